@@ -52,6 +52,7 @@ class ModelTester(object):
 		# - Process options
 		self.score_thr= 0.7
 		self.iou_thr= 0.6
+		self.batch_size= 16 # images detected at a time, see MaskRCNN.detect_many()
 
 		# - Results
 		self.n_classes= self.config.NUM_CLASSES
@@ -72,6 +73,7 @@ class ModelTester(object):
 		nimg= 0
 		logger.info("Processing up to %d images " % (self.n_max_img))
 
+		indices= []
 		for index, image_id in enumerate(self.dataset.image_ids):
 			nimg+= 1
 		
@@ -79,26 +81,36 @@ class ModelTester(object):
 			if self.n_max_img>0 and nimg>=self.n_max_img:
 				logger.info("Max number of images to inspect reached, stop here.")
 				break
+			indices.append(index)
 
-			# - Inspect results	for current image
-			image_path = self.dataset.image_info[index]['path']
-			image_path_base= os.path.basename(image_path)
+		# - Detect objects by chunks of images, run in batches by the model
+		for start in range(0,len(indices),self.batch_size):
+			chunk= indices[start:start+self.batch_size]
+			images= [self.dataset.load_image(self.dataset.image_ids[index]) for index in chunk]
+			results= self.model.detect_many(images,batch_size=self.batch_size,mask_format="crop")
 
-			# - Initialize the analyzer
-			analyzer= Analyzer(self.model,self.config,self.dataset)
-			analyzer.score_thr= self.score_thr
-			analyzer.iou_thr= self.iou_thr
-			
-			# - Inspecting results
-			logger.info("Inspecting results for image %s ..." % image_path_base)
-			status= analyzer.inspect_results(image_id,image_path)
-			if status<0:
-				logger.error("Failed to analyze results for image %s ..." % image_path_base)
-				continue
+			for index, image, r in zip(chunk,images,results):
+				image_id= self.dataset.image_ids[index]
 
-			# - Update performances
-			logger.info("Updating test performances using results for image %s ..." % image_path_base)
-			self.update_performances(analyzer)
+				# - Inspect results	for current image
+				image_path = self.dataset.image_info[index]['path']
+				image_path_base= os.path.basename(image_path)
+
+				# - Initialize the analyzer
+				analyzer= Analyzer(self.model,self.config,self.dataset)
+				analyzer.score_thr= self.score_thr
+				analyzer.iou_thr= self.iou_thr
+			
+				# - Inspecting results
+				logger.info("Inspecting results for image %s ..." % image_path_base)
+				status= analyzer.inspect_results(image_id,image_path,image,r)
+				if status<0:
+					logger.error("Failed to analyze results for image %s ..." % image_path_base)
+					continue
+
+				# - Update performances
+				logger.info("Updating test performances using results for image %s ..." % image_path_base)
+				self.update_performances(analyzer)
 			
 		# - Compute final results
 		logger.info("Computing final performances ...")
@@ -243,8 +255,8 @@ class Analyzer(object):
 	# =============================
 	# ==     GET DATA FROM MODEL
 	# =============================
-	def get_data(self):
-		""" Retrieve data from dataset & model """
+	def get_data(self,image=None,r=None):
+		""" Retrieve data from dataset & model. The image and the detector result are computed if not given """
 
 		# - Throw error if dataset is not given
 		if not self.dataset:
@@ -252,18 +264,21 @@ class Analyzer(object):
 			return -1
 
 		# - Load image
-		self.image = self.dataset.load_image(self.image_id)
+		if image is None:
+			image= self.dataset.load_image(self.image_id)
+		self.image = image
 		self.image_path_base= os.path.basename(self.image_path)
 		self.image_path_base_noext= os.path.splitext(self.image_path_base)[0]		
 
 		# - Get detector result
-		r = self.model.detect([self.image], verbose=0)[0]
+		if r is None:
+			r = self.model.detect_many([self.image], verbose=0, mask_format="crop")[0]
 		self.class_names= self.dataset.class_names
 		self.masks= r['masks']
 		self.boxes= r['rois']
 		self.class_ids= r['class_ids']
 		self.scores= r['scores']
-		self.nobjects= self.masks.shape[-1]
+		self.nobjects= utils.mask_count(self.masks)
 		#N = boxes.shape[0]
 
 		# - Retrieve ground truth masks
@@ -292,13 +307,13 @@ class Analyzer(object):
 			self.image_id= image_id
 
 		# - Get detector result
-		r = self.model.detect([self.image], verbose=0)[0]
+		r = self.model.detect_many([self.image], verbose=0, mask_format="crop")[0]
 		self.class_names= self.config.CLASS_NAMES
 		self.masks= r['masks']
 		self.boxes= r['rois']
 		self.class_ids= r['class_ids']
 		self.scores= r['scores']
-		self.nobjects= self.masks.shape[-1]
+		self.nobjects= utils.mask_count(self.masks)
 
 		# - Process detected masks
 		if self.nobjects>0:
@@ -322,14 +337,14 @@ class Analyzer(object):
 	# ========================
 	# ==     INSPECT
 	# ========================
-	def inspect_results(self,image_id,image_path):
-		""" Inspect results on given image """
+	def inspect_results(self,image_id,image_path,image=None,r=None):
+		""" Inspect results on given image, optionally with the image and the detector result already computed """
 	
 		# - Retrieve data from dataset & model
 		logger.info("Retrieve data from dataset & model ...")
 		self.image_id= image_id
 		self.image_path= image_path
-		if self.get_data()<0:
+		if self.get_data(image,r)<0:
 			logger.error("Failed to set data from provided dataset!")
 			return -1
 
@@ -476,7 +491,6 @@ class Analyzer(object):
 		logger.info("%d objects (%d boxes) found in this image ..." % (self.nobjects,N))
 
 		for i in range(N):
-			mask= self.masks[:, :, i]
 			class_id = self.class_ids[i]
 			score = self.scores[i]
 			label = self.class_names[class_id]
@@ -486,6 +500,8 @@ class Analyzer(object):
 				continue
 
 			logger.info("Selecting object %s (id=%d) with score %f>thr=%f ..." % (label,class_id,score,self.score_thr))
+			# - Full size mask, built for the selected objects only
+			mask= utils.instance_mask(self.masks,self.boxes,i,self.image.shape)
 			masks_sel.append(mask)
 			class_ids_sel.append(class_id)
 			scores_sel.append(score)
@@ -672,33 +688,24 @@ class Analyzer(object):
 		self.nobjs_det= np.zeros((1,self.n_classes))
 		self.nobjs_det_right= np.zeros((1,self.n_classes))
 
-		# - Loop over gt boxes and find associations to det boxes
+		# - Compute IOU of the overlapping true and detected objects
+		logger.debug("len(self.bboxes)=%d, len(self.class_ids_final)=%d" % (len(self.bboxes),len(self.class_ids_final)))
+		gt_index= utils.BoxGridIndex(self.bboxes_gt)
+		gt_ids, det_ids, ious= gt_index.overlaps(self.bboxes)
+		class_ids_gt= np.array(self.class_ids_gt_merged, dtype=np.int64)
+		class_ids_det= np.array(self.class_ids_final, dtype=np.int64)
+
+		# - Find associations between true and detected objects according to largest IOU
+		det_best= utils.match_best_sparse(gt_ids, det_ids, ious, len(self.bboxes_gt), self.iou_thr)
+		np.add.at(self.nobjs_true[0], class_ids_gt, 1)
+		associated= det_best!=-1
+		np.add.at(self.confusion_matrix, (class_ids_gt[associated], class_ids_det[det_best[associated]]), 1)
+
 		for i in range(len(self.bboxes_gt)):
-			bbox_gt= self.bboxes_gt[i]
-			class_id_gt= self.class_ids_gt_merged[i]
-			self.nobjs_true[0][class_id_gt]+= 1
-			
-			# - Find associations between true and detected objects according to largest IOU
-			index_best= -1
-			iou_best= 0
-			logger.debug("len(self.bboxes)=%d, len(self.class_ids_final)=%d" % (len(self.bboxes),len(self.class_ids_final)))
-	
-			for j in range(len(self.bboxes)):
-				class_id= self.class_ids_final[j]
-				bbox= self.bboxes[j]
-				iou= utils.get_iou(bbox, bbox_gt)
-				logger.debug("IOU(det=%d,true=%d)=%f" % (j,i,iou))
-				if iou>self.iou_thr and iou>=iou_best:
-					index_best= j
-					iou_best= iou
-
-			# - Update confusion matrix
-			if index_best==-1:
-				logger.info("True object no. %d (class_id=%d) not associated to any detected object ..." % (i+1,class_id_gt))
+			if det_best[i]==-1:
+				logger.info("True object no. %d (class_id=%d) not associated to any detected object ..." % (i+1,class_ids_gt[i]))
 			else:
-				class_id_det= self.class_ids_final[index_best]
-				self.confusion_matrix[class_id_gt][class_id_det]+= 1
-				logger.info("True object no. %d (class_id=%d) associated to detected object no. %d (class_id=%d) ..." % (i+1,class_id_gt,index_best,class_id_det))
+				logger.info("True object no. %d (class_id=%d) associated to detected object no. %d (class_id=%d) ..." % (i+1,class_ids_gt[i],det_best[i],class_ids_det[det_best[i]]))
 			
 
 		# - Normalize confusion matrix
@@ -711,28 +718,13 @@ class Analyzer(object):
 				C_norm= C/norm
 				self.confusion_matrix_norm[i][j]= C_norm
 
-		# - Compute purity
-		for j in range(len(self.bboxes)):
-			bbox= self.bboxes[j]
-			class_id= self.class_ids_final[j]
-			self.nobjs_det[0][class_id]+= 1
-
-			# - Find association to true box
-			index_best= -1
-			iou_best= 0
-			for i in range(len(self.bboxes_gt)):
-				bbox_gt= self.bboxes_gt[i]
-				class_id_gt= self.class_ids_gt_merged[i]	
-				iou= utils.get_iou(bbox, bbox_gt)
-				if iou>self.iou_thr and iou>=iou_best:
-					index_best= i
-					iou_best= iou
-		
-			# - Check if correctly detected
-			if index_best!=-1:
-				class_id_det= self.class_ids_gt_merged[index_best]	
-				if class_id==class_id_det:
-					self.nobjs_det_right[0][class_id]+= 1
+		# - Compute purity: find association of detected objects to true boxes
+		#   and check if correctly detected
+		gt_best= utils.match_best_sparse(det_ids, gt_ids, ious, len(self.bboxes), self.iou_thr)
+		np.add.at(self.nobjs_det[0], class_ids_det, 1)
+		right= gt_best!=-1
+		right[right]= class_ids_gt[gt_best[right]]==class_ids_det[right]
+		np.add.at(self.nobjs_det_right[0], class_ids_det[right], 1)
 
 	
 		for j in range(self.n_classes):
@@ -0,0 +1,106 @@
+"""
+Mask R-CNN
+Lightweight geometric augmentation.
+
+Flips and 90 degree rotations (the dihedral transforms of the image grid)
+applied to the image, masks and boxes together, as NumPy views. This
+replaces imgaug for the geometric part of the augmentation, imgaug can
+still be chained for non geometric augmenters (noise, blur, ...).
+
+Usage:
+
+    augmentation = DihedralAugmentation()
+    model.train(..., augmentation=augmentation)
+
+    # With additional imgaug augmenters applied to the image only
+    augmentation = DihedralAugmentation(
+        imgaug_augmentation=iaa.GaussianBlur(sigma=(0.0, 1.0)))
+"""
+
+import logging
+import numpy as np
+
+from mrcnn import utils
+
+## Get logger
+logger = logging.getLogger(__name__)
+
+
+############################################################
+#  Transforms
+############################################################
+
+# Dihedral transforms, as combinations of utils.DIHEDRAL_* flags. The
+# transpose is applied before the flips. Rotations are counterclockwise,
+# like np.rot90().
+IDENTITY = 0
+FLIP_LR = utils.DIHEDRAL_FLIP_LR
+FLIP_UD = utils.DIHEDRAL_FLIP_UD
+ROTATE_90 = utils.DIHEDRAL_TRANSPOSE | utils.DIHEDRAL_FLIP_UD
+ROTATE_180 = utils.DIHEDRAL_FLIP_LR | utils.DIHEDRAL_FLIP_UD
+ROTATE_270 = utils.DIHEDRAL_TRANSPOSE | utils.DIHEDRAL_FLIP_LR
+TRANSPOSE = utils.DIHEDRAL_TRANSPOSE
+TRANSVERSE = utils.DIHEDRAL_TRANSPOSE | utils.DIHEDRAL_FLIP_LR | utils.DIHEDRAL_FLIP_UD
+
+
+############################################################
+#  Augmentation
+############################################################
+
+class DihedralAugmentation(object):
+    """Applies one random dihedral transform to an image, its masks and its
+    boxes. The outputs are views of the inputs.
+
+    transforms: List of transforms to pick from. Default: all 8 of them.
+    probabilities: Optional. Probability of each transform. Default: uniform.
+    imgaug_augmentation: Optional. An imgaug augmentation applied after the
+        dihedral transform, with the same mask hooks as in load_image_gt().
+        Use it for non geometric augmenters only.
+    """
+
+    def __init__(self, transforms=None, probabilities=None, imgaug_augmentation=None):
+        self.transforms = list(utils.DIHEDRAL_TRANSFORMS if transforms is None else transforms)
+        if probabilities is not None:
+            probabilities = np.asarray(probabilities, dtype=np.float64)
+            assert len(probabilities) == len(self.transforms), \
+                "Give one probability per transform"
+            probabilities = probabilities / np.sum(probabilities)
+        self.probabilities = probabilities
+        self.imgaug_augmentation = imgaug_augmentation
+
+    def random_transform(self, image_shape, rng=None):
+        """Picks a random transform for an image of the given shape. Transposes
+        are only allowed on square images, they'd change the image size.
+
+        rng: Optional. np.random.RandomState to draw from. Defaults to the
+            global NumPy random generator.
+        """
+        transforms = self.transforms
+        probabilities = self.probabilities
+        if image_shape[0] != image_shape[1]:
+            keep = np.array([not (t & utils.DIHEDRAL_TRANSPOSE) for t in transforms])
+            if not np.any(keep):
+                return IDENTITY
+            transforms = [t for t, k in zip(transforms, keep) if k]
+            if probabilities is not None:
+                probabilities = probabilities[keep] / np.sum(probabilities[keep])
+        return transforms[(rng or np.random).choice(len(transforms), p=probabilities)]
+
+    def augment(self, image, mask, boxes=None, transform=None, rng=None):
+        """Applies a random (or the given) transform.
+
+        image: [height, width, channels]
+        mask: [height, width, instance count]
+        boxes: Optional. [instance count, (y1, x1, y2, x2)]
+        transform: Optional. Transform to apply instead of a random one.
+        rng: Optional. np.random.RandomState of the random transform.
+
+        Returns: image, mask and boxes (None if not given), transformed.
+        """
+        if transform is None:
+            transform = self.random_transform(image.shape, rng)
+        if boxes is not None:
+            boxes = utils.dihedral_boxes(boxes, transform, image.shape)
+        image = utils.dihedral_image(image, transform)
+        mask = utils.dihedral_image(mask, transform)
+        return image, mask, boxes
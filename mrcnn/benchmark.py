@@ -0,0 +1,880 @@
+"""
+Mask R-CNN
+Micro-benchmarks of the data pipeline hot spots.
+
+Each benchmark times an optimized function against the reference
+implementation it replaced (kept here verbatim) on synthetic data, and
+checks that both give the same results.
+
+Usage:
+
+    python -m mrcnn.benchmark rpn_targets --image_size=256 --ngt=1,30,300
+    python -m mrcnn.benchmark rpn_cache --image_size=256 --ngt=30,300
+    python -m mrcnn.benchmark masks --image_size=256 --ngt=30,300
+    python -m mrcnn.benchmark augment --image_size=256 --ngt=30,300
+    python -m mrcnn.benchmark detection_targets --image_size=256 --ngt=30,300
+    python -m mrcnn.benchmark mask_overlaps --image_size=256 --ngt=30,300
+    python -m mrcnn.benchmark nms --image_size=256
+    python -m mrcnn.benchmark unmold_detections --image_size=256 --ngt=1,30,300
+    python -m mrcnn.benchmark overlaps --image_size=256 --ngt=1,30,300
+    python -m mrcnn.benchmark resize --image_size=256
+    python -m mrcnn.benchmark spatial_index --image_size=132
+"""
+
+import sys
+import time
+import logging
+import numpy as np
+
+from mrcnn import utils
+from mrcnn import model as modellib
+from mrcnn.config import Config
+from mrcnn import augment
+from mrcnn import nms
+
+## Get logger
+logger = logging.getLogger(__name__)
+
+
+############################################################
+#  Configuration
+############################################################
+
+class BenchmarkConfig(Config):
+    """Configuration matching the source detector: small anchors on square
+    cutouts with many GT instances."""
+    NAME = "benchmark"
+    GPU_COUNT = 1
+    IMAGES_PER_GPU = 1
+    NUM_CLASSES = 1 + 5
+    RPN_ANCHOR_SCALES = (4, 8, 16, 32, 64)
+    RPN_TRAIN_ANCHORS_PER_IMAGE = 512
+    MAX_GT_INSTANCES = 300
+    IMAGE_MIN_DIM = 256
+    IMAGE_MAX_DIM = 256
+
+
+def make_config(image_size):
+    """Returns a BenchmarkConfig for square images of the given size."""
+    class _Config(BenchmarkConfig):
+        IMAGE_MIN_DIM = image_size
+        IMAGE_MAX_DIM = image_size
+    return _Config()
+
+
+############################################################
+#  Helpers
+############################################################
+
+def time_function(fn, *args, **kwargs):
+    """Runs fn(*args, **kwargs) repeatedly and returns (result, seconds per call).
+    repeat: number of timed calls (default 5). The best time is reported.
+    """
+    repeat = kwargs.pop("repeat", 5)
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        t0 = time.time()
+        result = fn(*args, **kwargs)
+        best = min(best, time.time() - t0)
+    return result, best
+
+
+def random_boxes(count, image_shape, min_size=2, max_size=64, seed=0):
+    """Generates random integer boxes [count, (y1, x1, y2, x2)] inside the image."""
+    rng = np.random.RandomState(seed)
+    h, w = image_shape[:2]
+    sizes = rng.randint(min_size, max_size + 1, (count, 2))
+    sizes = np.minimum(sizes, [h - 1, w - 1])
+    y1 = rng.randint(0, h - sizes[:, 0])
+    x1 = rng.randint(0, w - sizes[:, 1])
+    return np.stack([y1, x1, y1 + sizes[:, 0], x1 + sizes[:, 1]], axis=1).astype(np.int32)
+
+
+def pyramid_anchors(config):
+    """Returns the anchors used by data_generator() for the given config."""
+    backbone_shapes = modellib.compute_backbone_shapes(config, config.IMAGE_SHAPE)
+    return utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
+                                          config.RPN_ANCHOR_RATIOS,
+                                          backbone_shapes,
+                                          config.BACKBONE_STRIDES,
+                                          config.RPN_ANCHOR_STRIDE)
+
+
+def report(name, t_ref, t_new, error):
+    """Prints one benchmark result line."""
+    print("{:40} ref: {:9.3f} ms  new: {:9.3f} ms  speedup: {:6.1f}x  max error: {:.2e}".format(
+        name, t_ref * 1000, t_new * 1000, t_ref / max(t_new, 1e-9), error))
+
+
+############################################################
+#  Reference implementations
+############################################################
+
+def compute_overlaps_reference(boxes1, boxes2):
+    """utils.compute_overlaps() in float64, one column at a time."""
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+    overlaps = np.zeros((boxes1.shape[0], boxes2.shape[0]))
+    for i in range(overlaps.shape[1]):
+        overlaps[:, i] = utils.compute_iou(boxes2[i], boxes1, area2[i], area1)
+    return overlaps
+
+
+def compute_overlaps_masks_reference(masks1, masks2):
+    """utils.compute_overlaps_masks() with a dense product of the flattened
+    float32 masks."""
+    if masks1.shape[-1] == 0 or masks2.shape[-1] == 0:
+        return np.zeros((masks1.shape[-1], masks2.shape[-1]))
+    masks1 = np.reshape(masks1 > .5, (-1, masks1.shape[-1])).astype(np.float32)
+    masks2 = np.reshape(masks2 > .5, (-1, masks2.shape[-1])).astype(np.float32)
+    area1 = np.sum(masks1, axis=0)
+    area2 = np.sum(masks2, axis=0)
+    intersections = np.dot(masks1.T, masks2)
+    union = area1[:, None] + area2[None, :] - intersections
+    return intersections / union
+
+
+def non_max_suppression_reference(boxes, scores, threshold):
+    """utils.non_max_suppression() deleting the suppressed indices from the
+    sorted list after each kept box."""
+    boxes = boxes.astype(np.float32)
+    y1, x1, y2, x2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    area = (y2 - y1) * (x2 - x1)
+    ixs = scores.argsort()[::-1]
+    pick = []
+    while len(ixs) > 0:
+        i = ixs[0]
+        pick.append(i)
+        iou = utils.compute_iou(boxes[i], boxes[ixs[1:]], area[i], area[ixs[1:]])
+        remove_ixs = np.where(iou > threshold)[0] + 1
+        ixs = np.delete(ixs, remove_ixs)
+        ixs = np.delete(ixs, 0)
+    return np.array(pick, dtype=np.int32)
+
+
+def build_rpn_targets_reference(image_shape, anchors, gt_class_ids, gt_boxes, config):
+    """Dense implementation of model.build_rpn_targets() that compares every
+    anchor with every GT box and computes the deltas one anchor at a time."""
+    rpn_match = np.zeros([anchors.shape[0]], dtype=np.int32)
+    rpn_bbox = np.zeros((config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4))
+
+    crowd_ix = np.where(gt_class_ids < 0)[0]
+    if crowd_ix.shape[0] > 0:
+        non_crowd_ix = np.where(gt_class_ids > 0)[0]
+        crowd_boxes = gt_boxes[crowd_ix]
+        gt_class_ids = gt_class_ids[non_crowd_ix]
+        gt_boxes = gt_boxes[non_crowd_ix]
+        crowd_overlaps = compute_overlaps_reference(anchors, crowd_boxes)
+        crowd_iou_max = np.amax(crowd_overlaps, axis=1)
+        no_crowd_bool = (crowd_iou_max < 0.001)
+    else:
+        no_crowd_bool = np.ones([anchors.shape[0]], dtype=bool)
+
+    overlaps = compute_overlaps_reference(anchors, gt_boxes)
+
+    anchor_iou_argmax = np.argmax(overlaps, axis=1)
+    anchor_iou_max = overlaps[np.arange(overlaps.shape[0]), anchor_iou_argmax]
+    rpn_match[(anchor_iou_max < 0.3) & (no_crowd_bool)] = -1
+    gt_iou_argmax = np.argwhere(overlaps == np.max(overlaps, axis=0))[:, 0]
+    rpn_match[gt_iou_argmax] = 1
+    rpn_match[anchor_iou_max >= 0.7] = 1
+
+    ids = np.where(rpn_match == 1)[0]
+    extra = len(ids) - (config.RPN_TRAIN_ANCHORS_PER_IMAGE // 2)
+    if extra > 0:
+        ids = np.random.choice(ids, extra, replace=False)
+        rpn_match[ids] = 0
+    ids = np.where(rpn_match == -1)[0]
+    extra = len(ids) - (config.RPN_TRAIN_ANCHORS_PER_IMAGE -
+                        np.sum(rpn_match == 1))
+    if extra > 0:
+        ids = np.random.choice(ids, extra, replace=False)
+        rpn_match[ids] = 0
+
+    ids = np.where(rpn_match == 1)[0]
+    ix = 0
+    for i, a in zip(ids, anchors[ids]):
+        gt = gt_boxes[anchor_iou_argmax[i]]
+        gt_h = gt[2] - gt[0]
+        gt_w = gt[3] - gt[1]
+        gt_center_y = gt[0] + 0.5 * gt_h
+        gt_center_x = gt[1] + 0.5 * gt_w
+        a_h = a[2] - a[0]
+        a_w = a[3] - a[1]
+        a_center_y = a[0] + 0.5 * a_h
+        a_center_x = a[1] + 0.5 * a_w
+        rpn_bbox[ix] = [
+            (gt_center_y - a_center_y) / a_h,
+            (gt_center_x - a_center_x) / a_w,
+            np.log(gt_h / a_h),
+            np.log(gt_w / a_w),
+        ]
+        rpn_bbox[ix] /= config.RPN_BBOX_STD_DEV
+        ix += 1
+
+    return rpn_match, rpn_bbox
+
+
+def extract_bboxes_reference(mask):
+    """utils.extract_bboxes() looping over the instances."""
+    boxes = np.zeros([mask.shape[-1], 4], dtype=np.int32)
+    for i in range(mask.shape[-1]):
+        m = mask[:, :, i]
+        horizontal_indicies = np.where(np.any(m, axis=0))[0]
+        vertical_indicies = np.where(np.any(m, axis=1))[0]
+        if horizontal_indicies.shape[0]:
+            x1, x2 = horizontal_indicies[[0, -1]]
+            y1, y2 = vertical_indicies[[0, -1]]
+            x2 += 1
+            y2 += 1
+        else:
+            x1, x2, y1, y2 = 0, 0, 0, 0
+        boxes[i] = np.array([y1, x1, y2, x2])
+    return boxes.astype(np.int32)
+
+
+def minimize_mask_reference(bbox, mask, mini_shape):
+    """utils.minimize_mask() resizing one instance at a time with skimage.
+    Masks are cast to float, newer skimage versions refuse to interpolate bool."""
+    mini_mask = np.zeros(mini_shape + (mask.shape[-1],), dtype=bool)
+    for i in range(mask.shape[-1]):
+        m = mask[:, :, i].astype(np.float64)
+        y1, x1, y2, x2 = bbox[i][:4]
+        m = utils.resize(m[y1:y2, x1:x2], mini_shape)
+        mini_mask[:, :, i] = np.around(m).astype(bool)
+    return mini_mask
+
+
+def expand_mask_reference(bbox, mini_mask, image_shape):
+    """utils.expand_mask() resizing one instance at a time with skimage."""
+    mask = np.zeros(tuple(image_shape[:2]) + (mini_mask.shape[-1],), dtype=bool)
+    for i in range(mask.shape[-1]):
+        m = mini_mask[:, :, i].astype(np.float64)
+        y1, x1, y2, x2 = bbox[i][:4]
+        m = utils.resize(m, (y2 - y1, x2 - x1))
+        mask[y1:y2, x1:x2, i] = np.around(m).astype(bool)
+    return mask
+
+
+def unmold_masks_reference(masks, boxes, image_shape):
+    """utils.unmold_masks() calling the per instance skimage implementation."""
+    full_masks = []
+    for mask, (y1, x1, y2, x2) in zip(masks, boxes):
+        mask = utils.resize(mask, (y2 - y1, x2 - x1))
+        full_mask = np.zeros(image_shape[:2], dtype=bool)
+        full_mask[y1:y2, x1:x2] = mask >= 0.5
+        full_masks.append(full_mask)
+    return np.stack(full_masks, axis=-1)
+
+
+def unmold_detections_reference(detections, mrcnn_mask, original_image_shape,
+                                image_shape, window):
+    """MaskRCNN.unmold_detections() with np.delete() filtering and a
+    utils.unmold_mask() call per detection."""
+    zero_ix = np.where(detections[:, 4] == 0)[0]
+    N = zero_ix[0] if zero_ix.shape[0] > 0 else detections.shape[0]
+    boxes = detections[:N, :4]
+    class_ids = detections[:N, 4].astype(np.int32)
+    scores = detections[:N, 5]
+    masks = mrcnn_mask[np.arange(N), :, :, class_ids]
+    window = utils.norm_boxes(window, image_shape[:2])
+    wy1, wx1, wy2, wx2 = window
+    shift = np.array([wy1, wx1, wy1, wx1])
+    wh = wy2 - wy1
+    ww = wx2 - wx1
+    scale = np.array([wh, ww, wh, ww])
+    boxes = np.divide(boxes - shift, scale)
+    boxes = utils.denorm_boxes(boxes, original_image_shape[:2])
+    exclude_ix = np.where(
+        (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]) <= 0)[0]
+    if exclude_ix.shape[0] > 0:
+        boxes = np.delete(boxes, exclude_ix, axis=0)
+        class_ids = np.delete(class_ids, exclude_ix, axis=0)
+        scores = np.delete(scores, exclude_ix, axis=0)
+        masks = np.delete(masks, exclude_ix, axis=0)
+        N = class_ids.shape[0]
+    full_masks = []
+    for i in range(N):
+        full_mask = unmold_masks_reference(masks[i:i + 1], boxes[i:i + 1],
+                                           original_image_shape)[:, :, 0]
+        full_masks.append(full_mask)
+    full_masks = np.stack(full_masks, axis=-1)\
+        if full_masks else np.empty(original_image_shape[:2] + (0,))
+    return boxes, class_ids, scores, full_masks
+
+
+def generate_random_rois_reference(image_shape, count, gt_class_ids, gt_boxes):
+    """model.generate_random_rois() with rejection sampling loops per GT box."""
+    # placeholder
+    rois = np.zeros((count, 4), dtype=np.int32)
+
+    # Generate random ROIs around GT boxes (90% of count)
+    rois_per_box = int(0.9 * count / gt_boxes.shape[0])
+    for i in range(gt_boxes.shape[0]):
+        gt_y1, gt_x1, gt_y2, gt_x2 = gt_boxes[i]
+        h = gt_y2 - gt_y1
+        w = gt_x2 - gt_x1
+        # random boundaries
+        r_y1 = max(gt_y1 - h, 0)
+        r_y2 = min(gt_y2 + h, image_shape[0])
+        r_x1 = max(gt_x1 - w, 0)
+        r_x2 = min(gt_x2 + w, image_shape[1])
+
+        # To avoid generating boxes with zero area, we generate double what
+        # we need and filter out the extra. If we get fewer valid boxes
+        # than we need, we loop and try again.
+        while True:
+            y1y2 = np.random.randint(r_y1, r_y2, (rois_per_box * 2, 2))
+            x1x2 = np.random.randint(r_x1, r_x2, (rois_per_box * 2, 2))
+            # Filter out zero area boxes
+            threshold = 1
+            y1y2 = y1y2[np.abs(y1y2[:, 0] - y1y2[:, 1]) >=
+                        threshold][:rois_per_box]
+            x1x2 = x1x2[np.abs(x1x2[:, 0] - x1x2[:, 1]) >=
+                        threshold][:rois_per_box]
+            if y1y2.shape[0] == rois_per_box and x1x2.shape[0] == rois_per_box:
+                break
+
+        # Sort on axis 1 to ensure x1 <= x2 and y1 <= y2 and then reshape
+        # into x1, y1, x2, y2 order
+        x1, x2 = np.split(np.sort(x1x2, axis=1), 2, axis=1)
+        y1, y2 = np.split(np.sort(y1y2, axis=1), 2, axis=1)
+        box_rois = np.hstack([y1, x1, y2, x2])
+        rois[rois_per_box * i:rois_per_box * (i + 1)] = box_rois
+
+    # Generate random ROIs anywhere in the image (10% of count)
+    remaining_count = count - (rois_per_box * gt_boxes.shape[0])
+    # To avoid generating boxes with zero area, we generate double what
+    # we need and filter out the extra. If we get fewer valid boxes
+    # than we need, we loop and try again.
+    while True:
+        y1y2 = np.random.randint(0, image_shape[0], (remaining_count * 2, 2))
+        x1x2 = np.random.randint(0, image_shape[1], (remaining_count * 2, 2))
+        # Filter out zero area boxes
+        threshold = 1
+        y1y2 = y1y2[np.abs(y1y2[:, 0] - y1y2[:, 1]) >=
+                    threshold][:remaining_count]
+        x1x2 = x1x2[np.abs(x1x2[:, 0] - x1x2[:, 1]) >=
+                    threshold][:remaining_count]
+        if y1y2.shape[0] == remaining_count and x1x2.shape[0] == remaining_count:
+            break
+
+    # Sort on axis 1 to ensure x1 <= x2 and y1 <= y2 and then reshape
+    # into x1, y1, x2, y2 order
+    x1, x2 = np.split(np.sort(x1x2, axis=1), 2, axis=1)
+    y1, y2 = np.split(np.sort(y1y2, axis=1), 2, axis=1)
+    global_rois = np.hstack([y1, x1, y2, x2])
+    rois[-remaining_count:] = global_rois
+    return rois
+
+
+def detection_target_masks_reference(rois, gt_ids, gt_boxes, gt_masks, config):
+    """The mask targets of model.build_detection_targets(), one ROI at a
+    time with a full size placeholder for mini masks. Masks are resized as
+    floats, skimage doesn't interpolate bool images."""
+    masks = np.zeros((rois.shape[0],) + tuple(config.MASK_SHAPE), dtype=np.float32)
+    for i in range(rois.shape[0]):
+        gt_id = gt_ids[i]
+        class_mask = gt_masks[:, :, gt_id]
+
+        if config.USE_MINI_MASK:
+            # Create a mask placeholder, the size of the image
+            placeholder = np.zeros(config.IMAGE_SHAPE[:2], dtype=bool)
+            # GT box
+            gt_y1, gt_x1, gt_y2, gt_x2 = gt_boxes[gt_id]
+            gt_w = gt_x2 - gt_x1
+            gt_h = gt_y2 - gt_y1
+            # Resize mini mask to size of GT box
+            placeholder[gt_y1:gt_y2, gt_x1:gt_x2] = \
+                np.round(utils.resize(class_mask.astype(np.float64), (gt_h, gt_w))).astype(bool)
+            # Place the mini batch in the placeholder
+            class_mask = placeholder
+
+        # Pick part of the mask and resize it
+        y1, x1, y2, x2 = rois[i].astype(np.int32)
+        m = class_mask[y1:y2, x1:x2].astype(np.float64)
+        masks[i] = utils.resize(m, config.MASK_SHAPE)
+    return masks
+
+
+def augment_reference(image, mask, augmenter):
+    """Flips and rotates the image and masks with imgaug, as load_image_gt()
+    does for imgaug augmentations."""
+    det = augmenter.to_deterministic()
+    image = det.augment_image(image)
+    mask = det.augment_image(mask.astype(np.uint8)).astype(bool)
+    return image, mask
+
+
+############################################################
+#  Benchmarks
+############################################################
+
+def benchmark_rpn_targets(image_size=256, gt_counts=(1, 30, 300), repeat=5):
+    """Times build_rpn_targets() against the dense reference implementation."""
+    config = make_config(image_size)
+    anchors = pyramid_anchors(config)
+    anchor_index = utils.AnchorGridIndex(anchors)
+    print("rpn_targets: image {0}x{0}, {1} anchors".format(image_size, anchors.shape[0]))
+
+    for count in gt_counts:
+        gt_boxes = random_boxes(count, config.IMAGE_SHAPE, max_size=image_size // 4)
+        gt_class_ids = np.ones([count], dtype=np.int32)
+
+        np.random.seed(1)
+        (ref_match, ref_bbox), t_ref = time_function(
+            build_rpn_targets_reference, config.IMAGE_SHAPE, anchors,
+            gt_class_ids, gt_boxes, config, repeat=1)
+        np.random.seed(1)
+        (match, bbox), _ = time_function(
+            modellib.build_rpn_targets, config.IMAGE_SHAPE, anchors,
+            gt_class_ids, gt_boxes, config, anchor_index=anchor_index, repeat=1)
+        if not np.array_equal(match, ref_match):
+            logger.error("rpn_match differs from the reference for %d GT boxes!" % count)
+        error = np.abs(bbox - ref_bbox).max()
+
+        _, t_ref = time_function(build_rpn_targets_reference, config.IMAGE_SHAPE,
+                                 anchors, gt_class_ids, gt_boxes, config, repeat=repeat)
+        _, t_new = time_function(modellib.build_rpn_targets, config.IMAGE_SHAPE,
+                                 anchors, gt_class_ids, gt_boxes, config,
+                                 anchor_index=anchor_index, repeat=repeat)
+        report("build_rpn_targets (ngt={})".format(count), t_ref, t_new, error)
+
+
+def benchmark_rpn_cache(image_size=256, gt_counts=(1, 30, 300), repeat=5):
+    """Times the anchor matching of flipped and rotated images remapped by an
+    RPNTargetCache against matching them from scratch."""
+    config = make_config(image_size)
+    anchors = pyramid_anchors(config)
+    anchor_index = utils.AnchorGridIndex(anchors)
+    image_shape = config.IMAGE_SHAPE[:2]
+    print("rpn_cache: image {0}x{0}, {1} anchors".format(image_size, anchors.shape[0]))
+
+    for count in gt_counts:
+        gt_boxes = random_boxes(count, config.IMAGE_SHAPE, max_size=image_size // 4)
+        gt_class_ids = np.ones([count], dtype=np.int32)
+        cache = modellib.RPNTargetCache(anchors, anchor_index)
+        cache.match(0, image_shape, gt_class_ids, gt_boxes)
+        boxes = [utils.dihedral_boxes(gt_boxes, t, image_shape)
+                 for t in utils.DIHEDRAL_TRANSFORMS]
+
+        # The remapped anchors are the same, except for closest anchors that
+        # tie with IoUs that differ by rounding errors.
+        error = 0
+        for b in boxes:
+            ref = modellib.match_rpn_anchors(anchors, gt_class_ids, b, anchor_index)
+            new = cache.match(0, image_shape, gt_class_ids, b)
+            if not np.array_equal(np.sort(new["iou_ids"]), ref["iou_ids"]):
+                logger.error("Remapped anchors differ for %d GT boxes!" % count)
+            error = max(error, np.abs(new["gt_iou_max"] - ref["gt_iou_max"]).max())
+
+        def match_all(match_fn):
+            for b in boxes:
+                match_fn(b)
+        _, t_ref = time_function(match_all, lambda b: modellib.match_rpn_anchors(
+            anchors, gt_class_ids, b, anchor_index), repeat=repeat)
+        _, t_new = time_function(match_all, lambda b: cache.match(
+            0, image_shape, gt_class_ids, b), repeat=repeat)
+        report("RPNTargetCache.match x8 (ngt={})".format(count), t_ref, t_new, error)
+
+
+def random_masks(boxes, image_shape, seed=0):
+    """Generates elliptic instance masks [height, width, count] inscribed in
+    the given boxes."""
+    h, w = image_shape[:2]
+    yy, xx = np.mgrid[:h, :w]
+    masks = np.zeros([h, w, boxes.shape[0]], dtype=bool)
+    for i, (y1, x1, y2, x2) in enumerate(boxes):
+        cy, cx = (y1 + y2 - 1) / 2, (x1 + x2 - 1) / 2
+        ry, rx = max((y2 - y1) / 2, 0.5), max((x2 - x1) / 2, 0.5)
+        masks[:, :, i] = ((yy - cy) / ry) ** 2 + ((xx - cx) / rx) ** 2 <= 1
+    return masks
+
+
+def benchmark_masks(image_size=256, gt_counts=(1, 30, 300), repeat=5):
+    """Times the batched mask kernels against the per instance loops.
+    The error is the fraction of mask pixels that differ."""
+    config = make_config(image_size)
+    image_shape = config.IMAGE_SHAPE
+    mini_shape = config.MINI_MASK_SHAPE
+    print("masks: image {0}x{0}, mini mask {1}".format(image_size, mini_shape))
+
+    for count in gt_counts:
+        masks = random_masks(random_boxes(count, image_shape, max_size=image_size // 4),
+                             image_shape)
+        rng = np.random.RandomState(0)
+        small_masks = rng.uniform(size=(count,) + tuple(config.MASK_SHAPE)).astype(np.float32)
+
+        bbox, t_new = time_function(utils.extract_bboxes, masks, repeat=repeat)
+        ref, t_ref = time_function(extract_bboxes_reference, masks, repeat=repeat)
+        report("extract_bboxes (n={})".format(count), t_ref, t_new,
+               np.abs(bbox - ref).max())
+
+        mini, t_new = time_function(utils.minimize_mask, bbox, masks, mini_shape, repeat=repeat)
+        ref, t_ref = time_function(minimize_mask_reference, bbox, masks, mini_shape, repeat=repeat)
+        report("minimize_mask (n={})".format(count), t_ref, t_new, np.mean(mini != ref))
+
+        full, t_new = time_function(utils.expand_mask, bbox, mini, image_shape, repeat=repeat)
+        ref, t_ref = time_function(expand_mask_reference, bbox, mini, image_shape, repeat=repeat)
+        report("expand_mask (n={})".format(count), t_ref, t_new, np.mean(full != ref))
+
+        full, t_new = time_function(utils.unmold_masks, small_masks, bbox, image_shape, repeat=repeat)
+        ref, t_ref = time_function(unmold_masks_reference, small_masks, bbox, image_shape, repeat=repeat)
+        report("unmold_masks (n={})".format(count), t_ref, t_new, np.mean(full != ref))
+
+
+def benchmark_unmold_detections(image_size=256, counts=(1, 30, 100), repeat=5):
+    """Times MaskRCNN.unmold_detections() against the per detection loop, on
+    images molded to the image size from an original 1.5 times larger, with
+    full size and cropped masks. The last detection of each set has a zero
+    area box, which is filtered out. Counts are clamped to
+    DETECTION_MAX_INSTANCES, the most detections an image can have."""
+    config = make_config(image_size)
+    counts = sorted(set(min(c, config.DETECTION_MAX_INSTANCES) for c in counts))
+    image_shape = tuple(config.IMAGE_SHAPE)
+    original_shape = (image_size * 3 // 2, image_size * 3 // 2, 3)
+    window = np.array([0, 0, image_size, image_size])
+    print("unmold_detections: image {0}x{0}, original {1}x{1}".format(
+        image_size, original_shape[0]))
+    rng = np.random.RandomState(0)
+    for count in counts:
+        boxes = utils.norm_boxes(random_boxes(count, image_shape, max_size=image_size // 4),
+                                 image_shape[:2])
+        boxes[-1, 2:] = boxes[-1, :2]
+        detections = np.zeros([config.DETECTION_MAX_INSTANCES, 6], dtype=np.float32)
+        detections[:count, :4] = boxes
+        detections[:count, 4] = rng.randint(1, config.NUM_CLASSES, count)
+        detections[:count, 5] = rng.uniform(size=count)
+        mrcnn_mask = rng.uniform(size=(config.DETECTION_MAX_INSTANCES,) +
+                                 tuple(config.MASK_SHAPE) +
+                                 (config.NUM_CLASSES,)).astype(np.float32)
+        args = (detections, mrcnn_mask, original_shape, image_shape, window)
+        new, t_new = time_function(modellib.MaskRCNN.unmold_detections, None, *args,
+                                   repeat=repeat)
+        ref, t_ref = time_function(unmold_detections_reference, *args, repeat=repeat)
+        error = max(np.abs(new[0] - ref[0]).max(), np.mean(new[3] != ref[3]))
+        report("unmold_detections (n={})".format(count), t_ref, t_new, error)
+        # Masks cropped to their boxes
+        crops, t_new = time_function(modellib.MaskRCNN.unmold_detections, None, *args,
+                                     mask_format="crop", repeat=repeat)
+        error = np.mean(utils.to_full_masks(crops[3], crops[0], original_shape) != ref[3])
+        report("unmold_detections crop (n={})".format(count), t_ref, t_new, error)
+
+
+def benchmark_augment(image_size=256, gt_counts=(1, 30, 300), repeat=5):
+    """Times DihedralAugmentation against the same flips and rotations done
+    with imgaug (skipped if imgaug is not installed)."""
+    try:
+        from imgaug import augmenters as iaa
+    except ImportError:
+        logger.warning("imgaug is not installed, skipping the augment benchmark")
+        return
+    print("augment: image {0}x{0}".format(image_size))
+
+    # Transforms and the imgaug augmenters that do the same
+    transforms = [
+        (augment.FLIP_LR, iaa.Fliplr(1.0)),
+        (augment.FLIP_UD, iaa.Flipud(1.0)),
+        (augment.ROTATE_180, iaa.Rot90(2)),
+        (augment.ROTATE_270, iaa.Rot90(1)),
+    ]
+    dihedral = augment.DihedralAugmentation()
+    image_shape = (image_size, image_size, 3)
+    rng = np.random.RandomState(0)
+    image = rng.uniform(0, 255, image_shape).astype(np.float32)
+
+    for count in gt_counts:
+        mask = random_masks(random_boxes(count, image_shape, max_size=image_size // 4),
+                            image_shape)
+        error = 0
+        t_ref = t_new = 0
+        for transform, augmenter in transforms:
+            # Copy the views, as the training batch does
+            def native():
+                i, m, _ = dihedral.augment(image, mask, transform=transform)
+                return np.array(i), np.array(m)
+            (ref_image, ref_mask), t = time_function(
+                augment_reference, image, mask, augmenter, repeat=repeat)
+            t_ref += t
+            (new_image, new_mask), t = time_function(native, repeat=repeat)
+            t_new += t
+            error = max(error, np.abs(new_image - ref_image).max(),
+                        np.mean(new_mask != ref_mask))
+        report("DihedralAugmentation x4 (n={})".format(count), t_ref, t_new, error)
+
+
+def benchmark_detection_targets(image_size=256, gt_counts=(1, 30, 300), repeat=5):
+    """Times generate_random_rois() and the mask targets of
+    build_detection_targets() against the per box loops. The error of the
+    random ROIs, which are drawn differently, is the fraction of invalid
+    ROIs (empty or outside of the image)."""
+    config = make_config(image_size)
+    image_shape = config.IMAGE_SHAPE
+    count = config.TRAIN_ROIS_PER_IMAGE * 4
+    print("detection_targets: image {0}x{0}, {1} random ROIs".format(image_size, count))
+
+    for n in gt_counts:
+        gt_boxes = random_boxes(n, image_shape, max_size=image_size // 4)
+        gt_class_ids = np.ones([n], dtype=np.int32)
+        gt_masks = random_masks(gt_boxes, image_shape)
+
+        rois, t_new = time_function(modellib.generate_random_rois, image_shape, count,
+                                    gt_class_ids, gt_boxes, repeat=repeat)
+        _, t_ref = time_function(generate_random_rois_reference, image_shape, count,
+                                 gt_class_ids, gt_boxes, repeat=repeat)
+        invalid = (rois[:, 2] <= rois[:, 0]) | (rois[:, 3] <= rois[:, 1]) | \
+            (rois[:, 0] < 0) | (rois[:, 1] < 0) | \
+            (rois[:, 2] > image_shape[0]) | (rois[:, 3] > image_shape[1])
+        report("generate_random_rois (n={})".format(n), t_ref, t_new, np.mean(invalid))
+
+        # Mask targets of the positive ROIs, with full size and mini masks
+        overlaps = utils.compute_overlaps(rois, gt_boxes)
+        positive = np.where(overlaps.max(axis=1) > 0.5)[0]
+        rois = rois[positive]
+        gt_ids = overlaps[positive].argmax(axis=1)
+        for mini in [False, True]:
+            config.USE_MINI_MASK = mini
+            masks = utils.minimize_mask(gt_boxes, gt_masks, config.MINI_MASK_SHAPE) \
+                if mini else gt_masks
+            new, t_new = time_function(utils.crop_and_resize_masks, masks, gt_ids, rois,
+                                       config.MASK_SHAPE,
+                                       mask_boxes=gt_boxes if mini else None, repeat=repeat)
+            ref, t_ref = time_function(detection_target_masks_reference, rois, gt_ids,
+                                       gt_boxes, masks, config, repeat=repeat)
+            report("target masks{} x{} (n={})".format(" mini" if mini else "", rois.shape[0], n),
+                   t_ref, t_new, np.abs(new - ref).max())
+
+
+def benchmark_overlaps(image_size=256, gt_counts=(1, 30, 300), repeat=5):
+    """Times compute_overlaps() against the column loop, with the anchors
+    of images of 1, 2 and 4 times the image size: about 16k, 65k and 260k
+    anchors for 256."""
+    for size in [image_size, image_size * 2, image_size * 4]:
+        anchors = pyramid_anchors(make_config(size))
+        print("overlaps: image {0}x{0}, {1} anchors".format(size, anchors.shape[0]))
+        for n in gt_counts:
+            gt_boxes = random_boxes(n, (size, size), max_size=image_size // 4)
+            new, t_new = time_function(utils.compute_overlaps, anchors, gt_boxes,
+                                       repeat=repeat)
+            ref, t_ref = time_function(compute_overlaps_reference, anchors, gt_boxes,
+                                       repeat=repeat)
+            report("compute_overlaps (n={})".format(n), t_ref, t_new,
+                   np.abs(new - ref).max())
+
+
+def benchmark_mask_overlaps(image_size=256, gt_counts=(1, 30, 300), repeat=5, detections=100):
+    """Times the bounding box prefiltered, bit-packed compute_overlaps_masks()
+    against the dense product, for 100 detections against the GT masks, on
+    images of 1 and 4 times the image size."""
+    for size in [image_size, image_size * 4]:
+        print("mask_overlaps: image {0}x{0}, {1} detections".format(size, detections))
+        image_shape = (size, size)
+        for n in gt_counts:
+            gt_masks = random_masks(random_boxes(n, image_shape, max_size=image_size // 4),
+                                    image_shape)
+            pred_masks = random_masks(random_boxes(detections, image_shape,
+                                                   max_size=image_size // 4, seed=1),
+                                      image_shape)
+            # Some detections on the GT objects
+            k = min(n, detections // 2)
+            pred_masks[:, :, :k] = gt_masks[:, :, :k]
+            new, t_new = time_function(utils.compute_overlaps_masks, pred_masks, gt_masks,
+                                       repeat=repeat)
+            ref, t_ref = time_function(compute_overlaps_masks_reference, pred_masks, gt_masks,
+                                       repeat=repeat)
+            report("compute_overlaps_masks (n={})".format(n), t_ref, t_new,
+                   np.abs(new - ref).max())
+
+
+def benchmark_nms(image_size=256, counts=(100, 1000, 6000), repeat=5, threshold=0.3):
+    """Times nms_matrix() and nms_sweep() against the np.delete loop, on
+    random boxes in pixel and normalized coordinates. The error is the
+    fraction of boxes kept by one and not the other."""
+    print("nms: image {0}x{0}, IoU threshold {1}".format(image_size, threshold))
+    for n in counts:
+        boxes = random_boxes(n, (image_size, image_size), max_size=image_size // 8)
+        scores = np.random.RandomState(n).uniform(size=n).astype(np.float32)
+        for normalized in [False, True]:
+            b = utils.norm_boxes(boxes, (image_size, image_size)) if normalized else boxes
+            ref, t_ref = time_function(non_max_suppression_reference, b, scores, threshold,
+                                       repeat=repeat)
+            for fn in [nms.nms_matrix, nms.nms_sweep]:
+                if fn is nms.nms_matrix and n > 4 * nms.NMS_MATRIX_MAX_BOXES:
+                    continue
+                keep, t_new = time_function(fn, b, scores, threshold, repeat=repeat)
+                error = len(set(keep) ^ set(ref)) / max(len(ref), 1)
+                report("{}{} (n={})".format(fn.__name__, " norm" if normalized else "", n),
+                       t_ref, t_new, error)
+        # Per class, against one NMS per class
+        class_ids = np.random.RandomState(0).randint(1, 4, size=n)
+        keep, t_new = time_function(nms.batched_nms, boxes, scores, class_ids, threshold,
+                                    repeat=repeat)
+        ref = np.concatenate([
+            np.flatnonzero(class_ids == c)[non_max_suppression_reference(
+                boxes[class_ids == c], scores[class_ids == c], threshold)]
+            for c in np.unique(class_ids)])
+        report("batched_nms 3 classes (n={})".format(n), t_ref, t_new,
+               len(set(keep) ^ set(ref)) / max(len(ref), 1))
+
+
+def sources_in_cutouts_reference(positions, rects):
+    """The sources strictly inside each cutout, by comparing every source
+    with every cutout, one cutout at a time as SClassifier did."""
+    source_ids = []
+    rect_ids = []
+    for i, (y1, x1, y2, x2) in enumerate(rects):
+        inside = np.where((positions[:, 0] > y1) & (positions[:, 0] < y2) &
+                          (positions[:, 1] > x1) & (positions[:, 1] < x2))[0]
+        source_ids.append(inside)
+        rect_ids.append(np.full(inside.shape, i))
+    return np.concatenate(source_ids), np.concatenate(rect_ids)
+
+
+def benchmark_spatial_index(image_size=256, counts=(1000, 5000, 20000), repeat=5):
+    """Times the cutout queries of BoxGridIndex against the scan of all the
+    sources, for a catalog of sources on a map, with one cutout of the image
+    size around each source. The error is the number of differing pairs."""
+    print("spatial_index: cutouts {0}x{0}".format(image_size))
+    for n in counts:
+        # About 10 sources per cutout
+        side = int(image_size * np.sqrt(n / 10.))
+        rng = np.random.RandomState(n)
+        positions = rng.uniform(0, side, size=(n, 2))
+        rects = np.concatenate([positions - image_size / 2, positions + image_size / 2], axis=1)
+
+        def query():
+            index = utils.BoxGridIndex(np.concatenate([positions, positions], axis=1))
+            return index.query(rects)
+
+        (ids, rids), t_new = time_function(query, repeat=repeat)
+        (ref_ids, ref_rids), t_ref = time_function(sources_in_cutouts_reference, positions,
+                                                   rects, repeat=repeat)
+        error = len(set(zip(ids, rids)) ^ set(zip(ref_ids, ref_rids)))
+        report("cutout sources (n={})".format(n), t_ref, t_new, error)
+
+
+# (dtype, order) of the resize() calls of the pipeline: images are resized
+# with bilinear interpolation, masks with nearest neighbor
+RESIZE_CASES = [(np.float32, 1), (np.float64, 1), (np.uint8, 1),
+                (np.float32, 0), (np.uint8, 0), (bool, 0)]
+
+
+def resize_input(image_size, dtype, channels=3, seed=0):
+    """Returns a random image [image_size, image_size, channels] of a dtype,
+    with zeros around a brighter square like the padded images."""
+    rng = np.random.RandomState(seed)
+    image = rng.uniform(1, 255, size=(image_size, image_size, channels))
+    image[:image_size // 8] = 0
+    if dtype == bool:
+        return image > 128
+    return image.astype(dtype)
+
+
+def time_resize_backends(image, output_shape, order, repeat=5):
+    """Times each resize backend on an image, against skimage resize().
+    Returns a dict of name: (seconds per call, max error relative to the
+    image range). Backends that don't handle the sizes are left out."""
+    ref = utils._resize_skimage(image, output_shape, order)
+    scale = max(float(np.abs(ref.astype(np.float64)).max()), 1.)
+    results = {}
+    for name, backend in utils.RESIZE_BACKENDS.items():
+        resized, t = time_function(backend, image, output_shape, order, repeat=repeat)
+        if resized is None:
+            continue
+        error = np.abs(resized.astype(np.float64) - ref.astype(np.float64)).max() / scale
+        if resized.shape != ref.shape or (order == 0 and resized.dtype != ref.dtype):
+            error = np.inf
+        results[name] = (t, error)
+    return results
+
+
+def select_resize_backends(image_size=256, repeat=5, tolerance=1e-5, verbose=1):
+    """Picks the fastest resize backend of each (dtype, order) in
+    RESIZE_CASES and selects it with utils.set_resize_backend(). Backends
+    are timed on a scale of 1.5, which the fast paths don't handle, and
+    must match skimage to the relative tolerance.
+
+    Returns a dict of (dtype name, order): backend name.
+    """
+    output_size = image_size * 3 // 2
+    selected = {}
+    for dtype, order in RESIZE_CASES:
+        image = resize_input(image_size, dtype)
+        results = time_resize_backends(image, (output_size, output_size), order,
+                                       repeat=repeat)
+        valid = [(t, name) for name, (t, error) in results.items() if error <= tolerance]
+        name = min(valid)[1]
+        utils.set_resize_backend(name, dtype=dtype, order=order)
+        selected[(np.dtype(dtype).name, order)] = name
+        if verbose:
+            print("{:10} order {}: {}".format(np.dtype(dtype).name, order, name))
+    return selected
+
+
+def benchmark_resize(image_size=256, repeat=5):
+    """Times the resize backends against skimage resize() on scales with
+    and without a fast path, then selects the fastest backend of each
+    (dtype, order). The error is relative to the range of the image."""
+    print("resize: image {0}x{0}x3".format(image_size))
+    for dtype, order in RESIZE_CASES:
+        image = resize_input(image_size, dtype)
+        for scale in [1, 2, 0.5, 1.5]:
+            output_shape = (int(image_size * scale), int(image_size * scale))
+            results = time_resize_backends(image, output_shape, order, repeat=repeat)
+            t_ref = results["skimage"][0]
+            for name, (t, error) in results.items():
+                if name != "skimage":
+                    report("{} {} order {} x{} ({})".format(
+                        "resize", np.dtype(dtype).name, order, scale, name),
+                        t_ref, t, error)
+    print("fastest backends:")
+    select_resize_backends(image_size, repeat)
+
+
+BENCHMARKS = {
+    "rpn_targets": lambda args: benchmark_rpn_targets(
+        args.image_size, args.ngt, args.repeat),
+    "rpn_cache": lambda args: benchmark_rpn_cache(
+        args.image_size, args.ngt, args.repeat),
+    "masks": lambda args: benchmark_masks(
+        args.image_size, args.ngt, args.repeat),
+    "augment": lambda args: benchmark_augment(
+        args.image_size, args.ngt, args.repeat),
+    "detection_targets": lambda args: benchmark_detection_targets(
+        args.image_size, args.ngt, args.repeat),
+    "mask_overlaps": lambda args: benchmark_mask_overlaps(
+        args.image_size, args.ngt, args.repeat),
+    "unmold_detections": lambda args: benchmark_unmold_detections(
+        args.image_size, args.ngt, args.repeat),
+    "nms": lambda args: benchmark_nms(
+        args.image_size, repeat=args.repeat),
+    "spatial_index": lambda args: benchmark_spatial_index(
+        args.image_size, repeat=args.repeat),
+    "overlaps": lambda args: benchmark_overlaps(
+        args.image_size, args.ngt, args.repeat),
+    "resize": lambda args: benchmark_resize(
+        args.image_size, args.repeat),
+}
+
+
+def main():
+    """Main function"""
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark Mask R-CNN data pipeline functions')
+    parser.add_argument("benchmark", metavar="<benchmark>", choices=sorted(BENCHMARKS.keys()) + ["all"], help="Benchmark to run or 'all'")
+    parser.add_argument('--image_size', required=False, default=256, type=int, help="Image size in pixels")
+    parser.add_argument('--ngt', required=False, default=[1, 30, 300], type=lambda s: [int(x) for x in s.split(',')], help="Comma separated list of GT box counts")
+    parser.add_argument('--repeat', required=False, default=5, type=int, help="Number of timed repetitions")
+    args = parser.parse_args()
+
+    names = sorted(BENCHMARKS.keys()) if args.benchmark == "all" else [args.benchmark]
+    for name in names:
+        BENCHMARKS[name](args)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
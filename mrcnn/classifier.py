@@ -104,6 +104,7 @@ class SClassifier(object):
 		# - Source catalog data
 		self.scatalog_path= ''
 		self.sources= []
+		self.source_index= None
 		self.n_max_sources= -1
 		self.scutout_size= 132
 
@@ -222,21 +223,18 @@ class SClassifier(object):
 		is_bbox_cut= [bbox_cut]
 		indices_s= [sindex]
 		
-		for j in range(len(self.sources)):
+		if self.source_index is None:
+			self.index_sources()
+		indices_in_cutout, _= self.source_index.query([[ymin,xmin,ymax,xmax]])
+
+		for j in indices_in_cutout:
 			sname_j= self.sources[j].name
-			x0_j= self.sources[j].x0
-			y0_j= self.sources[j].y0
 			xmin_j= self.sources[j].xmin
 			xmax_j= self.sources[j].xmax
 			ymin_j= self.sources[j].ymin	
 			ymax_j= self.sources[j].ymax
 			if sname==sname_j:
 				continue
-			is_inside_x= (x0_j>xmin and x0_j<xmax)
-			is_inside_y= (y0_j>ymin and y0_j<ymax)
-			is_inside= (is_inside_x and is_inside_y)
-			if not is_inside:		
-				continue
 
 			indices_s.append(j)
 			
@@ -283,43 +281,25 @@ class SClassifier(object):
 
 
 		# - Process detected objects and match with source according to IOU
+		ious= utils.pairwise_iou(bboxes_s, bboxes_det)
+		det_indices= utils.match_best(ious, self.iou_thr)
 		association_map= {}
-		det_indices= []
 
 		for j in range(len(bboxes_s)):
 			index= indices_s[j]
 			sname_s= self.sources[index].name
-			bbox_cut= is_bbox_cut[j] 
-			bbox_s= bboxes_s[j]
-			xmin_s= bbox_j[1]
-			xmax_s= bbox_j[3]
-			ymin_s= bbox_j[0]
-			ymax_s= bbox_j[2]
-
-			logger.info("Find if source %s (index=%d) is associated to any of the %d objects detected..." % (sname_s,index,len(bboxes_det)))
-			index_best= -1
-			iou_best= 0
-
-			for i in range(len(bboxes_det)):
-				bbox_det= bboxes_det[i]
-
-				iou= utils.get_iou(bbox_det,bbox_s)
-				xmin_o= bbox_det[1]
-				xmax_o= bbox_det[3]
-				ymin_o= bbox_det[0]
-				ymax_o= bbox_det[2]
- 
-				logger.info("Det bbox no. %d [%s,%s,%s,%s], Source bbox[%s,%s,%s,%s]: IOU=%f" % (i+1,str(xmin_o),str(xmax_o),str(ymin_o),str(ymax_o),str(xmin_s),str(xmax_s),str(ymin_s),str(ymax_s),iou))
-				if iou>self.iou_thr and iou>=iou_best:
-					index_best= i
-					iou_best= iou
-
-			det_indices.append(index_best)
-
-			if index_best!=-1:
-				if not index_best in association_map:
-					association_map[index_best]= []
-				association_map[index_best].append(index)
+			index_best= det_indices[j]
+			ymin_s, xmin_s, ymax_s, xmax_s= bboxes_s[j]
+
+			if index_best==-1:
+				logger.info("Source %s (index=%d) bbox [%s,%s,%s,%s] not associated to any of the %d objects detected (max IOU=%f)..." % (sname_s,index,str(xmin_s),str(xmax_s),str(ymin_s),str(ymax_s),len(bboxes_det),ious[j].max()))
+				continue
+
+			ymin_o, xmin_o, ymax_o, xmax_o= bboxes_det[index_best]
+			logger.info("Source %s (index=%d) bbox [%s,%s,%s,%s] associated to det bbox no. %d [%s,%s,%s,%s]: IOU=%f" % (sname_s,index,str(xmin_s),str(xmax_s),str(ymin_s),str(ymax_s),index_best+1,str(xmin_o),str(xmax_o),str(ymin_o),str(ymax_o),ious[j][index_best]))
+			if not index_best in association_map:
+				association_map[index_best]= []
+			association_map[index_best].append(index)
 				
 
 		# - Add classification info
@@ -423,8 +403,19 @@ class SClassifier(object):
 
 		logger.info("Read #%d sources from file %s ..." % (len(self.sources),self.scatalog_path))
 
+		# - Index source positions
+		self.index_sources()
+
 		return 0
 
+	## ============================
+	## ==    INDEX SOURCES
+	## ============================
+	def index_sources(self):
+		""" Build spatial index of source positions, to find the sources in a cutout """
+		positions= [[s.y0,s.x0,s.y0,s.x0] for s in self.sources]
+		self.source_index= utils.BoxGridIndex(positions)
+
 	#def read_scatalog(self):
 	#	""" Read source catalog """
 	#
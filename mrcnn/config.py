@@ -7,6 +7,7 @@ Licensed under the MIT License (see LICENSE for details)
 Written by Waleed Abdulla
 """
 
+import copy
 import numpy as np
 
 
@@ -90,6 +91,35 @@ class Config(object):
 
     # How many anchors per image to use for RPN training
     RPN_TRAIN_ANCHORS_PER_IMAGE = 256
+
+    # Cache the anchor matches of training images in the data generator.
+    # When an image comes back flipped or rotated by 90 degrees the cached
+    # match is remapped instead of computing the anchor overlaps again.
+    CACHE_RPN_TARGETS = True
+
+    # Optional. Directory where the anchors of each image shape are saved,
+    # keyed by a fingerprint of the anchor settings. The generator workers
+    # and the models memory-map them read-only instead of generating them
+    # again. Use a directory only you can write to, for example in the log
+    # directory: don't share it through a world-writable one like /tmp.
+    # None keeps them in memory only, per process.
+    ANCHOR_CACHE_DIR = None
+
+    # Record the time spent in each stage of the data generator (FITS
+    # reading, resizing, augmentation, RPN targets, ...). The timings are
+    # written to TensorBoard and to data_timing.csv in the log directory at
+    # the end of each epoch. See timing.py.
+    PROFILE_DATA_GENERATOR = False
+
+    # Seed of the training data stream (shuffling, augmentation and target
+    # sampling). None picks a random seed. The seed and the position in the
+    # stream are saved next to each checkpoint to resume training from it.
+    DATA_GENERATOR_SEED = None
+
+    # File, in the model directory, where the data generator records the
+    # samples that fail to load (e.g. corrupt FITS files). They're skipped in
+    # the next epochs and runs. None disables the quarantine. See quarantine.py.
+    QUARANTINE_FILE = "quarantine.jsonl"
     
     # ROIs kept after tf.nn.top_k and before non-maximum suppression
     PRE_NMS_LIMIT = 6000
@@ -174,6 +204,24 @@ class Config(object):
     # Non-maximum suppression threshold for detection
     DETECTION_NMS_THRESHOLD = 0.3
 
+    # Format of the masks returned by MaskRCNN.detect(), see
+    # utils.MASK_FORMATS. "full" gives [height, width, N] bool arrays of
+    # the image size, "crop" the masks cropped to their boxes and "rle"
+    # their run length encodings, much smaller on large images.
+    DETECTION_MASK_FORMAT = "full"
+
+    # Type of the masks the inference graph returns to detect(): "float32",
+    # "float16", or "uint8" (probabilities scaled to [0, 255]). Smaller
+    # types are faster to copy out of the session. Masks of rounded
+    # probabilities can differ by a pixel on their edge once resized.
+    DETECTION_MASK_DTYPE = "float32"
+
+    # Embed the anchors of IMAGE_SHAPE in the inference graph as a constant
+    # instead of feeding them to the model with every batch. The model
+    # then has no input_anchors and only runs on images of IMAGE_SHAPE.
+    # Ignored with the resizing modes that give images of varying shapes.
+    INFERENCE_ANCHORS_IN_GRAPH = False
+
     # Learning rate and momentum
     # The Mask RCNN paper uses lr=0.02, but on TensorFlow it causes
     # weights to explode. Likely due to differences in optimizer
@@ -227,6 +275,16 @@ class Config(object):
         # See compose_image_meta() for details
         self.IMAGE_META_SIZE = 1 + 3 + 3 + 4 + 1 + self.NUM_CLASSES
 
+    def with_batch_size(self, batch_size):
+        """Returns a copy of the config with a batch size of batch_size
+        images on one GPU. Used to build an inference model with another
+        batch size than the training one."""
+        config = copy.copy(self)
+        config.GPU_COUNT = 1
+        config.IMAGES_PER_GPU = batch_size
+        config.BATCH_SIZE = batch_size
+        return config
+
     def display(self):
         """Display Configuration values."""
         print("\nConfigurations:")
@@ -0,0 +1,212 @@
+"""
+Mask R-CNN
+Frozen inference graphs.
+
+Building the ResNet-FPN graph and loading the weights layer by layer from
+the h5 file take most of the startup of an inference job. export_frozen()
+saves an inference model as a single frozen GraphDef file: variables are
+converted to constants, the nodes the outputs don't depend on are
+stripped, and, if the TF graph transforms are available, constants and
+batch norms are folded.
+The config of the model is saved in the graph too.
+
+FrozenMaskRCNN loads the file and has the detection API of MaskRCNN:
+
+    # Once per model version
+    model = modellib.MaskRCNN(mode="inference", config=config, model_dir=logs)
+    model.load_weights(weights_path, by_name=True)
+    export.export_frozen(model, "mask_rcnn.pb")
+
+    # In the inference jobs
+    model = export.FrozenMaskRCNN("mask_rcnn.pb")
+    results = model.detect_many(images)
+
+Only the inference outputs of MaskRCNN.inference_model are kept, so the
+frozen model can't run run_graph() or be trained.
+"""
+
+import json
+import logging
+import numpy as np
+import tensorflow as tf
+import keras.backend as K
+
+from mrcnn import model as modellib
+from mrcnn.config import Config
+
+## Get logger
+logger = logging.getLogger(__name__)
+
+
+# Name of the constant node with the export info (config and tensor names)
+EXPORT_INFO_NODE = "mrcnn_export_info"
+
+# Graph transforms applied after freezing, see optimize_graph(). Identity
+# nodes are kept: the while loop of tf.map_fn in DetectionLayer needs them.
+GRAPH_TRANSFORMS = [
+    "strip_unused_nodes",
+    "remove_nodes(op=CheckNumerics)",
+    "fold_constants(ignore_errors=true)",
+    "fold_batch_norms",
+    "fold_old_batch_norms",
+    "sort_by_execution_order",
+]
+
+
+############################################################
+#  Config
+############################################################
+
+def config_to_dict(config):
+    """Returns the settings of a config that can be saved in JSON, the ones
+    Config.display() shows. Callables are skipped."""
+    settings = {}
+    arrays = []
+    for name in dir(config):
+        value = getattr(config, name)
+        if name.startswith("__") or callable(value):
+            continue
+        if isinstance(value, np.ndarray):
+            arrays.append(name)
+            value = value.tolist()
+        try:
+            json.dumps(value)
+        except TypeError:
+            logger.warning("Config setting %s can't be exported, skipping it", name)
+            continue
+        settings[name] = value
+    return {"settings": settings, "arrays": arrays}
+
+
+def config_from_dict(info):
+    """Returns a Config with the settings of config_to_dict()."""
+    config = Config()
+    for name, value in info["settings"].items():
+        if name in info["arrays"]:
+            value = np.array(value)
+        setattr(config, name, value)
+    return config
+
+
+############################################################
+#  Export
+############################################################
+
+def optimize_graph(graph_def, inputs, outputs, transforms=None):
+    """Applies GRAPH_TRANSFORMS to a frozen graph. Returns the graph as it
+    is if the graph transforms of TF are not available."""
+    try:
+        from tensorflow.tools.graph_transforms import TransformGraph
+    except ImportError:
+        logger.warning("TF graph transforms not available, the graph is not optimized")
+        return graph_def
+    return TransformGraph(graph_def, inputs, outputs, transforms or GRAPH_TRANSFORMS)
+
+
+def _node_name(tensor):
+    return tensor.name.split(":")[0]
+
+
+def export_frozen(model, path, optimize=True):
+    """Saves the inference model of a MaskRCNN as a frozen graph file.
+
+    model: MaskRCNN in inference mode, with its weights loaded.
+    path: The file to write, usually with a .pb extension.
+    optimize: Apply GRAPH_TRANSFORMS to the frozen graph.
+
+    Returns the frozen GraphDef.
+    """
+    assert model.mode == "inference", "Create model in inference mode."
+    config = model.config
+    assert config.GPU_COUNT == 1, "Export a model on one GPU, see MaskRCNN(batch_size=...)"
+    if callable(config.BACKBONE):
+        assert modellib.anchors_in_graph(config, "inference"),\
+            "Anchors can't be computed without the backbone, set INFERENCE_ANCHORS_IN_GRAPH"
+    inference_model = model.inference_model
+    session = K.get_session()
+
+    # Save the config and the names of the tensors in the graph
+    info = {
+        "config": config_to_dict(config),
+        "inputs": [t.name for t in inference_model.inputs],
+        "outputs": [t.name for t in inference_model.outputs],
+        "learning_phase": None,
+    }
+    if inference_model.uses_learning_phase and not isinstance(K.learning_phase(), int):
+        info["learning_phase"] = K.learning_phase().name
+    with session.graph.as_default():
+        tf.constant(json.dumps(info), name=EXPORT_INFO_NODE)
+
+    inputs = [_node_name(t) for t in inference_model.inputs]
+    outputs = [_node_name(t) for t in inference_model.outputs] + [EXPORT_INFO_NODE]
+    # Not followed by tf.graph_util.remove_training_nodes(), which removes
+    # the Identity nodes of the while loops too.
+    graph_def = tf.graph_util.convert_variables_to_constants(
+        session, session.graph.as_graph_def(), outputs)
+    if optimize:
+        graph_def = optimize_graph(graph_def, inputs, outputs)
+
+    with tf.gfile.GFile(path, "wb") as f:
+        f.write(graph_def.SerializeToString())
+    logger.info("Exported frozen inference graph to %s (%d nodes)", path, len(graph_def.node))
+    return graph_def
+
+
+############################################################
+#  Loader
+############################################################
+
+class FrozenGraphRunner(object):
+    """Runs a frozen graph with the predict() interface of the Keras models
+    that MaskRCNN.predict_by_shape() uses."""
+
+    def __init__(self, session, inputs, outputs, feed=None):
+        self.session = session
+        self.inputs = inputs
+        self.outputs = outputs
+        self.feed = feed or {}
+
+    def predict(self, x, verbose=0):
+        feed = dict(zip(self.inputs, x))
+        feed.update(self.feed)
+        return self.session.run(self.outputs, feed)
+
+
+class FrozenMaskRCNN(modellib.MaskRCNN):
+    """Mask R-CNN inference model loaded from a file of export_frozen().
+    Has the detect(), detect_many(), detect_iter() and detect_molded()
+    methods of MaskRCNN, in its own graph and session.
+
+    path: The frozen graph file.
+    session_config: Optional. tf.ConfigProto of the session, for example
+        to set the number of threads.
+    """
+
+    def __init__(self, path, session_config=None):
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(path, "rb") as f:
+            graph_def.ParseFromString(f.read())
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        self.session = tf.Session(graph=self.graph, config=session_config)
+
+        info = self.session.run(self.graph.get_tensor_by_name(EXPORT_INFO_NODE + ":0"))
+        info = json.loads(info.decode() if isinstance(info, bytes) else info)
+        self.mode = "inference"
+        self.config = config_from_dict(info["config"])
+        self.model_dir = None
+        self.keras_model = None
+        feed = {}
+        if info["learning_phase"]:
+            feed[self.graph.get_tensor_by_name(info["learning_phase"])] = 0
+        self.inference_model = FrozenGraphRunner(
+            self.session,
+            [self.graph.get_tensor_by_name(n) for n in info["inputs"]],
+            [self.graph.get_tensor_by_name(n) for n in info["outputs"]],
+            feed)
+        logger.info("Loaded frozen inference graph %s", path)
+
+    def close(self):
+        """Releases the session."""
+        self.session.close()
@@ -8,13 +8,18 @@ Written by Waleed Abdulla
 """
 
 import os
-import random
 import datetime
 import re
 import math
 import logging
-from collections import OrderedDict
+import csv
+import json
+import hashlib
+import itertools
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 import multiprocessing
+import threading
 import numpy as np
 import tensorflow as tf
 import keras
@@ -24,6 +29,9 @@ import keras.engine as KE
 import keras.models as KM
 
 from mrcnn import utils
+from mrcnn import timing
+from mrcnn.augment import DihedralAugmentation
+from mrcnn.quarantine import Quarantine, sample_key
 
 # Requires TensorFlow 1.3+ and Keras 2.0.8+.
 from distutils.version import LooseVersion
@@ -85,6 +93,125 @@ def compute_backbone_shapes(config, image_shape):
             for stride in config.BACKBONE_STRIDES])
 
 
+def anchor_fingerprint(config, image_shape):
+    """Returns a hash of the settings that define the anchors of an image
+    shape: scales, ratios, strides and the backbone feature map shapes."""
+    settings = {
+        # Bump when generate_pyramid_anchors() changes
+        "version": 1,
+        "scales": [float(s) for s in config.RPN_ANCHOR_SCALES],
+        "ratios": [float(r) for r in config.RPN_ANCHOR_RATIOS],
+        "strides": [int(s) for s in config.BACKBONE_STRIDES],
+        "anchor_stride": int(config.RPN_ANCHOR_STRIDE),
+        "image_shape": [int(d) for d in image_shape[:2]],
+        "backbone_shapes": compute_backbone_shapes(config, image_shape).tolist(),
+    }
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def anchor_count(config, image_shape):
+    """Returns the number of anchors of an image shape, as generated by
+    utils.generate_pyramid_anchors()."""
+    backbone_shapes = compute_backbone_shapes(config, image_shape)
+    stride = config.RPN_ANCHOR_STRIDE
+    return len(config.RPN_ANCHOR_RATIOS) * int(sum(
+        math.ceil(h / stride) * math.ceil(w / stride) for h, w in backbone_shapes))
+
+
+# Anchors already generated or loaded by this process, by fingerprint and
+# normalization
+_anchor_arrays = {}
+
+
+def pyramid_anchors(config, image_shape, normalized=False):
+    """Returns the anchors of an image of the given shape.
+    [anchor_count, (y1, x1, y2, x2)] in pixels, or in normalized coordinates
+    if normalized is True.
+
+    The anchors are generated once per process, and once for all processes
+    if config.ANCHOR_CACHE_DIR is set: they're saved there and memory-mapped.
+    Cached files without the expected shape and dtype are regenerated. The
+    arrays are read-only.
+    """
+    fingerprint = anchor_fingerprint(config, image_shape)
+    key = (fingerprint, normalized)
+    if key in _anchor_arrays:
+        return _anchor_arrays[key]
+
+    path = None
+    if config.ANCHOR_CACHE_DIR:
+        path = os.path.join(config.ANCHOR_CACHE_DIR, "anchors_{}{}.npy".format(
+            fingerprint, "_norm" if normalized else ""))
+    anchors = None
+    if path and os.path.exists(path):
+        try:
+            anchors = np.asarray(np.load(path, mmap_mode="r"))
+        except (IOError, ValueError) as e:
+            logging.warning("Failed to load cached anchors %s: %s", path, e)
+        # Regenerate the anchors of a file that doesn't hold the expected
+        # array, written by another version or modified.
+        expected = (anchor_count(config, image_shape), 4)
+        dtype = np.float32 if normalized else np.float64
+        if anchors is not None and (anchors.shape != expected or anchors.dtype != dtype):
+            logging.warning("Cached anchors %s are %s %s, expected %s %s. Regenerating them.",
+                            path, anchors.dtype, anchors.shape, dtype.__name__, expected)
+            anchors = None
+    if anchors is None:
+        if normalized:
+            anchors = utils.norm_boxes(pyramid_anchors(config, image_shape), image_shape[:2])
+        else:
+            backbone_shapes = compute_backbone_shapes(config, image_shape)
+            anchors = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
+                                                     config.RPN_ANCHOR_RATIOS,
+                                                     backbone_shapes,
+                                                     config.BACKBONE_STRIDES,
+                                                     config.RPN_ANCHOR_STRIDE)
+        if path:
+            try:
+                anchors = _save_anchors(path, anchors)
+            except (IOError, OSError) as e:
+                logging.warning("Failed to cache anchors in %s: %s", path, e)
+    anchors.flags.writeable = False
+    _anchor_arrays[key] = anchors
+    return anchors
+
+
+def _save_anchors(path, anchors):
+    """Saves anchors to path atomically, so concurrent processes never read a
+    partial file, and returns them memory-mapped from it. The directory is
+    created private to the user."""
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        with open(tmp_path, "wb") as f:
+            np.save(f, anchors)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return np.asarray(np.load(path, mmap_mode="r"))
+
+
+def variable_image_shapes(config):
+    """Returns True if the resizing mode of the config gives images of
+    different sizes ("pad64" and "none"). Images are then batched by shape,
+    and the anchors of each batch are an input of the training model.
+    """
+    return config.IMAGE_RESIZE_MODE in ["pad64", "none"]
+
+
+def anchors_in_graph(config, mode):
+    """Returns True if the anchors of the IMAGE_SHAPE of the config are a
+    constant of the graph instead of an input of the model. That's the case
+    of the training models with images of a fixed shape, and of the
+    inference models with INFERENCE_ANCHORS_IN_GRAPH, which then only run
+    on images of IMAGE_SHAPE.
+    """
+    if variable_image_shapes(config):
+        return False
+    return mode == "training" or config.INFERENCE_ANCHORS_IN_GRAPH
+
+
 ############################################################
 #  Resnet Graph
 ############################################################
@@ -1007,6 +1134,28 @@ def build_fpn_mask_graph(rois, feature_maps, image_meta,
     return x
 
 
+def gather_class_masks_graph(mrcnn_mask, detections, dtype="float32"):
+    """Picks the mask of the detected class of each detection, so only one
+    channel of the mask head leaves the graph.
+
+    mrcnn_mask: [batch, num_detections, height, width, num_classes] masks.
+    detections: [batch, num_detections, (y1, x1, y2, x2, class_id, score)]
+    dtype: "float32", "float16", or "uint8" for the mask probabilities
+        scaled to [0, 255] and rounded.
+
+    Returns: Masks [batch, num_detections, height, width] of the dtype.
+    """
+    shape = tf.shape(mrcnn_mask)
+    batch_ix = tf.tile(tf.expand_dims(tf.range(shape[0]), 1), [1, shape[1]])
+    detection_ix = tf.tile(tf.expand_dims(tf.range(shape[1]), 0), [shape[0], 1])
+    class_ids = tf.cast(detections[:, :, 4], tf.int32)
+    masks = tf.transpose(mrcnn_mask, [0, 1, 4, 2, 3])
+    masks = tf.gather_nd(masks, tf.stack([batch_ix, detection_ix, class_ids], axis=2))
+    if dtype == "uint8":
+        return tf.cast(tf.round(masks * 255), tf.uint8)
+    return tf.cast(masks, dtype)
+
+
 ############################################################
 #  Loss Functions
 ############################################################
@@ -1185,20 +1334,34 @@ def mrcnn_mask_loss_graph(target_masks, target_class_ids, pred_masks):
 #  Data Generator
 ############################################################
 
+def seed_imgaug(augmenter, seed):
+    """Seeds an imgaug augmenter and its children, deterministic ones
+    included, so that what they draw only depends on the seed."""
+    if hasattr(augmenter, "seed_"):
+        # imgaug >= 0.4
+        augmenter.seed_(seed, deterministic_too=True)
+    else:
+        augmenter.reseed(seed, deterministic_too=True)
+
+
 def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
-                  use_mini_mask=False):
+                  use_mini_mask=False, rng=None):
     """Load and return ground truth data for an image (image, mask, bounding boxes).
 
     augment: (deprecated. Use augmentation instead). If true, apply random
         image augmentation. Currently, only horizontal flipping is offered.
     augmentation: Optional. An imgaug (https://github.com/aleju/imgaug) augmentation.
         For example, passing imgaug.augmenters.Fliplr(0.5) flips images
-        right/left 50% of the time.
+        right/left 50% of the time. Or a DihedralAugmentation (mrcnn.augment) to
+        flip and rotate images by 90 degrees without imgaug.
     use_mini_mask: If False, returns full-size masks that are the same height
         and width as the original image. These can be big, for example
         1024x1024x100 (for 100 instances). Mini masks are smaller, typically,
         224x224 and are generated by extracting the bounding box of the
         object and resizing it to MINI_MASK_SHAPE.
+    rng: Optional. np.random.RandomState of the augmentations. imgaug
+        augmentations are seeded from it too. Defaults to the global NumPy
+        random generator, and to the imgaug one for imgaug.
 
     Returns:
     image: [height, width, 3]
@@ -1209,66 +1372,93 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
         of the image unless use_mini_mask is True, in which case they are
         defined in MINI_MASK_SHAPE.
     """
+    # Per-stage timing (a no-op unless timing is on, see timing.py)
+    timer = timing.get_timer()
+
     # Load image and mask
-    image = dataset.load_image(image_id)
-    mask, class_ids = dataset.load_mask(image_id)
+    with timer.stage("load_image") as stage:
+        image = dataset.load_image(image_id)
+        stage.add(image)
+    with timer.stage("load_mask") as stage:
+        mask, class_ids = dataset.load_mask(image_id)
+        stage.add(mask)
     original_shape = image.shape
-    image, window, scale, padding, crop = utils.resize_image(
-        image,
-        min_dim=config.IMAGE_MIN_DIM,
-        min_scale=config.IMAGE_MIN_SCALE,
-        max_dim=config.IMAGE_MAX_DIM,
-        mode=config.IMAGE_RESIZE_MODE)
-    mask = utils.resize_mask(mask, scale, padding, crop)
+    with timer.stage("resize_image") as stage:
+        image, window, scale, padding, crop = utils.resize_image(
+            image,
+            min_dim=config.IMAGE_MIN_DIM,
+            min_scale=config.IMAGE_MIN_SCALE,
+            max_dim=config.IMAGE_MAX_DIM,
+            mode=config.IMAGE_RESIZE_MODE)
+        # Pad to a multiple of 64, as the network needs
+        if config.IMAGE_RESIZE_MODE == "none":
+            image, padding = utils.pad_to_multiple(image, 64)
+        stage.add(image)
+    with timer.stage("resize_mask") as stage:
+        mask = utils.resize_mask(mask, scale, padding, crop)
+        stage.add(mask)
 
     # Random horizontal flips.
     # TODO: will be removed in a future update in favor of augmentation
     if augment:
         logging.warning("'augment' is deprecated. Use 'augmentation' instead.")
-        if random.randint(0, 1):
+        if (rng or np.random).randint(0, 2):
             image = np.fliplr(image)
             mask = np.fliplr(mask)
 
+    # Flips and 90 degree rotations, as views of the image and masks.
+    # Augmenters chained to it, if any, go through imgaug below.
+    if isinstance(augmentation, DihedralAugmentation):
+        with timer.stage("augmentation"):
+            image, mask, _ = augmentation.augment(image, mask, rng=rng)
+        augmentation = augmentation.imgaug_augmentation
+
     # Augmentation
     # This requires the imgaug lib (https://github.com/aleju/imgaug)
     if augmentation:
-        import imgaug
-
-        # Augmenters that are safe to apply to masks
-        # Some, such as Affine, have settings that make them unsafe, so always
-        # test your augmentation on masks
-        MASK_AUGMENTERS = ["Sequential", "SomeOf", "OneOf", "Sometimes",
-                           "Fliplr", "Flipud", "CropAndPad",
-                           "Affine", "PiecewiseAffine"]
-
-        def hook(images, augmenter, parents, default):
-            """Determines which augmenters to apply to masks."""
-            return augmenter.__class__.__name__ in MASK_AUGMENTERS
-
-        # Store shapes before augmentation to compare
-        image_shape = image.shape
-        mask_shape = mask.shape
-        # Make augmenters deterministic to apply similarly to images and masks
-        det = augmentation.to_deterministic()
-        image = det.augment_image(image)
-        # Change mask to np.uint8 because imgaug doesn't support np.bool
-        mask = det.augment_image(mask.astype(np.uint8),
-                                 hooks=imgaug.HooksImages(activator=hook))
-        # Verify that shapes didn't change
-        assert image.shape == image_shape, "Augmentation shouldn't change image size"
-        assert mask.shape == mask_shape, "Augmentation shouldn't change mask size"
-        # Change mask back to bool
-        mask = mask.astype(np.bool)
+        with timer.stage("imgaug") as stage:
+            import imgaug
+
+            # Augmenters that are safe to apply to masks
+            # Some, such as Affine, have settings that make them unsafe, so always
+            # test your augmentation on masks
+            MASK_AUGMENTERS = ["Sequential", "SomeOf", "OneOf", "Sometimes",
+                               "Fliplr", "Flipud", "CropAndPad",
+                               "Affine", "PiecewiseAffine"]
+
+            def hook(images, augmenter, parents, default):
+                """Determines which augmenters to apply to masks."""
+                return augmenter.__class__.__name__ in MASK_AUGMENTERS
+
+            # Store shapes before augmentation to compare
+            image_shape = image.shape
+            mask_shape = mask.shape
+            # Make augmenters deterministic to apply similarly to images and masks
+            det = augmentation.to_deterministic()
+            if rng is not None:
+                seed_imgaug(det, rng.randint(0, 2**31 - 1))
+            image = det.augment_image(image)
+            # Change mask to np.uint8 because imgaug doesn't support np.bool
+            mask = det.augment_image(mask.astype(np.uint8),
+                                     hooks=imgaug.HooksImages(activator=hook))
+            # Verify that shapes didn't change
+            assert image.shape == image_shape, "Augmentation shouldn't change image size"
+            assert mask.shape == mask_shape, "Augmentation shouldn't change mask size"
+            # Change mask back to bool
+            mask = mask.astype(np.bool)
+            stage.add(image, mask)
 
     # Note that some boxes might be all zeros if the corresponding mask got cropped out.
     # and here is to filter them out
-    _idx = np.sum(mask, axis=(0, 1)) > 0
-    mask = mask[:, :, _idx]
-    class_ids = class_ids[_idx]
-    # Bounding boxes. Note that some boxes might be all zeros
-    # if the corresponding mask got cropped out.
-    # bbox: [num_instances, (y1, x1, y2, x2)]
-    bbox = utils.extract_bboxes(mask)
+    with timer.stage("extract_bboxes") as stage:
+        _idx = np.sum(mask, axis=(0, 1)) > 0
+        mask = mask[:, :, _idx]
+        class_ids = class_ids[_idx]
+        # Bounding boxes. Note that some boxes might be all zeros
+        # if the corresponding mask got cropped out.
+        # bbox: [num_instances, (y1, x1, y2, x2)]
+        bbox = utils.extract_bboxes(mask)
+        stage.add(mask, bbox)
 
     # Active classes
     # Different datasets have different classes, so track the
@@ -1279,7 +1469,9 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
 
     # Resize masks to smaller size to reduce memory usage
     if use_mini_mask:
-        mask = utils.minimize_mask(bbox, mask, config.MINI_MASK_SHAPE)
+        with timer.stage("minimize_mask") as stage:
+            mask = utils.minimize_mask(bbox, mask, config.MINI_MASK_SHAPE)
+            stage.add(mask)
 
     # Image meta data
     image_meta = compose_image_meta(image_id, original_shape, image.shape,
@@ -1288,7 +1480,8 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
     return image, image_meta, class_ids, bbox, mask
 
 
-def build_detection_targets(rpn_rois, gt_class_ids, gt_boxes, gt_masks, config):
+def build_detection_targets(rpn_rois, gt_class_ids, gt_boxes, gt_masks, config,
+                            rng=None):
     """Generate targets for training Stage 2 classifier and mask heads.
     This is not used in normal training. It's useful for debugging or to train
     the Mask RCNN heads without using the RPN head.
@@ -1307,7 +1500,11 @@ def build_detection_targets(rpn_rois, gt_class_ids, gt_boxes, gt_masks, config):
             bbox refinements.
     masks: [TRAIN_ROIS_PER_IMAGE, height, width, NUM_CLASSES). Class specific masks cropped
            to bbox boundaries and resized to neural network output size.
+
+    rng: Optional. np.random.RandomState of the ROI sampling. Defaults to
+        the global NumPy random generator.
     """
+    rng = rng or np.random
     assert rpn_rois.shape[0] > 0
     assert gt_class_ids.dtype == np.int32, "Expected int but got {}".format(
         gt_class_ids.dtype)
@@ -1326,18 +1523,8 @@ def build_detection_targets(rpn_rois, gt_class_ids, gt_boxes, gt_masks, config):
     gt_boxes = gt_boxes[instance_ids]
     gt_masks = gt_masks[:, :, instance_ids]
 
-    # Compute areas of ROIs and ground truth boxes.
-    rpn_roi_area = (rpn_rois[:, 2] - rpn_rois[:, 0]) * \
-        (rpn_rois[:, 3] - rpn_rois[:, 1])
-    gt_box_area = (gt_boxes[:, 2] - gt_boxes[:, 0]) * \
-        (gt_boxes[:, 3] - gt_boxes[:, 1])
-
     # Compute overlaps [rpn_rois, gt_boxes]
-    overlaps = np.zeros((rpn_rois.shape[0], gt_boxes.shape[0]))
-    for i in range(overlaps.shape[1]):
-        gt = gt_boxes[i]
-        overlaps[:, i] = utils.compute_iou(
-            gt, rpn_rois, gt_box_area[i], rpn_roi_area)
+    overlaps = utils.compute_overlaps(rpn_rois, gt_boxes)
 
     # Assign ROIs to GT boxes
     rpn_roi_iou_argmax = np.argmax(overlaps, axis=1)
@@ -1359,13 +1546,13 @@ def build_detection_targets(rpn_rois, gt_class_ids, gt_boxes, gt_masks, config):
     # FG
     fg_roi_count = int(config.TRAIN_ROIS_PER_IMAGE * config.ROI_POSITIVE_RATIO)
     if fg_ids.shape[0] > fg_roi_count:
-        keep_fg_ids = np.random.choice(fg_ids, fg_roi_count, replace=False)
+        keep_fg_ids = rng.choice(fg_ids, fg_roi_count, replace=False)
     else:
         keep_fg_ids = fg_ids
     # BG
     remaining = config.TRAIN_ROIS_PER_IMAGE - keep_fg_ids.shape[0]
     if bg_ids.shape[0] > remaining:
-        keep_bg_ids = np.random.choice(bg_ids, remaining, replace=False)
+        keep_bg_ids = rng.choice(bg_ids, remaining, replace=False)
     else:
         keep_bg_ids = bg_ids
     # Combine indices of ROIs to keep
@@ -1382,12 +1569,12 @@ def build_detection_targets(rpn_rois, gt_class_ids, gt_boxes, gt_masks, config):
             # Pick bg regions with easier IoU threshold
             bg_ids = np.where(rpn_roi_iou_max < 0.5)[0]
             assert bg_ids.shape[0] >= remaining
-            keep_bg_ids = np.random.choice(bg_ids, remaining, replace=False)
+            keep_bg_ids = rng.choice(bg_ids, remaining, replace=False)
             assert keep_bg_ids.shape[0] == remaining
             keep = np.concatenate([keep, keep_bg_ids])
         else:
             # Fill the rest with repeated bg rois.
-            keep_extra_ids = np.random.choice(
+            keep_extra_ids = rng.choice(
                 keep_bg_ids, remaining, replace=True)
             keep = np.concatenate([keep, keep_extra_ids])
     assert keep.shape[0] == config.TRAIN_ROIS_PER_IMAGE, \
@@ -1413,75 +1600,154 @@ def build_detection_targets(rpn_rois, gt_class_ids, gt_boxes, gt_masks, config):
     # Normalize bbox refinements
     bboxes /= config.BBOX_STD_DEV
 
-    # Generate class-specific target masks
+    # Generate class-specific target masks: crop the GT masks at the
+    # positive ROIs and resize them, all at once
     masks = np.zeros((config.TRAIN_ROIS_PER_IMAGE, config.MASK_SHAPE[0], config.MASK_SHAPE[1], config.NUM_CLASSES),
                      dtype=np.float32)
-    for i in pos_ids:
-        class_id = roi_gt_class_ids[i]
-        assert class_id > 0, "class id must be greater than 0"
-        gt_id = roi_gt_assignment[i]
-        class_mask = gt_masks[:, :, gt_id]
-
-        if config.USE_MINI_MASK:
-            # Create a mask placeholder, the size of the image
-            placeholder = np.zeros(config.IMAGE_SHAPE[:2], dtype=bool)
-            # GT box
-            gt_y1, gt_x1, gt_y2, gt_x2 = gt_boxes[gt_id]
-            gt_w = gt_x2 - gt_x1
-            gt_h = gt_y2 - gt_y1
-            # Resize mini mask to size of GT box
-            placeholder[gt_y1:gt_y2, gt_x1:gt_x2] = \
-                np.round(utils.resize(class_mask, (gt_h, gt_w))).astype(bool)
-            # Place the mini batch in the placeholder
-            class_mask = placeholder
-
-        # Pick part of the mask and resize it
-        y1, x1, y2, x2 = rois[i].astype(np.int32)
-        m = class_mask[y1:y2, x1:x2]
-        mask = utils.resize(m, config.MASK_SHAPE)
-        masks[i, :, :, class_id] = mask
+    if pos_ids.shape[0] > 0:
+        masks[pos_ids, :, :, roi_gt_class_ids[pos_ids]] = utils.crop_and_resize_masks(
+            gt_masks, roi_gt_assignment[pos_ids], rois[pos_ids], config.MASK_SHAPE,
+            mask_boxes=gt_boxes if config.USE_MINI_MASK else None)
 
     return rois, roi_gt_class_ids, bboxes, masks
 
 
-def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
+def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config,
+                      anchor_index=None, rng=None):
     """Given the anchors and GT boxes, compute overlaps and identify positive
     anchors and deltas to refine them to match their corresponding GT boxes.
 
     anchors: [num_anchors, (y1, x1, y2, x2)]
     gt_class_ids: [num_gt_boxes] Integer class IDs.
     gt_boxes: [num_gt_boxes, (y1, x1, y2, x2)]
+    anchor_index: Optional. A utils.AnchorGridIndex built on the anchors.
+        Only anchors close to a GT box are compared with it. Build it once
+        and pass it in to avoid re-indexing the anchors on every call.
+    rng: Optional. np.random.RandomState of the anchor sampling. Defaults to
+        the global NumPy random generator.
 
     Returns:
     rpn_match: [N] (int32) matches between anchors and GT boxes.
                1 = positive anchor, -1 = negative anchor, 0 = neutral
     rpn_bbox: [N, (dy, dx, log(dh), log(dw))] Anchor bbox deltas.
     """
-    # RPN Match: 1 = positive anchor, -1 = negative anchor, 0 = neutral
-    rpn_match = np.zeros([anchors.shape[0]], dtype=np.int32)
-    # RPN bounding boxes: [max anchors per image, (dy, dx, log(dh), log(dw))]
-    rpn_bbox = np.zeros((config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4))
+    if anchor_index is None:
+        anchor_index = utils.AnchorGridIndex(anchors)
+    match = match_rpn_anchors(anchors, gt_class_ids, gt_boxes, anchor_index)
+    # Filter out crowds from ground truth boxes
+    gt_boxes = gt_boxes[gt_class_ids >= 0]
+    return build_rpn_targets_from_match(anchors, match, gt_boxes, config, rng)
+
+
+def _best_overlaps(num_boxes, box_ids, other_ids, ious):
+    """Reduces sparse overlaps to the best match of each box.
+
+    Pairs are sorted by box, then by decreasing IoU, then by the index of
+    the other box, so ties resolve to the first one like np.argmax().
+
+    Returns:
+    iou_argmax: [num_boxes] Index of the best matching box (0 if none)
+    iou_max: [num_boxes] Best IoU (0 if none)
+    """
+    iou_argmax = np.zeros([num_boxes], dtype=np.int64)
+    iou_max = np.zeros([num_boxes])
+    order = np.lexsort((other_ids, -ious, box_ids))
+    best = order[np.unique(box_ids[order], return_index=True)[1]]
+    iou_argmax[box_ids[best]] = other_ids[best]
+    iou_max[box_ids[best]] = ious[best]
+    return iou_argmax, iou_max
+
+
+def _max_overlaps(num_boxes, box_ids, ious):
+    """Returns the best IoU of each box [num_boxes] from sparse overlaps."""
+    iou_max = np.zeros([num_boxes])
+    if box_ids.shape[0] > 0:
+        order = np.argsort(box_ids, kind="stable")
+        sorted_ids = box_ids[order]
+        starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+        iou_max[sorted_ids[starts]] = np.maximum.reduceat(ious[order], starts)
+    return iou_max
+
+
+def match_rpn_anchors(anchors, gt_class_ids, gt_boxes, anchor_index):
+    """Matches anchors with GT boxes. This is the deterministic part of
+    build_rpn_targets(), before positive and negative anchors are subsampled.
+    It only depends on the geometry of the GT boxes, so it can be cached.
+
+    anchors: [num_anchors, (y1, x1, y2, x2)]
+    gt_class_ids: [num_gt_boxes] Integer class IDs. Crowds are negative.
+    gt_boxes: [num_gt_boxes, (y1, x1, y2, x2)]
+    anchor_index: A utils.AnchorGridIndex built on the anchors.
+
+    Returns a dict describing the match compactly. GT indices refer to the
+    non-crowd GT boxes:
+    iou_ids: Anchors with IoU >= 0.3 with a GT box, so never negative.
+    iou_max, iou_argmax: Best IoU and best GT box of each anchor in iou_ids.
+    best_ids, best_gt_ids: (anchor, GT box) pairs where the anchor is the
+        closest one to the GT box. These anchors are always positive.
+    best_argmax: Best GT box of each anchor in best_ids.
+    gt_iou_max: [num_gt_boxes] Best IoU of each GT box.
+    crowd_ids: Anchors that overlap crowd boxes. They're never negative.
+    all_positive: True if a GT box doesn't intersect any anchor. It then ties
+        with all of them and every anchor is a positive candidate.
+    """
+    num_anchors = anchors.shape[0]
 
     # Handle COCO crowds
     # A crowd box in COCO is a bounding box around several instances. Exclude
     # them from training. A crowd box is given a negative class ID.
     crowd_ix = np.where(gt_class_ids < 0)[0]
+    crowd_ids = np.zeros([0], dtype=np.int64)
     if crowd_ix.shape[0] > 0:
         # Filter out crowds from ground truth class IDs and boxes
         non_crowd_ix = np.where(gt_class_ids > 0)[0]
         crowd_boxes = gt_boxes[crowd_ix]
         gt_class_ids = gt_class_ids[non_crowd_ix]
         gt_boxes = gt_boxes[non_crowd_ix]
-        # Compute overlaps with crowd boxes [anchors, crowds]
-        crowd_overlaps = utils.compute_overlaps(anchors, crowd_boxes)
-        crowd_iou_max = np.amax(crowd_overlaps, axis=1)
-        no_crowd_bool = (crowd_iou_max < 0.001)
-    else:
-        # All anchors don't intersect a crowd
-        no_crowd_bool = np.ones([anchors.shape[0]], dtype=bool)
+        # Anchors that overlap a crowd box
+        crowd_anchor_ids, _, crowd_ious = anchor_index.overlaps(crowd_boxes)
+        crowd_ids = np.unique(crowd_anchor_ids[crowd_ious >= 0.001])
+
+    # Compute overlaps as a sparse list of (anchor, gt box, IoU) triplets.
+    # Anchors that are not listed don't intersect any GT box.
+    anchor_ids, gt_ids, ious = anchor_index.overlaps(gt_boxes)
+    anchor_iou_argmax, anchor_iou_max = _best_overlaps(
+        num_anchors, anchor_ids, gt_ids, ious)
+    iou_ids = np.where(anchor_iou_max >= 0.3)[0]
+
+    # Closest anchors of each GT box (regardless of IoU value).
+    # If multiple anchors have the same IoU match all of them
+    gt_iou_max = _max_overlaps(gt_boxes.shape[0], gt_ids, ious)
+    is_best = ious == gt_iou_max[gt_ids]
+    best_ids = anchor_ids[is_best]
+
+    return {
+        "iou_ids": iou_ids,
+        "iou_max": anchor_iou_max[iou_ids],
+        "iou_argmax": anchor_iou_argmax[iou_ids],
+        "best_ids": best_ids,
+        "best_gt_ids": gt_ids[is_best],
+        "best_argmax": anchor_iou_argmax[best_ids],
+        "gt_iou_max": gt_iou_max,
+        "crowd_ids": crowd_ids,
+        "all_positive": bool(np.any(gt_iou_max == 0)),
+    }
+
 
-    # Compute overlaps [num_anchors, num_gt_boxes]
-    overlaps = utils.compute_overlaps(anchors, gt_boxes)
+def build_rpn_targets_from_match(anchors, match, gt_boxes, config, rng=None):
+    """Builds the RPN targets from an anchor match. See build_rpn_targets().
+
+    match: Anchor match returned by match_rpn_anchors().
+    gt_boxes: [num_gt_boxes, (y1, x1, y2, x2)] Non-crowd GT boxes.
+    rng: Optional. np.random.RandomState of the anchor sampling.
+
+    Returns rpn_match and rpn_bbox, like build_rpn_targets().
+    """
+    rng = rng or np.random
+    # RPN Match: 1 = positive anchor, -1 = negative anchor, 0 = neutral
+    rpn_match = np.zeros([anchors.shape[0]], dtype=np.int32)
+    # RPN bounding boxes: [max anchors per image, (dy, dx, log(dh), log(dw))]
+    rpn_bbox = np.zeros((config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4))
 
     # Match anchors to GT Boxes
     # If an anchor overlaps a GT box with IoU >= 0.7 then it's positive.
@@ -1493,15 +1759,15 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
     #
     # 1. Set negative anchors first. They get overwritten below if a GT box is
     # matched to them. Skip boxes in crowd areas.
-    anchor_iou_argmax = np.argmax(overlaps, axis=1)
-    anchor_iou_max = overlaps[np.arange(overlaps.shape[0]), anchor_iou_argmax]
-    rpn_match[(anchor_iou_max < 0.3) & (no_crowd_bool)] = -1
+    rpn_match[:] = -1
+    rpn_match[match["iou_ids"]] = 0
+    rpn_match[match["crowd_ids"]] = 0
     # 2. Set an anchor for each GT box (regardless of IoU value).
-    # If multiple anchors have the same IoU match all of them
-    gt_iou_argmax = np.argwhere(overlaps == np.max(overlaps, axis=0))[:,0]
-    rpn_match[gt_iou_argmax] = 1
+    if match["all_positive"]:
+        rpn_match[:] = 1
+    rpn_match[match["best_ids"]] = 1
     # 3. Set anchors with high overlap as positive.
-    rpn_match[anchor_iou_max >= 0.7] = 1
+    rpn_match[match["iou_ids"][match["iou_max"] >= 0.7]] = 1
 
     # Subsample to balance positive and negative anchors
     # Don't let positives be more than half the anchors
@@ -1509,7 +1775,7 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
     extra = len(ids) - (config.RPN_TRAIN_ANCHORS_PER_IMAGE // 2)
     if extra > 0:
         # Reset the extra ones to neutral
-        ids = np.random.choice(ids, extra, replace=False)
+        ids = rng.choice(ids, extra, replace=False)
         rpn_match[ids] = 0
     # Same for negative proposals
     ids = np.where(rpn_match == -1)[0]
@@ -1517,45 +1783,196 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
                         np.sum(rpn_match == 1))
     if extra > 0:
         # Rest the extra ones to neutral
-        ids = np.random.choice(ids, extra, replace=False)
+        ids = rng.choice(ids, extra, replace=False)
         rpn_match[ids] = 0
 
     # For positive anchors, compute shift and scale needed to transform them
-    # to match the corresponding GT boxes.
+    # to match the corresponding GT boxes (closest GT box, it might have
+    # IoU < 0.7).
+    anchor_iou_argmax = np.zeros([anchors.shape[0]], dtype=np.int64)
+    anchor_iou_argmax[match["iou_ids"]] = match["iou_argmax"]
+    anchor_iou_argmax[match["best_ids"]] = match["best_argmax"]
     ids = np.where(rpn_match == 1)[0]
-    ix = 0  # index into rpn_bbox
-    # TODO: use box_refinement() rather than duplicating the code here
-    for i, a in zip(ids, anchors[ids]):
-        # Closest gt box (it might have IoU < 0.7)
-        gt = gt_boxes[anchor_iou_argmax[i]]
-
-        # Convert coordinates to center plus width/height.
-        # GT Box
-        gt_h = gt[2] - gt[0]
-        gt_w = gt[3] - gt[1]
-        gt_center_y = gt[0] + 0.5 * gt_h
-        gt_center_x = gt[1] + 0.5 * gt_w
-        # Anchor
-        a_h = a[2] - a[0]
-        a_w = a[3] - a[1]
-        a_center_y = a[0] + 0.5 * a_h
-        a_center_x = a[1] + 0.5 * a_w
-
-        # Compute the bbox refinement that the RPN should predict.
-        rpn_bbox[ix] = [
-            (gt_center_y - a_center_y) / a_h,
-            (gt_center_x - a_center_x) / a_w,
-            np.log(gt_h / a_h),
-            np.log(gt_w / a_w),
-        ]
-        # Normalize
-        rpn_bbox[ix] /= config.RPN_BBOX_STD_DEV
-        ix += 1
+    rpn_bbox[:ids.shape[0]] = utils.box_refinement(
+        anchors[ids], gt_boxes[anchor_iou_argmax[ids]])
+    # Normalize
+    rpn_bbox /= config.RPN_BBOX_STD_DEV
 
     return rpn_match, rpn_bbox
 
 
-def generate_random_rois(image_shape, count, gt_class_ids, gt_boxes):
+def remap_rpn_match(match, permutation, anchor_index, gt_boxes):
+    """Maps an anchor match through a dihedral transform of the image,
+    without recomputing the overlaps. See utils.dihedral_boxes().
+
+    IoU doesn't change when the image is flipped or rotated, so the anchor
+    match of the transformed image is a permutation of the original one.
+    Only the anchors that have no counterpart in the original image (the
+    ones centered on the image border) are compared with the GT boxes.
+
+    match: Anchor match of the original image. See match_rpn_anchors().
+    permutation: [num_anchors] Index of the transformed anchor of each
+        anchor, or -1. See AnchorGridIndex.dihedral_permutation().
+    anchor_index: utils.AnchorGridIndex of the anchors.
+    gt_boxes: [num_gt_boxes, (y1, x1, y2, x2)] Transformed GT boxes.
+
+    Returns the anchor match of the transformed image, or None if it can't
+    be derived and must be computed with match_rpn_anchors().
+    """
+    if match["all_positive"] or match["crowd_ids"].shape[0] > 0:
+        return None
+
+    iou_ids = permutation[match["iou_ids"]]
+    keep = iou_ids >= 0
+    iou_ids = iou_ids[keep]
+    iou_max = match["iou_max"][keep]
+    iou_argmax = match["iou_argmax"][keep]
+    best_ids = permutation[match["best_ids"]]
+    keep = best_ids >= 0
+    best_ids = best_ids[keep]
+    best_gt_ids = match["best_gt_ids"][keep]
+    best_argmax = match["best_argmax"][keep]
+    gt_iou_max = match["gt_iou_max"].copy()
+
+    # Anchors that don't come from any anchor of the original image
+    uncovered = np.ones([permutation.shape[0]], dtype=bool)
+    uncovered[permutation[permutation >= 0]] = False
+    anchor_ids, gt_ids, ious = anchor_index.overlaps(gt_boxes, anchor_mask=uncovered)
+    if anchor_ids.shape[0] > 0:
+        new_argmax, new_max = _best_overlaps(
+            permutation.shape[0], anchor_ids, gt_ids, ious)
+        new_ids = np.where(new_max >= 0.3)[0]
+        iou_ids = np.concatenate([iou_ids, new_ids])
+        iou_max = np.concatenate([iou_max, new_max[new_ids]])
+        iou_argmax = np.concatenate([iou_argmax, new_argmax[new_ids]])
+        # Closest anchors of GT boxes might change
+        new_gt_iou_max = _max_overlaps(gt_iou_max.shape[0], gt_ids, ious)
+        replaced = new_gt_iou_max > gt_iou_max
+        keep = ~replaced[best_gt_ids]
+        best_ids = best_ids[keep]
+        best_gt_ids = best_gt_ids[keep]
+        best_argmax = best_argmax[keep]
+        gt_iou_max = np.maximum(gt_iou_max, new_gt_iou_max)
+        is_best = ious == gt_iou_max[gt_ids]
+        best_ids = np.concatenate([best_ids, anchor_ids[is_best]])
+        best_gt_ids = np.concatenate([best_gt_ids, gt_ids[is_best]])
+        best_argmax = np.concatenate([best_argmax, new_argmax[anchor_ids[is_best]]])
+
+    # GT boxes whose closest anchors all fell off the anchor lattice. Compare
+    # them with all the anchors to find their new closest anchors.
+    lost = np.ones([gt_boxes.shape[0]], dtype=bool)
+    lost[best_gt_ids] = False
+    lost = np.where(lost)[0]
+    if lost.shape[0] > 0:
+        anchor_ids, gt_ids, ious = anchor_index.overlaps(gt_boxes[lost])
+        gt_iou_max[lost] = _max_overlaps(lost.shape[0], gt_ids, ious)
+        if np.any(gt_iou_max[lost] == 0):
+            return None
+        is_best = ious == gt_iou_max[lost][gt_ids]
+        lost_ids = anchor_ids[is_best]
+        lost_gt_ids = lost[gt_ids[is_best]]
+        # Best GT box of the new closest anchors, among all GT boxes
+        anchor_mask = np.zeros([permutation.shape[0]], dtype=bool)
+        anchor_mask[lost_ids] = True
+        anchor_ids, gt_ids, ious = anchor_index.overlaps(gt_boxes, anchor_mask=anchor_mask)
+        lost_argmax, _ = _best_overlaps(permutation.shape[0], anchor_ids, gt_ids, ious)
+        best_ids = np.concatenate([best_ids, lost_ids])
+        best_gt_ids = np.concatenate([best_gt_ids, lost_gt_ids])
+        best_argmax = np.concatenate([best_argmax, lost_argmax[lost_ids]])
+
+    return {
+        "iou_ids": iou_ids,
+        "iou_max": iou_max,
+        "iou_argmax": iou_argmax,
+        "best_ids": best_ids,
+        "best_gt_ids": best_gt_ids,
+        "best_argmax": best_argmax,
+        "gt_iou_max": gt_iou_max,
+        "crowd_ids": match["crowd_ids"],
+        "all_positive": False,
+    }
+
+
+class RPNTargetCache(object):
+    """Caches the anchor matches of images so that the RPN targets of an
+    image seen again, possibly flipped or rotated by 90 degrees, are built
+    without recomputing the overlaps. Only the random subsampling of
+    positive and negative anchors is redone on every call.
+
+    An image is recognized by its ID and its GT boxes: if a dihedral
+    transform of the cached GT boxes gives the current ones, the cached
+    match is remapped with that transform. Otherwise (e.g. random crops or
+    non geometric augmentations that change the masks) the match is computed
+    again and replaces the cached one. Matches are cached for a canonical
+    orientation of the boxes, see canonical_entry().
+    """
+
+    def __init__(self, anchors, anchor_index):
+        self.anchors = anchors
+        self.anchor_index = anchor_index
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def find_transform(self, entry, image_shape, gt_class_ids, gt_boxes):
+        """Returns the dihedral transform that maps the cached GT boxes of the
+        entry to the given ones, or None."""
+        cached_shape, cached_class_ids, cached_boxes = entry[:3]
+        if not np.array_equal(cached_class_ids, gt_class_ids):
+            return None
+        for transform in utils.DIHEDRAL_TRANSFORMS:
+            if utils.dihedral_shape(cached_shape, transform) != tuple(image_shape[:2]):
+                continue
+            boxes = utils.dihedral_boxes(cached_boxes, transform, cached_shape)
+            if np.array_equal(boxes, gt_boxes):
+                return transform
+        return None
+
+    def canonical_entry(self, image_shape, gt_class_ids, gt_boxes):
+        """Matches the anchors with the GT boxes in a canonical orientation:
+        the smallest of their dihedral transforms, compared in instance order.
+        It's the same whichever orientation is seen first, so the targets
+        don't depend on the order in which the images come."""
+        shape = tuple(image_shape[:2])
+        candidates = [utils.dihedral_boxes(gt_boxes, t, shape)
+                      for t in utils.DIHEDRAL_TRANSFORMS
+                      if utils.dihedral_shape(shape, t) == shape]
+        boxes = min(candidates, key=lambda b: b.ravel().tolist())
+        match = match_rpn_anchors(self.anchors, gt_class_ids, boxes, self.anchor_index)
+        return (shape, np.copy(gt_class_ids), boxes, match)
+
+    def match(self, image_id, image_shape, gt_class_ids, gt_boxes):
+        """Returns the anchor match of the given image and GT boxes. See
+        match_rpn_anchors()."""
+        entry = self.entries.get(image_id)
+        transform = None
+        if entry is not None:
+            transform = self.find_transform(entry, image_shape, gt_class_ids, gt_boxes)
+        if transform is None:
+            entry = self.canonical_entry(image_shape, gt_class_ids, gt_boxes)
+            self.entries[image_id] = entry
+            transform = self.find_transform(entry, image_shape, gt_class_ids, gt_boxes)
+        if transform == 0:
+            self.hits += 1
+            return entry[3]
+        permutation = self.anchor_index.dihedral_permutation(transform, entry[0])
+        match = remap_rpn_match(entry[3], permutation, self.anchor_index,
+                                gt_boxes[gt_class_ids >= 0])
+        if match is not None:
+            self.hits += 1
+            return match
+        self.misses += 1
+        return match_rpn_anchors(self.anchors, gt_class_ids, gt_boxes, self.anchor_index)
+
+    def build_rpn_targets(self, image_id, image_shape, gt_class_ids, gt_boxes, config,
+                          rng=None):
+        """Same as build_rpn_targets() but uses the cache."""
+        match = self.match(image_id, image_shape, gt_class_ids, gt_boxes)
+        return build_rpn_targets_from_match(self.anchors, match,
+                                            gt_boxes[gt_class_ids >= 0], config, rng)
+
+
+def generate_random_rois(image_shape, count, gt_class_ids, gt_boxes, rng=None):
     """Generates ROI proposals similar to what a region proposal network
     would generate.
 
@@ -1563,75 +1980,175 @@ def generate_random_rois(image_shape, count, gt_class_ids, gt_boxes):
     count: Number of ROIs to generate
     gt_class_ids: [N] Integer ground truth class IDs
     gt_boxes: [N, (y1, x1, y2, x2)] Ground truth boxes in pixels.
+    rng: Optional. np.random.RandomState to draw from. Defaults to the
+        global NumPy random generator.
 
     Returns: [count, (y1, x1, y2, x2)] ROI boxes in pixels.
     """
-    # placeholder
-    rois = np.zeros((count, 4), dtype=np.int32)
-
-    # Generate random ROIs around GT boxes (90% of count)
+    rng = rng or np.random
+    # Generate random ROIs around GT boxes (90% of count), within one box
+    # size of them
     rois_per_box = int(0.9 * count / gt_boxes.shape[0])
-    for i in range(gt_boxes.shape[0]):
-        gt_y1, gt_x1, gt_y2, gt_x2 = gt_boxes[i]
-        h = gt_y2 - gt_y1
-        w = gt_x2 - gt_x1
-        # random boundaries
-        r_y1 = max(gt_y1 - h, 0)
-        r_y2 = min(gt_y2 + h, image_shape[0])
-        r_x1 = max(gt_x1 - w, 0)
-        r_x2 = min(gt_x2 + w, image_shape[1])
-
-        # To avoid generating boxes with zero area, we generate double what
-        # we need and filter out the extra. If we get fewer valid boxes
-        # than we need, we loop and try again.
-        while True:
-            y1y2 = np.random.randint(r_y1, r_y2, (rois_per_box * 2, 2))
-            x1x2 = np.random.randint(r_x1, r_x2, (rois_per_box * 2, 2))
-            # Filter out zero area boxes
-            threshold = 1
-            y1y2 = y1y2[np.abs(y1y2[:, 0] - y1y2[:, 1]) >=
-                        threshold][:rois_per_box]
-            x1x2 = x1x2[np.abs(x1x2[:, 0] - x1x2[:, 1]) >=
-                        threshold][:rois_per_box]
-            if y1y2.shape[0] == rois_per_box and x1x2.shape[0] == rois_per_box:
-                break
-
-        # Sort on axis 1 to ensure x1 <= x2 and y1 <= y2 and then reshape
-        # into x1, y1, x2, y2 order
-        x1, x2 = np.split(np.sort(x1x2, axis=1), 2, axis=1)
-        y1, y2 = np.split(np.sort(y1y2, axis=1), 2, axis=1)
-        box_rois = np.hstack([y1, x1, y2, x2])
-        rois[rois_per_box * i:rois_per_box * (i + 1)] = box_rois
+    gt_y1, gt_x1, gt_y2, gt_x2 = np.repeat(gt_boxes, rois_per_box, axis=0).T
+    h = gt_y2 - gt_y1
+    w = gt_x2 - gt_x1
+    y1, y2 = _random_pairs(np.maximum(gt_y1 - h, 0), np.minimum(gt_y2 + h, image_shape[0]), rng)
+    x1, x2 = _random_pairs(np.maximum(gt_x1 - w, 0), np.minimum(gt_x2 + w, image_shape[1]), rng)
+    box_rois = np.stack([y1, x1, y2, x2], axis=1)
 
     # Generate random ROIs anywhere in the image (10% of count)
-    remaining_count = count - (rois_per_box * gt_boxes.shape[0])
-    # To avoid generating boxes with zero area, we generate double what
-    # we need and filter out the extra. If we get fewer valid boxes
-    # than we need, we loop and try again.
-    while True:
-        y1y2 = np.random.randint(0, image_shape[0], (remaining_count * 2, 2))
-        x1x2 = np.random.randint(0, image_shape[1], (remaining_count * 2, 2))
-        # Filter out zero area boxes
-        threshold = 1
-        y1y2 = y1y2[np.abs(y1y2[:, 0] - y1y2[:, 1]) >=
-                    threshold][:remaining_count]
-        x1x2 = x1x2[np.abs(x1x2[:, 0] - x1x2[:, 1]) >=
-                    threshold][:remaining_count]
-        if y1y2.shape[0] == remaining_count and x1x2.shape[0] == remaining_count:
-            break
-
-    # Sort on axis 1 to ensure x1 <= x2 and y1 <= y2 and then reshape
-    # into x1, y1, x2, y2 order
-    x1, x2 = np.split(np.sort(x1x2, axis=1), 2, axis=1)
-    y1, y2 = np.split(np.sort(y1y2, axis=1), 2, axis=1)
-    global_rois = np.hstack([y1, x1, y2, x2])
-    rois[-remaining_count:] = global_rois
-    return rois
+    remaining_count = count - box_rois.shape[0]
+    y1, y2 = _random_pairs(np.zeros([remaining_count], dtype=np.int64),
+                           np.full([remaining_count], image_shape[0]), rng)
+    x1, x2 = _random_pairs(np.zeros([remaining_count], dtype=np.int64),
+                           np.full([remaining_count], image_shape[1]), rng)
+    global_rois = np.stack([y1, x1, y2, x2], axis=1)
+    return np.concatenate([box_rois, global_rois]).astype(np.int32)
+
+
+def _random_pairs(low, high, rng):
+    """Draws two different random integers in [low, high) for each element
+    of low and high, without rejection sampling. The second one is drawn
+    among the other values of the range, so pairs are uniform over the
+    pairs of different values.
+
+    Returns the smallest and the largest values of the pairs.
+    """
+    n = high - low
+    a = np.floor(rng.random_sample(n.shape) * n).astype(np.int64)
+    b = np.floor(rng.random_sample(n.shape) * (n - 1)).astype(np.int64)
+    b += b >= a
+    return low + np.minimum(a, b), low + np.maximum(a, b)
+
+
+class DataGeneratorState(object):
+    """Position of data_generator() in its stream of batches.
+
+    The stream only depends on the seed: the images of each epoch are
+    shuffled, and the augmentations and targets of each sample are drawn,
+    with local random generators seeded from the seed and the position of
+    the sample. imgaug augmentations are seeded from them too. So the seed
+    and the index of a batch are enough to resume the stream.
+    MaskRCNN.train() saves them next to each checkpoint.
+
+    The generators claim batch indices, each the positions of BATCH_SIZE
+    samples in the stream. When the image shapes vary, the samples of a
+    batch index can be yielded in different batches, some of them later.
+    The state tracks the first batch index whose samples are not all
+    yielded yet, and records it at each yield, so that consumed() gives
+    the batch to resume from after the batches training has consumed.
+    Resuming from there loses no samples. It can repeat some, the ones of
+    the batch indices that were only partly yielded.
+
+    seed: Optional. Random seed. Picked at random if None.
+    batch: Index of the batch to start from.
+    """
+
+    # Batch indices that can be claimed ahead of the first one not yielded
+    # yet, and yields that can be generated ahead of training. The arrays
+    # that track them take 1 byte and 8 bytes per entry.
+    WINDOW = 2**20
+    YIELD_LOG_SIZE = 2**16
+
+    def __init__(self, seed=None, batch=0):
+        if seed is None:
+            seed = np.random.randint(0, 2**31 - 1)
+        self.seed = int(seed)
+        self.batch = int(batch)
+        self._shared = False
+        self._allocate()
+
+    def _allocate(self):
+        """Allocates the counters (next batch index, first batch index not
+        yielded, number of yields), the done flags of the batch indices and
+        the yield log. They're in shared memory after share()."""
+        if self._shared:
+            self._lock = multiprocessing.Lock()
+            self._counters = multiprocessing.Array("q", 3, lock=False)
+            self._done = multiprocessing.Array("b", self.WINDOW, lock=False)
+            self._log = multiprocessing.Array("q", self.YIELD_LOG_SIZE, lock=False)
+        else:
+            self._lock = threading.Lock()
+            self._counters = np.zeros([3], dtype=np.int64)
+            self._done = np.zeros([self.WINDOW], dtype=np.int8)
+            self._log = np.zeros([self.YIELD_LOG_SIZE], dtype=np.int64)
+        self._counters[0] = self.batch
+        self._counters[1] = self.batch
+
+    def share(self):
+        """Shares the batch counters with the processes forked afterwards,
+        such as the generator workers of fit_generator(). They then claim
+        different batches instead of each producing the whole stream. The
+        counters restart from the batch of the state."""
+        self._shared = True
+        self._allocate()
+
+    def next_batch(self):
+        """Claims the index of the next batch to generate."""
+        with self._lock:
+            batch = int(self._counters[0])
+            if batch >= self._counters[1] + self.WINDOW:
+                raise Exception("Batch {} is claimed too far ahead of batch {}, whose "
+                                "samples are not all yielded".format(batch, self._counters[1]))
+            self._counters[0] += 1
+        return batch
+
+    def batch_done(self, batch):
+        """Records that all the samples of a claimed batch index have been
+        yielded. Called once per batch index."""
+        with self._lock:
+            self._done[batch % self.WINDOW] = 1
+            first = int(self._counters[1])
+            while self._done[first % self.WINDOW]:
+                self._done[first % self.WINDOW] = 0
+                first += 1
+            self._counters[1] = first
+
+    def yielded(self):
+        """Records a yield of the generator, with the first batch index whose
+        samples are not all yielded at that point."""
+        with self._lock:
+            self._log[self._counters[2] % self.YIELD_LOG_SIZE] = self._counters[1]
+            self._counters[2] += 1
+
+    def consumed(self, count):
+        """Sets the batch of the state to resume the stream after the first
+        count yields since share() (or since the state was created). Yields
+        are counted in the order the generators recorded them.
+        """
+        if count <= 0:
+            return
+        with self._lock:
+            yields = int(self._counters[2])
+            assert yields - self.YIELD_LOG_SIZE < count <= yields, \
+                "Yield {} is not in the log of yields {} to {}".format(
+                    count, yields - self.YIELD_LOG_SIZE, yields)
+            self.batch = int(self._log[(count - 1) % self.YIELD_LOG_SIZE])
+
+    def to_dict(self):
+        return {"seed": self.seed, "batch": self.batch}
+
+    def save(self, path):
+        """Saves the state to a JSON file."""
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, path):
+        """Loads a state saved with save()."""
+        with open(path) as f:
+            return cls(**json.load(f))
+
+    @staticmethod
+    def checkpoint_path(weights_path):
+        """Returns the path of the state saved with the given weights file."""
+        return os.path.splitext(weights_path)[0] + "_data.json"
 
 
 def data_generator(dataset, config, shuffle=True, augment=False, augmentation=None,
                    random_rois=0, batch_size=1, detection_targets=False,
-                   no_augmentation_sources=None):
+                   no_augmentation_sources=None,
+                   state=None, quarantine=None):
     """A generator that returns images and corresponding target class ids,
     bounding box deltas, and masks.
 
@@ -1653,6 +2170,10 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
     no_augmentation_sources: Optional. List of sources to exclude for
         augmentation. A source is string that identifies a dataset and is
         defined in the Dataset class.
+    state: Optional. A DataGeneratorState to start from. It's updated as
+        batches are generated. By default a new one with a random seed.
+    quarantine: Optional. A Quarantine of failing samples. Samples in it are
+        skipped, and samples that raise an error are added to it.
 
     Returns a Python generator. Upon calling next() on it, the
     generator returns two lists, inputs and outputs. The contents
@@ -1667,154 +2188,365 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
     - gt_masks: [batch, height, width, MAX_GT_INSTANCES]. The height and width
                 are those of the image unless use_mini_mask is True, in which
                 case they are defined in MINI_MASK_SHAPE.
+    - anchors: [batch, N, (y1, x1, y2, x2)] Anchors in normalized coordinates.
+               Last, and only if variable_image_shapes(config).
+
+    Images of different shapes go to different batches, each batch is
+    yielded when it's full. At the end of each epoch, the batches of the
+    shapes that are only partly filled are completed by repeating their
+    images and yielded, so that the images of rare shapes are not held
+    back to later epochs. The state records which batch indices have all
+    their samples yielded, see DataGeneratorState.
 
     outputs list: Usually empty in regular training. But if detection_targets
         is True then the outputs list contains target class_ids, bbox deltas,
         and masks.
     """
-    b = 0  # batch item index
-    image_index = -1
+    b = 0  # batch item index, in the range of samples of the batch index
     image_ids = np.copy(dataset.image_ids)
     error_count = 0
+    state = state or DataGeneratorState()
+    batch_index = state.next_batch()
+    # Images skipped for the current batch item
+    retry = 0
+    # Images of the current epoch, in order
+    epoch_index = -1
+    epoch_ids = image_ids
     no_augmentation_sources = no_augmentation_sources or []
 
-    # Anchors
-    # [anchor_count, (y1, x1, y2, x2)]
-    backbone_shapes = compute_backbone_shapes(config, config.IMAGE_SHAPE)
-    anchors = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
-                                             config.RPN_ANCHOR_RATIOS,
-                                             backbone_shapes,
-                                             config.BACKBONE_STRIDES,
-                                             config.RPN_ANCHOR_STRIDE)
+    # Images are batched by shape: each shape has its own batch arrays,
+    # yielded when full, and its own anchors. There's only one unless the
+    # image sizes vary, see variable_image_shapes().
+    buckets = {}
+    # Batch indices of the samples of each bucket, and number of samples of
+    # each claimed batch index in the buckets
+    bucket_indices = {}
+    pending = {}
+    # Anchors of each shape [anchor_count, (y1, x1, y2, x2)], their spatial
+    # index to match GT boxes with nearby anchors only and RPN target cache
+    shape_anchors = {}
+
+    def bucket_batch(shape):
+        """Removes the bucket of a shape and returns its inputs and outputs.
+        A partly filled bucket is completed by repeating its images."""
+        batch = buckets.pop(shape)
+        count = batch.pop("count")
+        # Batch indices done with this bucket. The current one is done when
+        # all its samples are drawn too.
+        for index in bucket_indices.pop(shape):
+            pending[index] -= 1
+            if pending[index] == 0 and index != batch_index:
+                del pending[index]
+                state.batch_done(index)
+        if count < batch_size:
+            repeats = np.arange(count, batch_size) % count
+            for array in batch.values():
+                array[count:] = array[repeats]
+        inputs = [batch["images"], batch["image_meta"], batch["rpn_match"],
+                  batch["rpn_bbox"], batch["gt_class_ids"], batch["gt_boxes"],
+                  batch["gt_masks"]]
+        outputs = []
+
+        if random_rois:
+            inputs.extend([batch["rpn_rois"]])
+            if detection_targets:
+                inputs.extend([batch["rois"]])
+                # Keras requires that output and targets have the same number of dimensions
+                batch_mrcnn_class_ids = np.expand_dims(
+                    batch["mrcnn_class_ids"], -1)
+                outputs.extend(
+                    [batch_mrcnn_class_ids, batch["mrcnn_bbox"], batch["mrcnn_mask"]])
+
+        # Anchors of the batch, when they vary from batch to batch
+        if variable_image_shapes(config):
+            batch_anchors = utils.norm_boxes(shape_anchors[shape][0], shape[:2])
+            inputs.append(np.broadcast_to(
+                batch_anchors, (batch_size,) + batch_anchors.shape))
+        return inputs, outputs
 
     # Keras requires a generator to run indefinitely.
     while True:
+        if retry > len(image_ids):
+            raise Exception("No usable image in the dataset. All of them are "
+                            "skipped or in quarantine.")
+        # Sample of this iteration, and whether the error, if any, is raised
+        # while loading it. Only loading errors quarantine the sample.
+        image_id = None
+        loading = False
         try:
-            # Increment index to pick next image. Shuffle if at the start of an epoch.
-            image_index = (image_index + 1) % len(image_ids)
-            if shuffle and image_index == 0:
-                np.random.shuffle(image_ids)
+            # Position of the sample in the stream. Shuffle if at the start of an epoch.
+            position = batch_index * batch_size + b
+            epoch, image_index = divmod(position, len(image_ids))
+            if epoch != epoch_index:
+                # Yield the partly filled batches of the shapes of the last
+                # epoch. With a single shape, the batch of the samples that
+                # span two epochs is completed by the next samples.
+                if variable_image_shapes(config):
+                    for bucket_shape in list(buckets):
+                        inputs, outputs = bucket_batch(bucket_shape)
+                        timing.get_timer().flush()
+                        state.yielded()
+                        yield inputs, outputs
+                epoch_index = epoch
+                if shuffle:
+                    epoch_ids = np.random.RandomState([state.seed, epoch]).permutation(image_ids)
+                # Pick up the samples quarantined by the other workers
+                if quarantine is not None:
+                    quarantine.load()
+
+            # Get GT bounding boxes and masks for image. Skipped images are
+            # replaced by the next ones of the epoch.
+            image_id = epoch_ids[(image_index + retry) % len(image_ids)]
+            if quarantine is not None and sample_key(dataset, image_id) in quarantine:
+                retry += 1
+                continue
 
-            # Get GT bounding boxes and masks for image.
-            image_id = image_ids[image_index]
+            # Random generator of the augmentations and targets of this
+            # sample. It's local, the global NumPy generator isn't touched.
+            rng = np.random.RandomState([state.seed, position, retry])
+
+            # Per-stage timing (a no-op unless timing is on, see timing.py)
+            timer = timing.get_timer()
 
             # If the image source is not to be augmented pass None as augmentation
-            if dataset.image_info[image_id]['source'] in no_augmentation_sources:
-                image, image_meta, gt_class_ids, gt_boxes, gt_masks = \
-                load_image_gt(dataset, config, image_id, augment=augment,
-                              augmentation=None,
-                              use_mini_mask=config.USE_MINI_MASK)
-            else:
-                image, image_meta, gt_class_ids, gt_boxes, gt_masks = \
+            loading = True
+            with timer.stage("load_image_gt"):
+                if dataset.image_info[image_id]['source'] in no_augmentation_sources:
+                    image, image_meta, gt_class_ids, gt_boxes, gt_masks = \
                     load_image_gt(dataset, config, image_id, augment=augment,
-                                augmentation=augmentation,
-                                use_mini_mask=config.USE_MINI_MASK)
+                                  augmentation=None,
+                                  use_mini_mask=config.USE_MINI_MASK, rng=rng)
+                else:
+                    image, image_meta, gt_class_ids, gt_boxes, gt_masks = \
+                        load_image_gt(dataset, config, image_id, augment=augment,
+                                    augmentation=augmentation,
+                                    use_mini_mask=config.USE_MINI_MASK, rng=rng)
+            loading = False
 
             # Skip images that have no instances. This can happen in cases
             # where we train on a subset of classes and the image doesn't
             # have any of the classes we care about.
             if not np.any(gt_class_ids > 0):
+                retry += 1
                 continue
 
+            # Anchors of the image shape
+            shape = image.shape
+            if shape not in shape_anchors:
+                anchors = pyramid_anchors(config, shape)
+                anchor_index = utils.AnchorGridIndex(anchors)
+                rpn_cache = RPNTargetCache(anchors, anchor_index) \
+                    if config.CACHE_RPN_TARGETS else None
+                shape_anchors[shape] = (anchors, anchor_index, rpn_cache)
+            anchors, anchor_index, rpn_cache = shape_anchors[shape]
+
             # RPN Targets
-            rpn_match, rpn_bbox = build_rpn_targets(image.shape, anchors,
-                                                    gt_class_ids, gt_boxes, config)
+            with timer.stage("rpn_targets") as stage:
+                if rpn_cache is not None:
+                    rpn_match, rpn_bbox = rpn_cache.build_rpn_targets(
+                        image_id, image.shape, gt_class_ids, gt_boxes, config, rng=rng)
+                else:
+                    rpn_match, rpn_bbox = build_rpn_targets(image.shape, anchors,
+                                                            gt_class_ids, gt_boxes, config,
+                                                            anchor_index=anchor_index, rng=rng)
+                stage.add(rpn_match, rpn_bbox)
 
             # Mask R-CNN Targets
             if random_rois:
-                rpn_rois = generate_random_rois(
-                    image.shape, random_rois, gt_class_ids, gt_boxes)
-                if detection_targets:
-                    rois, mrcnn_class_ids, mrcnn_bbox, mrcnn_mask =\
-                        build_detection_targets(
-                            rpn_rois, gt_class_ids, gt_boxes, gt_masks, config)
-
-            # Init batch arrays
-            if b == 0:
-                batch_image_meta = np.zeros(
-                    (batch_size,) + image_meta.shape, dtype=image_meta.dtype)
-                batch_rpn_match = np.zeros(
-                    [batch_size, anchors.shape[0], 1], dtype=rpn_match.dtype)
-                batch_rpn_bbox = np.zeros(
-                    [batch_size, config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4], dtype=rpn_bbox.dtype)
-                batch_images = np.zeros(
-                    (batch_size,) + image.shape, dtype=np.float32)
-                batch_gt_class_ids = np.zeros(
-                    (batch_size, config.MAX_GT_INSTANCES), dtype=np.int32)
-                batch_gt_boxes = np.zeros(
-                    (batch_size, config.MAX_GT_INSTANCES, 4), dtype=np.int32)
-                batch_gt_masks = np.zeros(
-                    (batch_size, gt_masks.shape[0], gt_masks.shape[1],
-                     config.MAX_GT_INSTANCES), dtype=gt_masks.dtype)
+                with timer.stage("detection_targets"):
+                    rpn_rois = generate_random_rois(
+                        image.shape, random_rois, gt_class_ids, gt_boxes, rng=rng)
+                    if detection_targets:
+                        rois, mrcnn_class_ids, mrcnn_bbox, mrcnn_mask =\
+                            build_detection_targets(
+                                rpn_rois, gt_class_ids, gt_boxes, gt_masks, config, rng=rng)
+
+            # Add to the batch of the image shape, allocating its arrays first
+            with timer.stage("batch") as stage:
+                # Init batch arrays
+                batch = buckets.get(shape)
+                if batch is None:
+                    batch = buckets[shape] = {"count": 0}
+                    batch["image_meta"] = np.zeros(
+                        (batch_size,) + image_meta.shape, dtype=image_meta.dtype)
+                    batch["rpn_match"] = np.zeros(
+                        [batch_size, anchors.shape[0], 1], dtype=rpn_match.dtype)
+                    batch["rpn_bbox"] = np.zeros(
+                        [batch_size, config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4], dtype=rpn_bbox.dtype)
+                    batch["images"] = np.zeros(
+                        (batch_size,) + image.shape, dtype=np.float32)
+                    batch["gt_class_ids"] = np.zeros(
+                        (batch_size, config.MAX_GT_INSTANCES), dtype=np.int32)
+                    batch["gt_boxes"] = np.zeros(
+                        (batch_size, config.MAX_GT_INSTANCES, 4), dtype=np.int32)
+                    batch["gt_masks"] = np.zeros(
+                        (batch_size, gt_masks.shape[0], gt_masks.shape[1],
+                         config.MAX_GT_INSTANCES), dtype=gt_masks.dtype)
+                    if random_rois:
+                        batch["rpn_rois"] = np.zeros(
+                            (batch_size, rpn_rois.shape[0], 4), dtype=rpn_rois.dtype)
+                        if detection_targets:
+                            batch["rois"] = np.zeros(
+                                (batch_size,) + rois.shape, dtype=rois.dtype)
+                            batch["mrcnn_class_ids"] = np.zeros(
+                                (batch_size,) + mrcnn_class_ids.shape, dtype=mrcnn_class_ids.dtype)
+                            batch["mrcnn_bbox"] = np.zeros(
+                                (batch_size,) + mrcnn_bbox.shape, dtype=mrcnn_bbox.dtype)
+                            batch["mrcnn_mask"] = np.zeros(
+                                (batch_size,) + mrcnn_mask.shape, dtype=mrcnn_mask.dtype)
+                    stage.add(*batch.values())
+
+                # If more instances than fits in the array, sub-sample from them.
+                if gt_boxes.shape[0] > config.MAX_GT_INSTANCES:
+                    ids = rng.choice(
+                        np.arange(gt_boxes.shape[0]), config.MAX_GT_INSTANCES, replace=False)
+                    gt_class_ids = gt_class_ids[ids]
+                    gt_boxes = gt_boxes[ids]
+                    gt_masks = gt_masks[:, :, ids]
+
+                # Add to batch
+                i = batch["count"]
+                batch["image_meta"][i] = image_meta
+                batch["rpn_match"][i] = rpn_match[:, np.newaxis]
+                batch["rpn_bbox"][i] = rpn_bbox
+                batch["images"][i] = mold_image(image.astype(np.float32), config)
+                batch["gt_class_ids"][i, :gt_class_ids.shape[0]] = gt_class_ids
+                batch["gt_boxes"][i, :gt_boxes.shape[0]] = gt_boxes
+                batch["gt_masks"][i, :, :, :gt_masks.shape[-1]] = gt_masks
                 if random_rois:
-                    batch_rpn_rois = np.zeros(
-                        (batch_size, rpn_rois.shape[0], 4), dtype=rpn_rois.dtype)
+                    batch["rpn_rois"][i] = rpn_rois
                     if detection_targets:
-                        batch_rois = np.zeros(
-                            (batch_size,) + rois.shape, dtype=rois.dtype)
-                        batch_mrcnn_class_ids = np.zeros(
-                            (batch_size,) + mrcnn_class_ids.shape, dtype=mrcnn_class_ids.dtype)
-                        batch_mrcnn_bbox = np.zeros(
-                            (batch_size,) + mrcnn_bbox.shape, dtype=mrcnn_bbox.dtype)
-                        batch_mrcnn_mask = np.zeros(
-                            (batch_size,) + mrcnn_mask.shape, dtype=mrcnn_mask.dtype)
-
-            # If more instances than fits in the array, sub-sample from them.
-            if gt_boxes.shape[0] > config.MAX_GT_INSTANCES:
-                ids = np.random.choice(
-                    np.arange(gt_boxes.shape[0]), config.MAX_GT_INSTANCES, replace=False)
-                gt_class_ids = gt_class_ids[ids]
-                gt_boxes = gt_boxes[ids]
-                gt_masks = gt_masks[:, :, ids]
-
-            # Add to batch
-            batch_image_meta[b] = image_meta
-            batch_rpn_match[b] = rpn_match[:, np.newaxis]
-            batch_rpn_bbox[b] = rpn_bbox
-            batch_images[b] = mold_image(image.astype(np.float32), config)
-            batch_gt_class_ids[b, :gt_class_ids.shape[0]] = gt_class_ids
-            batch_gt_boxes[b, :gt_boxes.shape[0]] = gt_boxes
-            batch_gt_masks[b, :, :, :gt_masks.shape[-1]] = gt_masks
-            if random_rois:
-                batch_rpn_rois[b] = rpn_rois
-                if detection_targets:
-                    batch_rois[b] = rois
-                    batch_mrcnn_class_ids[b] = mrcnn_class_ids
-                    batch_mrcnn_bbox[b] = mrcnn_bbox
-                    batch_mrcnn_mask[b] = mrcnn_mask
+                        batch["rois"][i] = rois
+                        batch["mrcnn_class_ids"][i] = mrcnn_class_ids
+                        batch["mrcnn_bbox"][i] = mrcnn_bbox
+                        batch["mrcnn_mask"][i] = mrcnn_mask
+                batch["count"] += 1
+                bucket_indices.setdefault(shape, []).append(batch_index)
+                pending[batch_index] = pending.get(batch_index, 0) + 1
             b += 1
+            retry = 0
+            error_count = 0
 
-            # Batch full?
-            if b >= batch_size:
-                inputs = [batch_images, batch_image_meta, batch_rpn_match, batch_rpn_bbox,
-                          batch_gt_class_ids, batch_gt_boxes, batch_gt_masks]
-                outputs = []
+            # Batch of the image shape full?
+            full = batch["count"] >= batch_size
+            if full:
+                inputs, outputs = bucket_batch(shape)
 
-                if random_rois:
-                    inputs.extend([batch_rpn_rois])
-                    if detection_targets:
-                        inputs.extend([batch_rois])
-                        # Keras requires that output and targets have the same number of dimensions
-                        batch_mrcnn_class_ids = np.expand_dims(
-                            batch_mrcnn_class_ids, -1)
-                        outputs.extend(
-                            [batch_mrcnn_class_ids, batch_mrcnn_bbox, batch_mrcnn_mask])
+            # Move to the samples of the next batch index, before yielding so
+            # that the yield records this one as done if it is
+            if b >= batch_size:
+                if pending.get(batch_index, 0) == 0:
+                    pending.pop(batch_index, None)
+                    state.batch_done(batch_index)
+                b = 0
+                batch_index = state.next_batch()
 
+            if full:
+                # Send the timings of this worker to the training process
+                timer.flush()
+                state.yielded()
                 yield inputs, outputs
-
-                # start a new batch
-                b = 0
         except (GeneratorExit, KeyboardInterrupt):
             raise
-        except:
-            # Log it and skip the image
-            logging.exception("Error processing image {}".format(
-                dataset.image_info[image_id]))
+        except Exception as e:
+            # Log it and skip the image. If it failed to load, quarantine it
+            # so that it's not drawn again. Other errors, in the targets or
+            # the batch, are not the sample's fault: they're only logged.
+            info = dataset.image_info[image_id] \
+                if image_id is not None and image_id < len(dataset.image_info) else None
+            logging.exception("Error processing image {}".format(info))
+            if loading and quarantine is not None and info is not None:
+                quarantine.add(sample_key(dataset, image_id), e)
             error_count += 1
+            retry += 1
             if error_count > 5:
                 raise
 
 
+############################################################
+#  Callbacks
+############################################################
+
+class StageTimingCallback(keras.callbacks.Callback):
+    """Writes the data generator timings collected by a timing.StageTimer
+    at the end of each epoch, then resets them.
+
+    The mean and total time and the MB produced by each stage are written as
+    TensorBoard scalars in log_dir/data_timing, and appended to a CSV file
+    (log_dir/data_timing.csv by default) with one row per epoch and stage.
+    """
+
+    CSV_FIELDS = ["epoch", "stage", "count", "total_s", "mean_ms", "max_ms", "mbytes"]
+
+    def __init__(self, timer, log_dir, csv_path=None):
+        super(StageTimingCallback, self).__init__()
+        self.timer = timer
+        self.log_dir = log_dir
+        self.csv_path = csv_path or os.path.join(log_dir, "data_timing.csv")
+        self.writer = None
+
+    def on_epoch_end(self, epoch, logs=None):
+        rows = self.timer.summary()
+        self.timer.reset()
+        if not rows:
+            return
+
+        # TensorBoard scalars
+        if self.writer is None:
+            self.writer = tf.summary.FileWriter(os.path.join(self.log_dir, "data_timing"))
+        values = []
+        for row in rows:
+            for key in ["mean_ms", "total_s", "mbytes"]:
+                values.append(tf.Summary.Value(
+                    tag="data_timing/{}/{}".format(row["stage"], key),
+                    simple_value=row[key]))
+        self.writer.add_summary(tf.Summary(value=values), epoch)
+        self.writer.flush()
+
+        # CSV summary
+        write_header = not os.path.exists(self.csv_path)
+        with open(self.csv_path, "a") as f:
+            writer = csv.DictWriter(f, fieldnames=self.CSV_FIELDS)
+            if write_header:
+                writer.writeheader()
+            for row in rows:
+                row["epoch"] = epoch
+                writer.writerow(row)
+
+    def on_train_end(self, logs=None):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class DataStateCheckpoint(keras.callbacks.Callback):
+    """Saves the state of the training data generator next to each
+    checkpoint (see DataGeneratorState), so that training resumed from the
+    checkpoint continues with the samples not consumed yet instead of
+    replaying data.
+
+    state: The shared DataGeneratorState of the training generator.
+    checkpoint_path: Weights path with an {epoch} placeholder, as given to
+        ModelCheckpoint.
+    """
+
+    def __init__(self, state, checkpoint_path):
+        super(DataStateCheckpoint, self).__init__()
+        self.state = state
+        self.checkpoint_path = checkpoint_path
+        self.batches = 0
+
+    def on_batch_end(self, batch, logs=None):
+        self.batches += 1
+
+    def on_epoch_end(self, epoch, logs=None):
+        # The generators run ahead of training, so resume after the batches
+        # consumed rather than the generated ones.
+        self.state.consumed(self.batches)
+        path = self.checkpoint_path.format(epoch=epoch + 1)
+        self.state.save(DataGeneratorState.checkpoint_path(path))
+
+
 ############################################################
 #  MaskRCNN Class
 ############################################################
@@ -1822,20 +2554,29 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
 class MaskRCNN():
     """Encapsulates the Mask RCNN model functionality.
 
-    The actual Keras model is in the keras_model property.
+    The actual Keras model is in the keras_model property. In inference
+    mode, detect() runs inference_model instead, a model on the same layers
+    with the detections and the masks of their class as only outputs.
     """
 
-    def __init__(self, mode, config, model_dir):
+    def __init__(self, mode, config, model_dir, batch_size=None):
         """
         mode: Either "training" or "inference"
         config: A Sub-class of the Config class
         model_dir: Directory to save training logs and trained weights
+        batch_size: Optional, inference mode only. Batch size of the model,
+            on one GPU, instead of the BATCH_SIZE of the config. See
+            Config.with_batch_size().
         """
         assert mode in ['training', 'inference']
+        if batch_size is not None:
+            assert mode == "inference", "batch_size is for inference models only"
+            config = config.with_batch_size(batch_size)
         self.mode = mode
         self.config = config
         self.model_dir = model_dir
         self.set_log_dir()
+        self.inference_model = None
         self.keras_model = self.build(mode=mode, config=config)
 
     def build(self, mode, config):
@@ -1883,11 +2624,17 @@ class MaskRCNN():
                     shape=[config.MINI_MASK_SHAPE[0],
                            config.MINI_MASK_SHAPE[1], None],
                     name="input_gt_masks", dtype=bool)
+            elif variable_image_shapes(config):
+                input_gt_masks = KL.Input(
+                    shape=[None, None, None], name="input_gt_masks", dtype=bool)
             else:
                 input_gt_masks = KL.Input(
                     shape=[config.IMAGE_SHAPE[0], config.IMAGE_SHAPE[1], None],
                     name="input_gt_masks", dtype=bool)
-        elif mode == "inference":
+            # Anchors in normalized coordinates, if they vary from batch to batch
+            if variable_image_shapes(config):
+                input_anchors = KL.Input(shape=[None, 4], name="input_anchors")
+        elif mode == "inference" and not anchors_in_graph(config, mode):
             # Anchors in normalized coordinates
             input_anchors = KL.Input(shape=[None, 4], name="input_anchors")
 
@@ -1927,13 +2674,15 @@ class MaskRCNN():
         mrcnn_feature_maps = [P2, P3, P4, P5]
 
         # Anchors
-        if mode == "training":
-            anchors = self.get_anchors(config.IMAGE_SHAPE)
-            # Duplicate across the batch dimension because Keras requires it
-            # TODO: can this be optimized to avoid duplicating the anchors?
-            anchors = np.broadcast_to(anchors, (config.BATCH_SIZE,) + anchors.shape)
-            # A hack to get around Keras's bad support for constants
-            anchors = KL.Lambda(lambda x: tf.Variable(anchors), name="anchors")(input_image)
+        if anchors_in_graph(config, mode):
+            anchors = np.array(self.get_anchors(config.IMAGE_SHAPE), dtype=np.float32)
+            # A hack to get around Keras's bad support for constants. The
+            # anchors are embedded once, and duplicated across the batch
+            # dimension in the graph because Keras requires it.
+            anchors = KL.Lambda(
+                lambda x: tf.tile(tf.expand_dims(tf.constant(anchors), 0),
+                                  [tf.shape(x)[0], 1, 1]),
+                name="anchors")(input_image)
         else:
             anchors = input_anchors
 
@@ -2025,6 +2774,8 @@ class MaskRCNN():
                       input_rpn_match, input_rpn_bbox, input_gt_class_ids, input_gt_boxes, input_gt_masks]
             if not config.USE_RPN_ROIS:
                 inputs.append(input_rois)
+            if variable_image_shapes(config):
+                inputs.append(input_anchors)
             outputs = [rpn_class_logits, rpn_class, rpn_bbox,
                        mrcnn_class_logits, mrcnn_class, mrcnn_bbox, mrcnn_mask,
                        rpn_rois, output_rois,
@@ -2053,15 +2804,29 @@ class MaskRCNN():
                                               config.NUM_CLASSES,
                                               train_bn=config.TRAIN_BN)
 
-            model = KM.Model([input_image, input_image_meta, input_anchors],
+            inputs = [input_image, input_image_meta]
+            if not anchors_in_graph(config, mode):
+                inputs.append(input_anchors)
+            model = KM.Model(inputs,
                              [detections, mrcnn_class, mrcnn_bbox,
                                  mrcnn_mask, rpn_rois, rpn_class, rpn_bbox],
                              name='mask_rcnn')
 
+            # Slim model for detect(), on the same layers: the detections
+            # and the mask of their class only
+            class_masks = KL.Lambda(
+                lambda x: gather_class_masks_graph(*x, dtype=config.DETECTION_MASK_DTYPE),
+                name="mrcnn_class_mask")([mrcnn_mask, detections])
+            self.inference_model = KM.Model(
+                inputs, [detections, class_masks], name='mask_rcnn_inference')
+
         # Add multi-GPU support.
         if config.GPU_COUNT > 1:
             from mrcnn.parallel_model import ParallelModel
             model = ParallelModel(model, config.GPU_COUNT)
+            if mode == "inference":
+                self.inference_model = ParallelModel(self.inference_model,
+                                                     config.GPU_COUNT)
 
         return model
 
@@ -2247,6 +3012,7 @@ class MaskRCNN():
         """
         # Set date and epoch counter as if starting a new model
         self.epoch = 0
+        self.data_state = None
         now = datetime.datetime.now()
 
         # If we have a model path with date and epochs use them
@@ -2264,6 +3030,11 @@ class MaskRCNN():
                 # So, adjust for that then increment by one to start from the next epoch
                 self.epoch = int(m.group(6)) - 1 + 1
                 print('Re-starting from epoch %d' % self.epoch)
+                # Resume the training data where the checkpoint left it
+                state_path = DataGeneratorState.checkpoint_path(model_path)
+                if os.path.exists(state_path):
+                    self.data_state = DataGeneratorState.load(state_path)
+                    print('Re-starting data generator from batch %d' % self.data_state.batch)
 
         # Directory for training logs
         self.log_dir = os.path.join(self.model_dir, "{}{:%Y%m%dT%H%M}".format(
@@ -2275,6 +3046,16 @@ class MaskRCNN():
         self.checkpoint_path = self.checkpoint_path.replace(
             "*epoch*", "{epoch:04d}")
 
+    def quarantine_path(self):
+        """Returns the path of the quarantine file of failing samples. It's
+        in the model directory, shared by all the runs, so that samples
+        quarantined by a run are skipped by the next ones too. None if
+        config.QUARANTINE_FILE is not set.
+        """
+        if not self.config.QUARANTINE_FILE:
+            return None
+        return os.path.join(self.model_dir, self.config.QUARANTINE_FILE)
+
     def train(self, train_dataset, val_dataset, learning_rate, epochs, layers,
               augmentation=None, custom_callbacks=None, no_augmentation_sources=None, n_worker_threads=-1):
         """Train the model.
@@ -2303,13 +3084,24 @@ class MaskRCNN():
                     imgaug.augmenters.Fliplr(0.5),
                     imgaug.augmenters.GaussianBlur(sigma=(0.0, 5.0))
                 ])
+
+            For flips and 90 degree rotations, DihedralAugmentation()
+            is much faster than imgaug. See mrcnn/augment.py.
 	    custom_callbacks: Optional. Add custom callbacks to be called
 	        with the keras fit_generator method. Must be list of type keras.callbacks.
         no_augmentation_sources: Optional. List of sources to exclude for
             augmentation. A source is string that identifies a dataset and is
             defined in the Dataset class.
+
+        The datasets can also be TFRecordInput objects (see tfrecord.py), to
+        train from TFRecord files with a tf.data pipeline instead of
+        data_generator(). They do their own augmentation, augmentation and
+        no_augmentation_sources don't apply to them. Both datasets must then
+        be TFRecordInput objects.
         """
         assert self.mode == "training", "Create model in training mode."
+        # Imported here, tfrecord.py imports this module
+        from mrcnn.tfrecord import TFRecordInput
 
         # Pre-defined layer regular expressions
         layer_regex = {
@@ -2325,13 +3117,35 @@ class MaskRCNN():
         if layers in layer_regex.keys():
             layers = layer_regex[layers]
 
-        # Data generators
-        train_generator = data_generator(train_dataset, self.config, shuffle=True,
-                                         augmentation=augmentation,
-                                         batch_size=self.config.BATCH_SIZE,
-                                         no_augmentation_sources=no_augmentation_sources)
-        val_generator = data_generator(val_dataset, self.config, shuffle=True,
-                                       batch_size=self.config.BATCH_SIZE)
+        # Data generators. The training data continues from the state loaded
+        # with the weights or left by the previous call, if any. The batch
+        # counter is shared with the generator workers.
+        quarantine = Quarantine(self.quarantine_path()) \
+            if self.config.QUARANTINE_FILE else None
+        # Keras runs both generators with the same workers: the tf.data
+        # pipelines in a single thread, data_generator() in processes.
+        tfrecord_input = isinstance(train_dataset, TFRecordInput)
+        assert tfrecord_input == isinstance(val_dataset, TFRecordInput), \
+            "Mixed inputs: the training and validation datasets must both be " \
+            "TFRecordInput objects, or both be Dataset objects."
+        if tfrecord_input:
+            train_generator = train_dataset.generator(self.config.BATCH_SIZE)
+        else:
+            if self.data_state is None:
+                self.data_state = DataGeneratorState(seed=self.config.DATA_GENERATOR_SEED)
+            self.data_state.share()
+            train_generator = data_generator(train_dataset, self.config, shuffle=True,
+                                             augmentation=augmentation,
+                                             batch_size=self.config.BATCH_SIZE,
+                                             no_augmentation_sources=no_augmentation_sources,
+                                             state=self.data_state,
+                                             quarantine=quarantine)
+        if tfrecord_input:
+            val_generator = val_dataset.generator(self.config.BATCH_SIZE)
+        else:
+            val_generator = data_generator(val_dataset, self.config, shuffle=True,
+                                           batch_size=self.config.BATCH_SIZE,
+                                           quarantine=quarantine)
 
         # Create log_dir if it does not exist
         if not os.path.exists(self.log_dir):
@@ -2344,11 +3158,19 @@ class MaskRCNN():
             keras.callbacks.ModelCheckpoint(self.checkpoint_path,
                                             verbose=0, save_weights_only=True),
         ]
+        if not tfrecord_input:
+            callbacks.append(DataStateCheckpoint(self.data_state, self.checkpoint_path))
 
         # Add custom callbacks to the list
         if custom_callbacks:
             callbacks += custom_callbacks
 
+        # Per-stage timing of the data generator. The timer is set before
+        # Keras forks the generator workers, they send their timings back.
+        if self.config.PROFILE_DATA_GENERATOR:
+            timer = timing.set_timer(timing.StageTimer(shared=True))
+            callbacks.append(StageTimingCallback(timer, self.log_dir))
+
         # Train
         log("\nStarting at epoch {}. LR={}\n".format(self.epoch, learning_rate))
         log("Checkpoint Path: {}".format(self.checkpoint_path))
@@ -2358,8 +3180,12 @@ class MaskRCNN():
         # Work-around for Windows: Keras fails on Windows when using
         # multiprocessing workers. See discussion here:
         # https://github.com/matterport/Mask_RCNN/issues/13#issuecomment-353124009
+        # The tf.data pipelines run in the Keras session, they're fed from a
+        # thread and parallelize on their own.
         if os.name is 'nt':
             workers = 0
+        elif tfrecord_input:
+            workers = 1
         else:
             ncpus= multiprocessing.cpu_count()
             if n_worker_threads<0 or n_worker_threads>=ncpus:
@@ -2377,9 +3203,11 @@ class MaskRCNN():
             validation_steps=self.config.VALIDATION_STEPS,
             max_queue_size=100,
             workers=workers,
-            use_multiprocessing=True,
+            use_multiprocessing=not tfrecord_input,
         )
         self.epoch = max(self.epoch, epochs)
+        if self.config.PROFILE_DATA_GENERATOR:
+            timing.set_timer(None)
 
     def mold_inputs(self, images):
         """Takes a list of images and modifies them to the format expected
@@ -2388,7 +3216,8 @@ class MaskRCNN():
             different sizes.
 
         Returns 3 Numpy matrices:
-        molded_images: [N, h, w, 3]. Images resized and normalized.
+        molded_images: [N, h, w, 3]. Images resized and normalized. A list
+            if their shapes differ, see variable_image_shapes().
         image_metas: [N, length of meta data]. Details about each image.
         windows: [N, (y1, x1, y2, x2)]. The portion of the image that has the
             original image (padding excluded).
@@ -2405,6 +3234,9 @@ class MaskRCNN():
                 min_scale=self.config.IMAGE_MIN_SCALE,
                 max_dim=self.config.IMAGE_MAX_DIM,
                 mode=self.config.IMAGE_RESIZE_MODE)
+            # Pad to a multiple of 64, as the network needs
+            if self.config.IMAGE_RESIZE_MODE == "none":
+                molded_image, padding = utils.pad_to_multiple(molded_image, 64)
             molded_image = mold_image(molded_image, self.config)
             # Build image_meta
             image_meta = compose_image_meta(
@@ -2415,29 +3247,34 @@ class MaskRCNN():
             windows.append(window)
             image_metas.append(image_meta)
         # Pack into arrays
-        molded_images = np.stack(molded_images)
+        if len(set(m.shape for m in molded_images)) == 1:
+            molded_images = np.stack(molded_images)
         image_metas = np.stack(image_metas)
         windows = np.stack(windows)
         return molded_images, image_metas, windows
 
     def unmold_detections(self, detections, mrcnn_mask, original_image_shape,
-                          image_shape, window):
+                          image_shape, window, mask_format="full"):
         """Reformats the detections of one image from the format of the neural
         network output to a format suitable for use in the rest of the
         application.
 
         detections: [N, (y1, x1, y2, x2, class_id, score)] in normalized coordinates
-        mrcnn_mask: [N, height, width, num_classes]
+        mrcnn_mask: [N, height, width, num_classes], or [N, height, width]
+            masks of the detected classes, float or uint8 scaled to [0, 255].
+            See gather_class_masks_graph().
         original_image_shape: [H, W, C] Original image shape before resizing
         image_shape: [H, W, C] Shape of the image after resizing and padding
         window: [y1, x1, y2, x2] Pixel coordinates of box in the image where the real
                 image is excluding the padding.
+        mask_format: Format of the returned masks, one of utils.MASK_FORMATS.
 
         Returns:
         boxes: [N, (y1, x1, y2, x2)] Bounding boxes in pixels
         class_ids: [N] Integer class IDs for each bounding box
         scores: [N] Float probability scores of the class_id
-        masks: [height, width, num_instances] Instance masks
+        masks: [height, width, num_instances] Instance masks, or a list of
+            box crops or RLEs, depending on mask_format
         """
         # How many detections do we have?
         # Detections array is padded with zeros. Find the first class_id == 0.
@@ -2448,7 +3285,15 @@ class MaskRCNN():
         boxes = detections[:N, :4]
         class_ids = detections[:N, 4].astype(np.int32)
         scores = detections[:N, 5]
-        masks = mrcnn_mask[np.arange(N), :, :, class_ids]
+        if mrcnn_mask.ndim == 4:
+            masks = mrcnn_mask[np.arange(N), :, :, class_ids]
+        else:
+            masks = mrcnn_mask[:N]
+        # Masks of the inference model can be float16 or uint8
+        if masks.dtype == np.uint8:
+            masks = masks.astype(np.float32) / 255
+        elif masks.dtype == np.float16:
+            masks = masks.astype(np.float32)
 
         # Translate normalized coordinates in the resized image to pixel
         # coordinates in the original image before resizing
@@ -2465,41 +3310,67 @@ class MaskRCNN():
 
         # Filter out detections with zero area. Happens in early training when
         # network weights are still random
-        exclude_ix = np.where(
-            (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]) <= 0)[0]
-        if exclude_ix.shape[0] > 0:
-            boxes = np.delete(boxes, exclude_ix, axis=0)
-            class_ids = np.delete(class_ids, exclude_ix, axis=0)
-            scores = np.delete(scores, exclude_ix, axis=0)
-            masks = np.delete(masks, exclude_ix, axis=0)
-            N = class_ids.shape[0]
-
-        # Resize masks to original image size and set boundary threshold.
-        full_masks = []
-        for i in range(N):
-            # Convert neural network mask to full size mask
-            full_mask = utils.unmold_mask(masks[i], boxes[i], original_image_shape)
-            full_masks.append(full_mask)
-        full_masks = np.stack(full_masks, axis=-1)\
-            if full_masks else np.empty(original_image_shape[:2] + (0,))
+        keep = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]) > 0
+        if not keep.all():
+            boxes = boxes[keep]
+            class_ids = class_ids[keep]
+            scores = scores[keep]
+            masks = masks[keep]
+
+        # Resize masks to original image size and set boundary threshold,
+        # all instances at once, in a single [H, W, N] array or in crops
+        full_masks = utils.unmold_masks(masks, boxes, original_image_shape,
+                                        mask_format=mask_format)
 
         return boxes, class_ids, scores, full_masks
 
-    def detect(self, images, verbose=0):
+    def detect(self, images, verbose=0, mask_format=None):
         """Runs the detection pipeline.
 
         images: List of images, potentially of different sizes.
+        mask_format: Optional. Format of the masks, one of utils.MASK_FORMATS.
+            Defaults to config.DETECTION_MASK_FORMAT.
 
         Returns a list of dicts, one dict per image. The dict contains:
         rois: [N, (y1, x1, y2, x2)] detection bounding boxes
         class_ids: [N] int class IDs
         scores: [N] float probability scores for the class IDs
-        masks: [H, W, N] instance binary masks
+        masks: [H, W, N] instance binary masks, or a list of N box crops
+            or RLEs. See utils.MASK_FORMATS.
         """
         assert self.mode == "inference", "Create model in inference mode."
         assert len(
             images) == self.config.BATCH_SIZE, "len(images) must be equal to BATCH_SIZE"
+        return self._detect(images, verbose=verbose, mask_format=mask_format)
+
+    def detect_many(self, images, batch_size=None, verbose=0, mask_format=None):
+        """Runs the detection pipeline on any number of images. The images
+        are molded, run and unmolded by chunks of batch_size images, run in
+        batches of BATCH_SIZE, and the last batch of each chunk is padded.
+
+        images: List of images, potentially of different sizes.
+        batch_size: Optional. Number of images processed at a time, which
+            bounds the memory used by the molded images and the raw outputs
+            of the model. Rounded up to a multiple of BATCH_SIZE. Defaults
+            to BATCH_SIZE.
+        mask_format: Optional. Format of the masks, see detect().
+
+        Returns a list of dicts, one dict per image, in the order of the
+        images. See detect().
+        """
+        assert self.mode == "inference", "Create model in inference mode."
+        model_batch_size = self.config.BATCH_SIZE
+        chunk_size = batch_size or model_batch_size
+        chunk_size = -(-chunk_size // model_batch_size) * model_batch_size
+        results = []
+        for start in range(0, len(images), chunk_size):
+            results.extend(self._detect(images[start:start + chunk_size],
+                                        verbose=verbose, mask_format=mask_format))
+        return results
 
+    def _detect(self, images, verbose=0, mask_format=None):
+        """Molds, runs and unmolds the detections of a list of images of
+        any length. See detect()."""
         if verbose:
             log("Processing {} images".format(len(images)))
             for image in images:
@@ -2508,34 +3379,23 @@ class MaskRCNN():
         # Mold inputs to format expected by the neural network
         molded_images, image_metas, windows = self.mold_inputs(images)
 
-        
-        # Validate image sizes
-        # All images in a batch MUST be of the same size
-        image_shape = molded_images[0].shape
-        for g in molded_images[1:]:
-            assert g.shape == image_shape,\
-                "After resizing, all images must have the same size. Check IMAGE_RESIZE_MODE and image sizes."
-
-        # Anchors
-        anchors = self.get_anchors(image_shape)
-        # Duplicate across the batch dimension because Keras requires it
-        # TODO: can this be optimized to avoid duplicating the anchors?
-        anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
-
-        if verbose:
-            log("molded_images", molded_images)
-            log("image_metas", image_metas)
-            log("anchors", anchors)
-        # Run object detection
-        detections, _, _, mrcnn_mask, _, _, _ =\
-            self.keras_model.predict([molded_images, image_metas, anchors], verbose=0)
+        # Run object detection, by batches of images of the same shape
+        detections, mrcnn_mask = self.predict_by_shape(molded_images, image_metas,
+                                                       verbose=verbose)
         # Process detections
+        return self._unmold_results(images, molded_images, windows,
+                                    detections, mrcnn_mask, mask_format)
+
+    def _unmold_results(self, images, molded_images, windows, detections, mrcnn_mask,
+                        mask_format=None):
+        """Returns the result dicts of detect() for a list of images."""
+        mask_format = mask_format or self.config.DETECTION_MASK_FORMAT
         results = []
         for i, image in enumerate(images):
             final_rois, final_class_ids, final_scores, final_masks =\
                 self.unmold_detections(detections[i], mrcnn_mask[i],
                                        image.shape, molded_images[i].shape,
-                                       windows[i])
+                                       windows[i], mask_format=mask_format)
             results.append({
                 "rois": final_rois,
                 "class_ids": final_class_ids,
@@ -2544,19 +3404,71 @@ class MaskRCNN():
             })
         return results
 
-    def detect_molded(self, molded_images, image_metas, verbose=0):
+    def detect_iter(self, images, workers=2, prefetch=2, mask_format=None):
+        """Runs the detection pipeline on a stream of images and yields the
+        result of each image, in order. The images are taken in batches of
+        BATCH_SIZE, and the three stages of a batch overlap with the others:
+        a pool of threads molds the next batches and unmolds the previous
+        ones while the model runs on the current batch.
+
+        images: Iterable of images, potentially of different sizes. It's
+            consumed as the results are yielded.
+        workers: Number of threads that mold and unmold the batches.
+        prefetch: Bound on the number of batches molded ahead of the model,
+            and on the number of batches waiting to be unmolded, so memory
+            stays bounded on long streams.
+        mask_format: Optional. Format of the masks, see detect().
+
+        Yields one dict per image, see detect().
+        """
+        assert self.mode == "inference", "Create model in inference mode."
+        images = iter(images)
+        batch_size = self.config.BATCH_SIZE
+        molding = deque()
+        unmolding = deque()
+
+        def mold_next(pool):
+            # Queue the next batches for molding, up to prefetch of them
+            while len(molding) < prefetch:
+                batch = list(itertools.islice(images, batch_size))
+                if not batch:
+                    return
+                molding.append((batch, pool.submit(self.mold_inputs, batch)))
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            mold_next(pool)
+            while molding:
+                batch, molded = molding.popleft()
+                molded_images, image_metas, windows = molded.result()
+                # Mold the next batches while this one runs
+                mold_next(pool)
+                detections, mrcnn_mask = self.predict_by_shape(molded_images, image_metas)
+                unmolding.append(pool.submit(
+                    self._unmold_results, batch, molded_images, windows,
+                    detections, mrcnn_mask, mask_format))
+                # Yield the batches unmolded so far, in order
+                while unmolding and (unmolding[0].done() or len(unmolding) > prefetch):
+                    for result in unmolding.popleft().result():
+                        yield result
+            while unmolding:
+                for result in unmolding.popleft().result():
+                    yield result
+
+    def detect_molded(self, molded_images, image_metas, verbose=0, mask_format=None):
         """Runs the detection pipeline, but expect inputs that are
         molded already. Used mostly for debugging and inspecting
         the model.
 
         molded_images: List of images loaded using load_image_gt()
         image_metas: image meta data, also returned by load_image_gt()
+        mask_format: Optional. Format of the masks, see detect().
 
         Returns a list of dicts, one dict per image. The dict contains:
         rois: [N, (y1, x1, y2, x2)] detection bounding boxes
         class_ids: [N] int class IDs
         scores: [N] float probability scores for the class IDs
-        masks: [H, W, N] instance binary masks
+        masks: [H, W, N] instance binary masks, or a list of N box crops
+            or RLEs. See utils.MASK_FORMATS.
         """
         assert self.mode == "inference", "Create model in inference mode."
         assert len(molded_images) == self.config.BATCH_SIZE,\
@@ -2567,33 +3479,18 @@ class MaskRCNN():
             for image in molded_images:
                 log("image", image)
 
-        # Validate image sizes
-        # All images in a batch MUST be of the same size
-        image_shape = molded_images[0].shape
-        for g in molded_images[1:]:
-            assert g.shape == image_shape, "Images must have the same size"
-
-        # Anchors
-        anchors = self.get_anchors(image_shape)
-        # Duplicate across the batch dimension because Keras requires it
-        # TODO: can this be optimized to avoid duplicating the anchors?
-        anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
-
-        if verbose:
-            log("molded_images", molded_images)
-            log("image_metas", image_metas)
-            log("anchors", anchors)
-        # Run object detection
-        detections, _, _, mrcnn_mask, _, _, _ =\
-            self.keras_model.predict([molded_images, image_metas, anchors], verbose=0)
+        # Run object detection, by batches of images of the same shape
+        detections, mrcnn_mask = self.predict_by_shape(molded_images, image_metas,
+                                                       verbose=verbose)
         # Process detections
+        mask_format = mask_format or self.config.DETECTION_MASK_FORMAT
         results = []
         for i, image in enumerate(molded_images):
             window = [0, 0, image.shape[0], image.shape[1]]
             final_rois, final_class_ids, final_scores, final_masks =\
                 self.unmold_detections(detections[i], mrcnn_mask[i],
                                        image.shape, molded_images[i].shape,
-                                       window)
+                                       window, mask_format=mask_format)
             results.append({
                 "rois": final_rois,
                 "class_ids": final_class_ids,
@@ -2602,26 +3499,72 @@ class MaskRCNN():
             })
         return results
 
+    def predict_by_shape(self, molded_images, image_metas, verbose=0):
+        """Runs the inference model on molded images, batched by shape. The
+        images of each shape run in batches of BATCH_SIZE with the anchors of
+        that shape. Partial batches are padded by repeating their last image.
+
+        molded_images: [N, height, width, 3] array, or list of molded images
+            of different shapes.
+        image_metas: [N, meta size] image meta data.
+
+        Returns detections and mrcnn_mask, lists with one item per image.
+        The masks are the ones of the detected classes, [N, height, width]
+        of config.DETECTION_MASK_DTYPE, see gather_class_masks_graph().
+        """
+        batch_size = self.config.BATCH_SIZE
+        detections = [None] * len(molded_images)
+        mrcnn_mask = [None] * len(molded_images)
+        for image_shape, ids in utils.group_by_shape(molded_images).items():
+            anchors = self.anchor_inputs(image_shape)
+            for start in range(0, len(ids), batch_size):
+                batch_ids = ids[start:start + batch_size]
+                padded_ids = batch_ids + batch_ids[-1:] * (batch_size - len(batch_ids))
+                batch_images = np.stack([molded_images[i] for i in padded_ids])
+                batch_metas = np.asarray(image_metas)[padded_ids]
+                if verbose:
+                    log("molded_images", batch_images)
+                    log("image_metas", batch_metas)
+                    for a in anchors:
+                        log("anchors", a)
+                # Detections and class masks only. keras_model has all the
+                # outputs, see run_graph()
+                batch_detections, batch_mrcnn_mask = self.inference_model.predict(
+                    [batch_images, batch_metas] + anchors, verbose=0)
+                for k, i in enumerate(batch_ids):
+                    detections[i] = batch_detections[k]
+                    mrcnn_mask[i] = batch_mrcnn_mask[k]
+        return detections, mrcnn_mask
+
+    def anchor_inputs(self, image_shape):
+        """Returns the anchors input of the inference model for a batch of
+        images of the given shape: a list with the normalized anchors
+        duplicated across the batch dimension, or an empty list if the
+        anchors are in the graph. See anchors_in_graph().
+        """
+        if anchors_in_graph(self.config, self.mode):
+            assert tuple(image_shape) == tuple(self.config.IMAGE_SHAPE),\
+                "Anchors are in the graph for images of shape {}, got {}".format(
+                    tuple(self.config.IMAGE_SHAPE), tuple(image_shape))
+            return []
+        anchors = self.get_anchors(image_shape)
+        # Duplicate across the batch dimension because Keras requires it
+        return [np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)]
+
     def get_anchors(self, image_shape):
         """Returns anchor pyramid for the given image size."""
-        backbone_shapes = compute_backbone_shapes(self.config, image_shape)
         # Cache anchors and reuse if image shape is the same
         if not hasattr(self, "_anchor_cache"):
             self._anchor_cache = {}
         if not tuple(image_shape) in self._anchor_cache:
-            # Generate Anchors
-            a = utils.generate_pyramid_anchors(
-                self.config.RPN_ANCHOR_SCALES,
-                self.config.RPN_ANCHOR_RATIOS,
-                backbone_shapes,
-                self.config.BACKBONE_STRIDES,
-                self.config.RPN_ANCHOR_STRIDE)
+            # Generated, or loaded from config.ANCHOR_CACHE_DIR
             # Keep a copy of the latest anchors in pixel coordinates because
             # it's used in inspect_model notebooks.
             # TODO: Remove this after the notebook are refactored to not use it
-            self.anchors = a
-            # Normalize coordinates
-            self._anchor_cache[tuple(image_shape)] = utils.norm_boxes(a, image_shape[:2])
+            self.anchors = pyramid_anchors(self.config, image_shape)
+            # Normalized coordinates
+            self._anchor_cache[tuple(image_shape)] = pyramid_anchors(
+                self.config, image_shape, normalized=True)
         return self._anchor_cache[tuple(image_shape)]
 
     def ancestor(self, tensor, name, checked=None):
@@ -2705,12 +3648,7 @@ class MaskRCNN():
         else:
             molded_images = images
         image_shape = molded_images[0].shape
-        # Anchors
-        anchors = self.get_anchors(image_shape)
-        # Duplicate across the batch dimension because Keras requires it
-        # TODO: can this be optimized to avoid duplicating the anchors?
-        anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
-        model_in = [molded_images, image_metas, anchors]
+        model_in = [molded_images, image_metas] + self.anchor_inputs(image_shape)
 
         # Run inference
         if model.uses_learning_phase and not isinstance(K.learning_phase(), int):
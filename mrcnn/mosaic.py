@@ -0,0 +1,288 @@
+"""
+Mask R-CNN
+Sliding window inference on whole survey mosaics.
+
+The detector runs on images of IMAGE_MAX_DIM pixels, cut out around the
+sources of a catalog by SClassifier. MosaicDetector finds the sources of
+a whole mosaic blindly instead: it covers the mosaic with overlapping
+tiles, runs the model on batches of tiles, and stitches the detections:
+
+    detector = MosaicDetector(model, overlap=64)
+    r = detector.detect(data, label_map_path="labels.dat")
+
+data is the 2D mosaic, as read by utils.read_fits() without stretch and
+normalization, or a memory map of it. The tiles are stretched and
+normalized one at a time, like the cutouts of utils.crop_img().
+
+The objects in the overlap of two tiles are detected twice, and cut by
+the edge of one of them if they cross it. Detections of the same class in
+different tiles are duplicates if the IoU of their masks, counted in the
+overlap of the two tiles only, is over iou_threshold: the pixels a cut
+detection misses are out of the overlap. Of a set of duplicates, the
+detection not cut by a tile edge with the highest score is kept.
+
+The kept detections are painted in a label map of the mosaic size, in a
+memory map on disk if a path is given, with the index of the detection
+plus one, 0 for the background. The time and the memory, besides the
+label map, scale with the number of tiles, so with the area of the
+mosaic.
+"""
+
+import logging
+import numpy as np
+
+from mrcnn import utils
+
+## Get logger
+logger = logging.getLogger(__name__)
+
+
+############################################################
+#  Tiles
+############################################################
+
+def tile_grid(shape, tile_size, overlap):
+    """Returns the tiles that cover an image with the given overlap.
+
+    shape: (height, width) of the image.
+    tile_size: Side of the tiles. Tiles are smaller on the sides of the
+        image that are smaller than a tile.
+    overlap: Overlap of neighbor tiles, in pixels. The last tiles of a row
+        or column are shifted to end on the image edge, so they can overlap
+        more.
+
+    Returns [T, (y1, x1, y2, x2)] int tiles in row major order.
+    """
+    assert 0 <= overlap < tile_size, "overlap must be smaller than tile_size"
+    starts = []
+    for size in shape[:2]:
+        stride = tile_size - overlap
+        last = max(size - tile_size, 0)
+        s = np.arange(0, last + 1, stride)
+        if s[-1] < last:
+            s = np.append(s, last)
+        starts.append(s)
+    y1, x1 = [a.reshape([-1]) for a in np.meshgrid(starts[0], starts[1], indexing="ij")]
+    y2 = np.minimum(y1 + tile_size, shape[0])
+    x2 = np.minimum(x1 + tile_size, shape[1])
+    return np.stack([y1, x1, y2, x2], axis=1).astype(np.int64)
+
+
+def tile_image(data, tile, stretch=True):
+    """Cuts a tile out of a 2D mosaic and converts it to an RGB image, as
+    utils.crop_img() does for the source cutouts. The mosaic is not
+    modified.
+
+    data: [height, width] mosaic.
+    tile: (y1, x1, y2, x2) of the tile.
+    stretch: Apply a z-scale stretch to the tile.
+    """
+    y1, x1, y2, x2 = tile
+    crop = np.array(data[y1:y2, x1:x2], dtype=np.float32)
+    # Replace nan values with min pix value
+    nans = np.isnan(crop)
+    if nans.all():
+        crop[:] = 0
+    elif nans.any():
+        crop[nans] = np.nanmin(crop)
+    if stretch:
+        crop = utils.stretch_img(crop).astype(np.float32)
+    # Normalize to [0, 1] for the RGB conversion
+    if crop.max() > 0:
+        crop = utils.normalize_img(crop)
+    return utils.gray2rgb(crop)
+
+
+############################################################
+#  Stitching
+############################################################
+
+def _paste(crop, box, frame):
+    """Returns the part of a box crop inside a frame (y1, x1, y2, x2), as a
+    bool array of the frame size."""
+    out = np.zeros([frame[2] - frame[0], frame[3] - frame[1]], dtype=bool)
+    y1, x1 = max(box[0], frame[0]), max(box[1], frame[1])
+    y2, x2 = min(box[2], frame[2]), min(box[3], frame[3])
+    if y2 > y1 and x2 > x1:
+        out[y1 - frame[0]:y2 - frame[0], x1 - frame[1]:x2 - frame[1]] = \
+            crop[y1 - box[0]:y2 - box[0], x1 - box[1]:x2 - box[1]]
+    return out
+
+
+def overlap_mask_iou(crop1, box1, crop2, box2, window):
+    """IoU of two box crops counted inside a window only, the overlap of
+    the tiles they come from."""
+    frame = np.array([max(min(box1[0], box2[0]), window[0]),
+                      max(min(box1[1], box2[1]), window[1]),
+                      min(max(box1[2], box2[2]), window[2]),
+                      min(max(box1[3], box2[3]), window[3])])
+    if frame[2] <= frame[0] or frame[3] <= frame[1]:
+        return 0.
+    m1 = _paste(crop1, box1, frame)
+    m2 = _paste(crop2, box2, frame)
+    intersection = np.count_nonzero(m1 & m2)
+    union = np.count_nonzero(m1) + np.count_nonzero(m2) - intersection
+    return intersection / union if union > 0 else 0.
+
+
+def cut_by_tile(boxes, tiles, shape):
+    """Returns an [N] bool array of the boxes that touch an edge of their
+    tile inside the mosaic, so are likely cut by it.
+
+    boxes: [N, (y1, x1, y2, x2)] in mosaic coordinates.
+    tiles: [N, (y1, x1, y2, x2)] tile of each box.
+    shape: (height, width) of the mosaic.
+    """
+    return ((boxes[:, 0] <= tiles[:, 0]) & (tiles[:, 0] > 0)) | \
+        ((boxes[:, 1] <= tiles[:, 1]) & (tiles[:, 1] > 0)) | \
+        ((boxes[:, 2] >= tiles[:, 2]) & (tiles[:, 2] < shape[0])) | \
+        ((boxes[:, 3] >= tiles[:, 3]) & (tiles[:, 3] < shape[1]))
+
+
+def merge_tile_detections(boxes, class_ids, scores, crops, tiles, shape,
+                          iou_threshold=0.5):
+    """Merges the duplicate detections of overlapping tiles.
+
+    boxes: [N, (y1, x1, y2, x2)] detection boxes in mosaic coordinates.
+    class_ids, scores: [N] class IDs and scores of the detections.
+    crops: List of N bool masks cropped to their boxes.
+    tiles: [N, (y1, x1, y2, x2)] tile of each detection.
+    shape: (height, width) of the mosaic.
+    iou_threshold: Detections of the same class from different tiles with
+        a mask IoU over this in the overlap of their tiles are duplicates.
+
+    Returns the indices of the kept detections, by decreasing rank: not
+    cut by a tile edge first, then by score.
+    """
+    n = boxes.shape[0]
+    if n == 0:
+        return np.zeros([0], dtype=np.int64)
+    # Candidate pairs: boxes that intersect, of different tiles, same class
+    ids1, ids2 = utils.BoxGridIndex(boxes).query(boxes)
+    tile_window = np.concatenate([np.maximum(tiles[ids1, :2], tiles[ids2, :2]),
+                                  np.minimum(tiles[ids1, 2:], tiles[ids2, 2:])], axis=1)
+    candidates = (ids1 < ids2) & (class_ids[ids1] == class_ids[ids2]) & \
+        np.any(tiles[ids1] != tiles[ids2], axis=1)
+    duplicates = [[] for _ in range(n)]
+    for i, j, window in zip(ids1[candidates], ids2[candidates], tile_window[candidates]):
+        if overlap_mask_iou(crops[i], boxes[i], crops[j], boxes[j], window) > iou_threshold:
+            duplicates[i].append(j)
+            duplicates[j].append(i)
+
+    # Greedy suppression by rank
+    cut = cut_by_tile(boxes, tiles, shape)
+    order = np.lexsort((-scores, cut))
+    suppressed = np.zeros([n], dtype=bool)
+    keep = []
+    for i in order:
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        suppressed[duplicates[i]] = True
+    return np.array(keep, dtype=np.int64)
+
+
+def paint_label_map(labels, boxes, crops):
+    """Paints masks in a label map with the index of each mask plus one.
+    The pixels of overlapping masks go to the first one.
+
+    labels: [height, width] int array or memory map, 0 for the background.
+    boxes: [N, (y1, x1, y2, x2)] boxes of the crops.
+    crops: List of N bool masks cropped to their boxes.
+    """
+    for i, (box, crop) in enumerate(zip(boxes, crops)):
+        y1, x1, y2, x2 = box
+        region = labels[y1:y2, x1:x2]
+        region[crop & (region == 0)] = i + 1
+    return labels
+
+
+############################################################
+#  Mosaic Detector
+############################################################
+
+class MosaicDetector(object):
+    """Runs a MaskRCNN inference model on a whole mosaic by overlapping
+    tiles, and stitches the detections.
+
+    model: MaskRCNN model in inference mode. The tiles run in batches of
+        its BATCH_SIZE, see the batch_size argument of MaskRCNN.
+    tile_size: Optional. Side of the tiles. Defaults to IMAGE_MAX_DIM.
+    overlap: Overlap of neighbor tiles, in pixels. Objects up to this size
+        are fully inside at least one tile.
+    iou_threshold: Mask IoU of duplicate detections, see
+        merge_tile_detections().
+    stretch: Stretch the tiles, see tile_image().
+    """
+
+    def __init__(self, model, tile_size=None, overlap=64, iou_threshold=0.5,
+                 stretch=True):
+        self.model = model
+        self.tile_size = tile_size or model.config.IMAGE_MAX_DIM
+        self.overlap = overlap
+        self.iou_threshold = iou_threshold
+        self.stretch = stretch
+
+    def detect(self, data, label_map_path=None, mask_format="crop", verbose=1):
+        """Detects the objects of a mosaic.
+
+        data: [height, width] mosaic.
+        label_map_path: Optional. File of the label map, an int32 memory
+            map of the mosaic size. If None, the label map is in memory.
+        mask_format: "crop" or "rle", see utils.MASK_FORMATS. Full size
+            masks of a mosaic don't fit in memory.
+
+        Returns a dict like MaskRCNN.detect(), in mosaic coordinates, with
+        the label map in "labels".
+        """
+        assert mask_format in ["crop", "rle"], "Unsupported mask format {}".format(mask_format)
+        shape = data.shape[:2]
+        tiles = tile_grid(shape, self.tile_size, self.overlap)
+        if verbose:
+            logger.info("Detecting objects in mosaic %d x %d with %d tiles of %d pix ...",
+                        shape[1], shape[0], tiles.shape[0], self.tile_size)
+
+        # Detect on the tiles, in batches, while the next tiles are prepared
+        images = (tile_image(data, t, self.stretch) for t in tiles)
+        boxes, class_ids, scores, crops, tile_ids = [], [], [], [], []
+        for t, r in enumerate(self.model.detect_iter(images, mask_format="crop")):
+            offset = np.concatenate([tiles[t, :2], tiles[t, :2]])
+            boxes.append(r["rois"].astype(np.int64) + offset)
+            class_ids.append(r["class_ids"])
+            scores.append(r["scores"])
+            crops.extend(r["masks"])
+            tile_ids.append(np.full([len(r["class_ids"])], t))
+            if verbose and (t + 1) % 100 == 0:
+                logger.info("Processed %d/%d tiles ...", t + 1, tiles.shape[0])
+        boxes = np.concatenate(boxes).reshape([-1, 4])
+        class_ids = np.concatenate(class_ids).astype(np.int32)
+        scores = np.concatenate(scores).astype(np.float32)
+        tile_ids = np.concatenate(tile_ids).astype(np.int64)
+
+        # Merge the duplicates of the tile overlaps
+        keep = merge_tile_detections(boxes, class_ids, scores, crops, tiles[tile_ids],
+                                     shape, self.iou_threshold)
+        if verbose:
+            logger.info("%d detections, %d after merging the tile overlaps",
+                        boxes.shape[0], keep.shape[0])
+        boxes = boxes[keep]
+        crops = [crops[i] for i in keep]
+
+        # Label map
+        if label_map_path:
+            labels = np.memmap(label_map_path, dtype=np.int32, mode="w+", shape=shape)
+        else:
+            labels = np.zeros(shape, dtype=np.int32)
+        paint_label_map(labels, boxes, crops)
+        if isinstance(labels, np.memmap):
+            labels.flush()
+
+        if mask_format == "rle":
+            crops = [utils.crop_to_rle(c, b, shape) for c, b in zip(crops, boxes)]
+        return {
+            "rois": boxes,
+            "class_ids": class_ids[keep],
+            "scores": scores[keep],
+            "masks": crops,
+            "labels": labels,
+        }
@@ -0,0 +1,219 @@
+"""
+Mask R-CNN
+Non-maximum suppression of boxes in NumPy.
+
+The graph does its NMS with tf.image.non_max_suppression(). These are the
+NumPy counterparts, for the post-processing done outside of the graph,
+like merging the detections of overlapping tiles:
+
+    keep = nms.non_max_suppression(boxes, scores, 0.3, max_output=100)
+    keep = nms.batched_nms(boxes, scores, class_ids, 0.3)
+    keep, scores = nms.soft_nms(boxes, scores, sigma=0.5)
+
+Boxes are [N, (y1, x1, y2, x2)], with (y2, x2) outside of the box, in
+pixel or normalized coordinates: IoUs don't depend on the scale. All the
+functions return indices into the boxes, highest scores first.
+
+Two implementations give the same boxes:
+- nms_matrix() computes the IoUs of all pairs by chunks and keeps their
+  upper triangle above the threshold, [N, N] bools. Fastest for up to
+  a few thousand boxes.
+- nms_sweep() computes the IoUs of one kept box at a time with the boxes
+  not suppressed yet. Memory is O(N).
+non_max_suppression() picks one based on the number of boxes.
+"""
+
+import numpy as np
+
+from mrcnn import utils
+
+
+# Above this number of boxes, non_max_suppression() uses nms_sweep() as
+# the [N, N] matrix of nms_matrix() gets too big to pay off
+NMS_MATRIX_MAX_BOXES = 2048
+
+
+############################################################
+#  Non-Maximum Suppression
+############################################################
+
+def _sort_by_score(boxes, scores):
+    """Returns the boxes as float32 and the indices that sort them by
+    decreasing score. Equal scores keep the order of the boxes."""
+    boxes = np.asarray(boxes, dtype=np.float32).reshape([-1, 4])
+    order = np.argsort(-np.asarray(scores), kind="mergesort")
+    return boxes, order
+
+
+def _iou(coordinates, areas, i, others):
+    """IoUs of the box i with other boxes, with the operations of
+    utils.compute_overlaps(boxes[i:i + 1], boxes[others]) so the values
+    are identical.
+    coordinates: (y1, x1, y2, x2) float32 arrays of the boxes.
+    areas: float32 areas of the boxes.
+    """
+    y1, x1, y2, x2 = coordinates
+    h = np.minimum(y2[i], y2[others])
+    h -= np.maximum(y1[i], y1[others])
+    np.maximum(h, 0, out=h)
+    w = np.minimum(x2[i], x2[others])
+    w -= np.maximum(x1[i], x1[others])
+    np.maximum(w, 0, out=w)
+    h *= w
+    return h / (areas[i] + areas[others] - h)
+
+
+def suppression_matrix(boxes, threshold, chunk_bytes=None):
+    """Returns the [N, N] bool matrix of the box pairs (i, j) with j > i and
+    an IoU over the threshold: box i suppresses box j if it's kept. The IoUs
+    are computed by chunks of rows, on the upper triangle only, so only the
+    bool matrix is fully allocated.
+
+    boxes: [N, (y1, x1, y2, x2)] float32, sorted by decreasing score.
+    chunk_bytes: Optional. Bound on the size of the IoUs of a chunk.
+        Defaults to utils.OVERLAPS_CHUNK_BYTES.
+    """
+    n = boxes.shape[0]
+    suppresses = np.zeros([n, n], dtype=bool)
+    chunk_bytes = chunk_bytes or utils.OVERLAPS_CHUNK_BYTES
+    rows = max(1, chunk_bytes // (4 * max(n, 1)))
+    for start in range(0, n, rows):
+        stop = min(start + rows, n)
+        iou = utils.compute_overlaps(boxes[start:stop], boxes[start:],
+                                     chunk_bytes=chunk_bytes)
+        suppresses[start:stop, start:] = np.triu(iou > threshold, k=1)
+    return suppresses
+
+
+def nms_matrix(boxes, scores, threshold, max_output=None):
+    """Non-maximum suppression with the precomputed suppression matrix of
+    the boxes, see suppression_matrix().
+
+    boxes: [N, (y1, x1, y2, x2)].
+    scores: [N] box scores.
+    threshold: Boxes with an IoU over this value with a higher scoring
+        kept box are suppressed.
+    max_output: Optional. Maximum number of boxes to keep.
+
+    Returns the int32 indices of the kept boxes, highest scores first.
+    """
+    boxes, order = _sort_by_score(boxes, scores)
+    suppresses = suppression_matrix(boxes[order], threshold)
+    max_output = max_output or order.shape[0]
+    suppressed = np.zeros([order.shape[0]], dtype=bool)
+    keep = []
+    for i in range(order.shape[0]):
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        if len(keep) >= max_output:
+            break
+        suppressed |= suppresses[i]
+    return order[keep].astype(np.int32)
+
+
+def nms_sweep(boxes, scores, threshold, max_output=None):
+    """Non-maximum suppression sweeping the boxes by decreasing score. Each
+    kept box is compared with the remaining candidates only, which are then
+    filtered with a bool mask of the suppressed ones. Same arguments and
+    results as nms_matrix(), with O(N) memory.
+    """
+    boxes, order = _sort_by_score(boxes, scores)
+    sorted_boxes = boxes[order]
+    coordinates = [np.ascontiguousarray(c) for c in sorted_boxes.T]
+    areas = (coordinates[2] - coordinates[0]) * (coordinates[3] - coordinates[1])
+    max_output = max_output or order.shape[0]
+    candidates = np.arange(order.shape[0])
+    keep = []
+    while candidates.shape[0] > 0 and len(keep) < max_output:
+        i = candidates[0]
+        keep.append(i)
+        candidates = candidates[1:]
+        suppressed = _iou(coordinates, areas, i, candidates) > threshold
+        candidates = candidates[~suppressed]
+    return order[keep].astype(np.int32)
+
+
+def non_max_suppression(boxes, scores, threshold, max_output=None):
+    """Performs non-maximum suppression and returns indices of kept boxes,
+    highest scores first. Uses nms_matrix() for up to NMS_MATRIX_MAX_BOXES
+    boxes and nms_sweep() above.
+
+    boxes: [N, (y1, x1, y2, x2)]. Notice that (y2, x2) lays outside the box.
+    scores: 1-D array of box scores.
+    threshold: Float. IoU threshold to use for filtering.
+    max_output: Optional. Maximum number of boxes to keep.
+    """
+    if len(scores) <= NMS_MATRIX_MAX_BOXES:
+        return nms_matrix(boxes, scores, threshold, max_output)
+    return nms_sweep(boxes, scores, threshold, max_output)
+
+
+def batched_nms(boxes, scores, class_ids, threshold, max_output=None):
+    """Per class non-maximum suppression, all classes at once. The boxes of
+    each class are shifted by a class specific offset larger than the extent
+    of all the boxes, so boxes of different classes never overlap.
+
+    class_ids: [N] int class ID of each box.
+    Other arguments as in non_max_suppression(). max_output caps the total
+    number of boxes, not the number per class.
+
+    Returns the int32 indices of the kept boxes, highest scores first.
+    """
+    boxes = np.asarray(boxes, dtype=np.float32).reshape([-1, 4])
+    if boxes.shape[0] == 0:
+        return np.zeros([0], dtype=np.int32)
+    # Same offset on y and x. The extent includes the origin so that the
+    # shifted boxes of two classes can't touch.
+    extent = max(np.abs(boxes).max(), 1) * 2 + 1
+    _, classes = np.unique(class_ids, return_inverse=True)
+    offsets = classes.reshape([-1, 1]).astype(np.float32) * extent
+    return non_max_suppression(boxes + offsets, scores, threshold, max_output)
+
+
+def soft_nms(boxes, scores, sigma=0.5, threshold=0.3, score_threshold=0.001,
+             method="gaussian", max_output=None):
+    """Soft-NMS: instead of suppressing the boxes that overlap a kept box,
+    decays their scores, and drops them once their score falls below
+    score_threshold.
+
+    boxes: [N, (y1, x1, y2, x2)].
+    scores: [N] box scores.
+    sigma: Decay of the gaussian method: scores are multiplied by
+        exp(-iou^2 / sigma).
+    threshold: IoU threshold of the linear method: the scores of boxes with
+        an IoU over it are multiplied by (1 - iou).
+    score_threshold: Boxes with a decayed score below this are dropped.
+    method: "gaussian" or "linear".
+    max_output: Optional. Maximum number of boxes to keep.
+
+    Returns:
+    keep: [K] int32 indices of the kept boxes, in the order they're picked.
+    scores: [K] float32 decayed scores of the kept boxes.
+    """
+    assert method in ["gaussian", "linear"], "Unknown soft-NMS method {}".format(method)
+    boxes = np.asarray(boxes, dtype=np.float32).reshape([-1, 4])
+    scores = np.array(scores, dtype=np.float32)
+    coordinates = [np.ascontiguousarray(c) for c in boxes.T]
+    areas = (coordinates[2] - coordinates[0]) * (coordinates[3] - coordinates[1])
+    max_output = max_output or boxes.shape[0]
+    candidates = np.flatnonzero(scores >= score_threshold)
+    keep = []
+    keep_scores = []
+    while candidates.shape[0] > 0 and len(keep) < max_output:
+        # Pick the highest score and decay the others
+        top = np.argmax(scores[candidates])
+        i = candidates[top]
+        keep.append(i)
+        keep_scores.append(scores[i])
+        candidates = np.delete(candidates, top)
+        if candidates.shape[0] == 0:
+            break
+        iou = _iou(coordinates, areas, i, candidates)
+        if method == "gaussian":
+            decay = np.exp(-(iou * iou) / sigma)
+        else:
+            decay = np.where(iou > threshold, 1 - iou, 1)
+        scores[candidates] *= decay
+        candidates = candidates[scores[candidates] >= score_threshold]
+    return np.array(keep, dtype=np.int32), np.array(keep_scores, dtype=np.float32)
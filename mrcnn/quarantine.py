@@ -0,0 +1,182 @@
+"""
+Mask R-CNN
+Quarantine of the samples that fail to load.
+
+A corrupt FITS file raises in load_image_gt() every time it's drawn, and
+data_generator() gives up after a few errors. A Quarantine records each
+failing sample, with the class of the error, in a file so that later
+epochs and later runs skip it instead of failing on it again.
+
+The file is in JSON lines format, one record per failing sample:
+
+    {"key": "/data/img_0042.fits", "error": "OSError", "message": "...", "time": "..."}
+
+Records are appended with a single write, so the generator workers forked
+by fit_generator() can share the file. A worker doesn't see the samples
+quarantined by the others until the file is loaded again, so a bad sample
+can fail once per worker before it's skipped everywhere.
+
+validate_dataset() loads every sample of a dataset in parallel and
+quarantines the failing ones before training starts:
+
+    quarantine = Quarantine(os.path.join(logs_dir, "quarantine.jsonl"))
+    validate_dataset(dataset, config, quarantine, workers=8)
+"""
+
+import os
+import json
+import time
+import logging
+import multiprocessing
+
+## Get logger
+logger = logging.getLogger(__name__)
+
+
+############################################################
+#  Quarantine
+############################################################
+
+def sample_key(dataset, image_id):
+    """Returns the key that identifies a sample across runs: the path of the
+    image if it has one, otherwise its source and ID. Image IDs of the
+    Dataset class are indices that can change between runs."""
+    info = dataset.image_info[image_id]
+    if info.get("path"):
+        return str(info["path"])
+    return "{}:{}".format(info["source"], info["id"])
+
+
+class Quarantine(object):
+    """Registry of samples that failed to load.
+
+    path: Optional. The file where the records are kept. It's loaded if it
+        exists. If None, the records are kept in memory only.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.records = {}
+        self.load()
+
+    def load(self):
+        """Reads the records of the file, including the ones added by other
+        processes since it was last read. Does nothing if there's no file."""
+        if not self.path or not os.path.exists(self.path):
+            return
+        with open(self.path, "r") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Partial line of an interrupted write
+                    logger.warning("Skipping invalid quarantine record: %s", line)
+                    continue
+                self.records[record["key"]] = record
+
+    def add(self, key, error, message=None):
+        """Quarantines a sample.
+        key: The key of the sample. See sample_key().
+        error: The exception raised by the sample, or the name of its class.
+        message: The error message, if error is a class name.
+        """
+        if isinstance(error, BaseException):
+            error, message = type(error).__name__, str(error)
+        record = {
+            "key": key,
+            "error": error,
+            "message": message or "",
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        self.records[key] = record
+        if self.path:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        return record
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def keys(self):
+        """Returns the keys of the quarantined samples."""
+        return list(self.records.keys())
+
+
+############################################################
+#  Dataset validation
+############################################################
+
+# Dataset and config of validate_dataset(), inherited by the forked workers
+_validation = None
+
+
+def _validate_sample(image_id):
+    """Loads a sample. Returns (image_id, error class name, message), with
+    None for the error if the sample loads. Exceptions are not returned as
+    they're not all picklable."""
+    # Import here, model.py imports this module
+    from mrcnn.model import load_image_gt
+    dataset, config = _validation
+    try:
+        load_image_gt(dataset, config, image_id,
+                      use_mini_mask=config.USE_MINI_MASK)
+    except Exception as e:
+        return image_id, type(e).__name__, str(e)
+    return image_id, None, None
+
+
+def validate_dataset(dataset, config, quarantine, workers=None, verbose=1):
+    """Loads every sample of a dataset, as the data generator does without
+    augmentation, and quarantines the ones that fail. Samples already in
+    quarantine are not loaded again.
+
+    dataset: A prepared Dataset object.
+    config: The model config object.
+    quarantine: The Quarantine to add the failing samples to.
+    workers: Number of worker processes. Defaults to the number of CPUs.
+        0 loads the samples in this process.
+
+    Returns the list of the image IDs that failed.
+    """
+    global _validation
+    image_ids = [i for i in dataset.image_ids
+                 if sample_key(dataset, i) not in quarantine]
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    _validation = (dataset, config)
+    failed = []
+    pool = None
+    try:
+        if workers > 0:
+            pool = multiprocessing.Pool(workers)
+            results = pool.imap_unordered(_validate_sample, image_ids, chunksize=8)
+        else:
+            results = map(_validate_sample, image_ids)
+        for n, (image_id, error, message) in enumerate(results):
+            if error is not None:
+                record = quarantine.add(sample_key(dataset, image_id), error, message)
+                failed.append(image_id)
+                logger.warning("Quarantined %s (%s: %s)", record["key"],
+                               record["error"], record["message"])
+            if verbose and (n + 1) % 1000 == 0:
+                logger.info("Validated %d/%d samples, %d failed",
+                            n + 1, len(image_ids), len(failed))
+    finally:
+        if pool is not None:
+            pool.terminate()
+        _validation = None
+
+    if verbose:
+        logger.info("Validated %d samples, %d failed, %d in quarantine",
+                    len(image_ids), len(failed), len(quarantine))
+    return failed
@@ -0,0 +1,350 @@
+"""
+Mask R-CNN
+TFRecord export of the training data and tf.data input pipeline.
+
+write_tfrecords() runs load_image_gt() without augmentation on every
+sample of a dataset, and writes the image, image meta, class IDs, boxes
+and masks to sharded, GZIP compressed TFRecord files. FITS reading,
+zscale and resizing are then done once, instead of in every epoch.
+
+TFRecordInput reads them back with tf.data: parallel decoding, random flips
+and 90 degree rotations in the graph, RPN targets with tf.py_func() and
+prefetching. MaskRCNN.train() accepts it in place of a Dataset:
+
+    # Once
+    write_tfrecords(dataset_train, config, "/data/train")
+    # Then
+    train_input = TFRecordInput("/data/train-*.tfrecord", config)
+    model.train(train_input, val_input, ...)
+
+Keras 2.2 doesn't take tf.data datasets as model inputs, so the batches are
+run in the Keras session and fed to fit_generator() from a thread. Decoding,
+augmentation and batching run in the tf.data threads, and no data is
+pickled between processes.
+"""
+
+import glob
+import math
+import logging
+import multiprocessing
+import numpy as np
+import tensorflow as tf
+import keras.backend as K
+
+from mrcnn import utils
+from mrcnn import model as modellib
+from mrcnn.quarantine import sample_key
+
+## Get logger
+logger = logging.getLogger(__name__)
+
+
+############################################################
+#  Serialization
+############################################################
+
+def _bytes_feature(value):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def _int64_feature(values):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=[int(v) for v in values]))
+
+
+def _float_feature(values):
+    return tf.train.Feature(float_list=tf.train.FloatList(value=[float(v) for v in values]))
+
+
+def serialize_sample(image, image_meta, class_ids, boxes, masks):
+    """Serializes the outputs of load_image_gt() to a tf.train.Example.
+    The image is stored as float32 and the masks as packed bits.
+
+    Returns the serialized example (bytes).
+    """
+    image = np.ascontiguousarray(image, dtype=np.float32)
+    masks = np.asarray(masks, dtype=bool)
+    features = {
+        "image": _bytes_feature(image.tobytes()),
+        "image/shape": _int64_feature(image.shape),
+        "image_meta": _float_feature(image_meta),
+        "class_ids": _int64_feature(class_ids),
+        "boxes": _int64_feature(np.ravel(boxes)),
+        "masks": _bytes_feature(np.packbits(masks.ravel()).tobytes()),
+        "masks/shape": _int64_feature(masks.shape),
+    }
+    example = tf.train.Example(features=tf.train.Features(feature=features))
+    return example.SerializeToString()
+
+
+def parse_sample(serialized, config):
+    """Parses a serialized sample in the graph. Returns a dict of tensors:
+    image [height, width, channels] float32, image_meta, class_ids
+    [instance count] int32, boxes [instance count, 4] int32 and masks
+    [height, width, instance count] bool.
+    """
+    features = tf.parse_single_example(serialized, {
+        "image": tf.FixedLenFeature([], tf.string),
+        "image/shape": tf.FixedLenFeature([3], tf.int64),
+        "image_meta": tf.FixedLenFeature([config.IMAGE_META_SIZE], tf.float32),
+        "class_ids": tf.VarLenFeature(tf.int64),
+        "boxes": tf.VarLenFeature(tf.int64),
+        "masks": tf.FixedLenFeature([], tf.string),
+        "masks/shape": tf.FixedLenFeature([3], tf.int64),
+    })
+    image = tf.reshape(tf.decode_raw(features["image"], tf.float32),
+                       tf.cast(features["image/shape"], tf.int32))
+    image.set_shape([None, None, config.IMAGE_SHAPE[2]])
+    class_ids = tf.cast(tf.sparse_tensor_to_dense(features["class_ids"]), tf.int32)
+    boxes = tf.reshape(tf.cast(tf.sparse_tensor_to_dense(features["boxes"]), tf.int32), [-1, 4])
+
+    # Unpack the mask bits, most significant first like np.packbits()
+    mask_shape = tf.cast(features["masks/shape"], tf.int32)
+    packed = tf.decode_raw(features["masks"], tf.uint8)
+    bits = tf.bitwise.bitwise_and(tf.expand_dims(packed, -1),
+                                  tf.constant([128, 64, 32, 16, 8, 4, 2, 1], dtype=tf.uint8))
+    bits = tf.reshape(tf.greater(bits, 0), [-1])
+    masks = tf.reshape(bits[:tf.reduce_prod(mask_shape)], mask_shape)
+    return {
+        "image": image,
+        "image_meta": features["image_meta"],
+        "class_ids": class_ids,
+        "boxes": boxes,
+        "masks": masks,
+    }
+
+
+############################################################
+#  Export
+############################################################
+
+# Dataset and config of write_tfrecords(), inherited by the forked workers
+_export = None
+
+
+def _export_sample(image_id):
+    """Loads and serializes a sample. Returns (image_id, serialized example,
+    error class name, message), with None for the example if it fails."""
+    dataset, config = _export
+    try:
+        image, image_meta, class_ids, boxes, masks = modellib.load_image_gt(
+            dataset, config, image_id, use_mini_mask=config.USE_MINI_MASK)
+        if not np.any(class_ids > 0):
+            # Skipped by the data generator too
+            return image_id, None, None, None
+        return image_id, serialize_sample(image, image_meta, class_ids, boxes, masks), None, None
+    except Exception as e:
+        return image_id, None, type(e).__name__, str(e)
+
+
+def shard_path(prefix, shard, num_shards):
+    """Returns the path of a shard of write_tfrecords()."""
+    return "{}-{:05d}-of-{:05d}.tfrecord".format(prefix, shard, num_shards)
+
+
+def write_tfrecords(dataset, config, prefix, num_shards=None, workers=None,
+                    quarantine=None, verbose=1):
+    """Writes the samples of a dataset to sharded TFRecord files, as
+    returned by load_image_gt() without augmentation. Masks are mini masks
+    if config.USE_MINI_MASK is True, the reading config must match.
+
+    dataset: A prepared Dataset object.
+    config: The model config object.
+    prefix: Path prefix of the files. See shard_path().
+    num_shards: Number of files. Default: one per 1000 samples.
+    workers: Number of worker processes loading the samples. Defaults to
+        the number of CPUs. 0 loads the samples in this process.
+    quarantine: Optional. A Quarantine. Its samples are not exported, and
+        samples that fail to load are added to it.
+
+    Returns the list of the files written.
+    """
+    global _export
+    image_ids = [i for i in dataset.image_ids
+                 if quarantine is None or sample_key(dataset, i) not in quarantine]
+    if num_shards is None:
+        num_shards = max(1, int(math.ceil(len(image_ids) / 1000.)))
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    paths = [shard_path(prefix, i, num_shards) for i in range(num_shards)]
+    options = tf.python_io.TFRecordOptions(tf.python_io.TFRecordCompressionType.GZIP)
+    writers = [tf.python_io.TFRecordWriter(p, options=options) for p in paths]
+    _export = (dataset, config)
+    pool = None
+    written = 0
+    try:
+        if workers > 0:
+            pool = multiprocessing.Pool(workers)
+            results = pool.imap(_export_sample, image_ids, chunksize=4)
+        else:
+            results = map(_export_sample, image_ids)
+        for image_id, example, error, message in results:
+            if example is not None:
+                # Round robin over the shards
+                writers[written % num_shards].write(example)
+                written += 1
+            elif error is not None:
+                logger.warning("Error exporting image %s (%s: %s)",
+                               dataset.image_info[image_id], error, message)
+                if quarantine is not None:
+                    quarantine.add(sample_key(dataset, image_id), error, message)
+    finally:
+        if pool is not None:
+            pool.terminate()
+        for w in writers:
+            w.close()
+        _export = None
+
+    if verbose:
+        logger.info("Wrote %d of %d samples to %d files %s",
+                    written, len(image_ids), num_shards, shard_path(prefix, 0, num_shards))
+    return paths
+
+
+############################################################
+#  tf.data input pipeline
+############################################################
+
+def _dihedral_transform(image, masks, boxes):
+    """Applies a random flip or 90 degree rotation to a sample in the graph,
+    like augment.DihedralAugmentation with the default uniform transforms.
+    The transpose is applied first, and only to square images. Mini masks
+    are transformed like full size masks, being crops of the boxes."""
+    h = tf.shape(image)[0]
+    w = tf.shape(image)[1]
+
+    transpose = tf.logical_and(tf.random_uniform([]) < 0.5, tf.equal(h, w))
+    image, masks, boxes = tf.cond(
+        transpose,
+        lambda: (tf.transpose(image, [1, 0, 2]), tf.transpose(masks, [1, 0, 2]),
+                 tf.gather(boxes, [1, 0, 3, 2], axis=1)),
+        lambda: (image, masks, boxes))
+
+    y1, x1, y2, x2 = tf.unstack(boxes, axis=1)
+    flip_ud = tf.random_uniform([]) < 0.5
+    image, masks, y1, y2 = tf.cond(
+        flip_ud,
+        lambda: (tf.reverse(image, [0]), tf.reverse(masks, [0]), h - y2, h - y1),
+        lambda: (image, masks, y1, y2))
+    flip_lr = tf.random_uniform([]) < 0.5
+    image, masks, x1, x2 = tf.cond(
+        flip_lr,
+        lambda: (tf.reverse(image, [1]), tf.reverse(masks, [1]), w - x2, w - x1),
+        lambda: (image, masks, x1, x2))
+    return image, masks, tf.stack([y1, x1, y2, x2], axis=1)
+
+
+class TFRecordInput(object):
+    """tf.data input pipeline over the files written by write_tfrecords().
+    Gives the same batches as data_generator() with a DihedralAugmentation.
+
+    filenames: List of TFRecord files, or a glob pattern.
+    config: The model config object.
+    shuffle: If True, shuffles the files and the samples.
+    augmentation: If True, applies random flips and 90 degree rotations.
+    shuffle_buffer: Number of samples in the shuffle buffer.
+    num_parallel_calls: Number of samples decoded in parallel. Default:
+        tuned by tf.data.
+    """
+
+    def __init__(self, filenames, config, shuffle=True, augmentation=True,
+                 shuffle_buffer=256, num_parallel_calls=None):
+        if isinstance(filenames, str):
+            filenames = sorted(glob.glob(filenames))
+        assert len(filenames) > 0, "No TFRecord files"
+        self.filenames = list(filenames)
+        self.config = config
+        self.shuffle = shuffle
+        self.augmentation = augmentation
+        self.shuffle_buffer = shuffle_buffer
+        self.num_parallel_calls = num_parallel_calls or tf.data.experimental.AUTOTUNE
+
+        # Images of the records all have the shape config.IMAGE_SHAPE
+        assert not modellib.variable_image_shapes(config),\
+            "TFRecord input needs a fixed image shape. Use IMAGE_RESIZE_MODE square or crop."
+
+        # Anchors, as in data_generator()
+        self.anchors = modellib.pyramid_anchors(config, config.IMAGE_SHAPE)
+        self.anchor_index = utils.AnchorGridIndex(self.anchors)
+
+    def rpn_targets(self, image_shape, class_ids, boxes):
+        """Builds the RPN targets of a sample, in tf.py_func()."""
+        rpn_match, rpn_bbox = modellib.build_rpn_targets(
+            tuple(image_shape), self.anchors, class_ids, boxes, self.config,
+            anchor_index=self.anchor_index)
+        return rpn_match.astype(np.int32), rpn_bbox.astype(np.float32)
+
+    def targets(self, sample):
+        """Builds the training inputs of a sample, as data_generator() does."""
+        config = self.config
+        image = sample["image"]
+        class_ids = sample["class_ids"]
+        boxes = sample["boxes"]
+        masks = sample["masks"]
+
+        rpn_match, rpn_bbox = tf.py_func(self.rpn_targets,
+                                         [tf.shape(image), class_ids, boxes],
+                                         [tf.int32, tf.float32], stateful=True)
+        rpn_match = tf.reshape(rpn_match, [self.anchors.shape[0], 1])
+        rpn_bbox = tf.reshape(rpn_bbox, [config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4])
+
+        # If more instances than fits in the array, sub-sample from them.
+        ids = tf.random_shuffle(tf.range(tf.shape(class_ids)[0]))[:config.MAX_GT_INSTANCES]
+        class_ids = tf.gather(class_ids, ids)
+        boxes = tf.gather(boxes, ids)
+        masks = tf.gather(masks, ids, axis=2)
+
+        # Zero padding to MAX_GT_INSTANCES
+        padding = config.MAX_GT_INSTANCES - tf.shape(class_ids)[0]
+        class_ids = tf.pad(class_ids, [[0, padding]])
+        boxes = tf.pad(boxes, [[0, padding], [0, 0]])
+        masks = tf.pad(masks, [[0, 0], [0, 0], [0, padding]])
+        mask_shape = config.MINI_MASK_SHAPE if config.USE_MINI_MASK else [None, None]
+        class_ids.set_shape([config.MAX_GT_INSTANCES])
+        boxes.set_shape([config.MAX_GT_INSTANCES, 4])
+        masks.set_shape(list(mask_shape) + [config.MAX_GT_INSTANCES])
+
+        # Mold the image
+        image = tf.cast(image, tf.float32) - tf.constant(config.MEAN_PIXEL, dtype=tf.float32)
+        return image, sample["image_meta"], rpn_match, rpn_bbox, class_ids, boxes, masks
+
+    def dataset(self, batch_size):
+        """Returns a tf.data.Dataset of batches of the model inputs: images,
+        image_meta, rpn_match, rpn_bbox, gt_class_ids, gt_boxes, gt_masks.
+        It repeats indefinitely."""
+        files = tf.data.Dataset.from_tensor_slices(self.filenames)
+        if self.shuffle:
+            files = files.shuffle(len(self.filenames))
+        files = files.repeat()
+        dataset = files.apply(tf.data.experimental.parallel_interleave(
+            lambda f: tf.data.TFRecordDataset(f, compression_type="GZIP"),
+            cycle_length=min(len(self.filenames), 8), sloppy=self.shuffle))
+        if self.shuffle:
+            dataset = dataset.shuffle(self.shuffle_buffer)
+
+        def prepare(serialized):
+            sample = parse_sample(serialized, self.config)
+            if self.augmentation:
+                sample["image"], sample["masks"], sample["boxes"] = _dihedral_transform(
+                    sample["image"], sample["masks"], sample["boxes"])
+            return self.targets(sample)
+
+        dataset = dataset.map(prepare, num_parallel_calls=self.num_parallel_calls)
+        dataset = dataset.batch(batch_size, drop_remainder=True)
+        return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+    def generator(self, batch_size):
+        """Returns a Python generator of batches for fit_generator(), like
+        data_generator(). The pipeline is built in the graph of the Keras
+        session. Run it in a thread (use_multiprocessing=False): it can't be
+        used in a forked process."""
+        session = K.get_session()
+        with session.graph.as_default():
+            iterator = self.dataset(batch_size).make_initializable_iterator()
+            next_batch = iterator.get_next()
+        session.run(iterator.initializer)
+
+        def batches():
+            while True:
+                yield list(session.run(next_batch)), []
+        return batches()
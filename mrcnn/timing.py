@@ -0,0 +1,189 @@
+"""
+Mask R-CNN
+Per-stage timing of the data pipeline.
+
+A StageTimer accumulates the wall time and the bytes of the arrays produced
+by each stage of load_image_gt() and data_generator(): FITS reading, zscale,
+resizing, augmentation, RPN targets, batch assembly, ...
+
+The active timer is process wide. By default it's a NullTimer that records
+nothing, so instrumented code costs nothing when timing is off. Training
+enables it when Config.PROFILE_DATA_GENERATOR is True, and the
+StageTimingCallback in model.py writes the results to TensorBoard and to a
+CSV file at the end of each epoch.
+
+Usage:
+
+    with timing.get_timer().stage("resize_image") as stage:
+        image = resize(image)
+        stage.add(image)
+"""
+
+import time
+import queue
+import logging
+import multiprocessing
+
+## Get logger
+logger = logging.getLogger(__name__)
+
+
+############################################################
+#  Timers
+############################################################
+
+class _Stage(object):
+    """Times one execution of a stage. Returned by StageTimer.stage()."""
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+        self.nbytes = 0
+        self.start = None
+
+    def add(self, *arrays):
+        """Counts the bytes of the arrays produced by the stage."""
+        for a in arrays:
+            self.nbytes += getattr(a, "nbytes", 0)
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.record(self.name, time.time() - self.start, self.nbytes)
+        return False
+
+
+class _NullStage(object):
+    """Stage that does nothing, for the NullTimer."""
+
+    def add(self, *arrays):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class NullTimer(object):
+    """Timer used when timing is off. Records nothing."""
+    enabled = False
+
+    def stage(self, name):
+        return _NULL_STAGE
+
+    def record(self, name, seconds, nbytes=0):
+        pass
+
+    def flush(self):
+        pass
+
+
+class StageTimer(object):
+    """Accumulates the number of calls, total and max wall time, and bytes
+    produced of each stage.
+
+    shared: If True, stats recorded in other processes (e.g. the Keras
+        generator workers forked by fit_generator()) are sent to this one
+        through a queue when they call flush(), and merged by collect().
+    """
+    enabled = True
+
+    def __init__(self, shared=False):
+        self.stats = {}
+        self.queue = multiprocessing.Queue() if shared else None
+        self.pid = multiprocessing.current_process().pid
+
+    def stage(self, name):
+        """Returns a context manager that times a stage."""
+        return _Stage(self, name)
+
+    def record(self, name, seconds, nbytes=0):
+        """Adds one execution of a stage."""
+        s = self.stats.get(name)
+        if s is None:
+            self.stats[name] = [1, seconds, seconds, nbytes]
+        else:
+            s[0] += 1
+            s[1] += seconds
+            s[2] = max(s[2], seconds)
+            s[3] += nbytes
+
+    def merge(self, stats):
+        """Adds stats of another timer."""
+        for name, (count, total, longest, nbytes) in stats.items():
+            s = self.stats.get(name)
+            if s is None:
+                self.stats[name] = [count, total, longest, nbytes]
+            else:
+                s[0] += count
+                s[1] += total
+                s[2] = max(s[2], longest)
+                s[3] += nbytes
+
+    def flush(self):
+        """Sends the stats recorded in a worker process to the main process.
+        Called by data_generator() after each batch. Does nothing in the
+        process that created the timer."""
+        if self.queue is None or not self.stats:
+            return
+        if multiprocessing.current_process().pid == self.pid:
+            return
+        self.queue.put(self.stats)
+        self.stats = {}
+
+    def collect(self):
+        """Merges the stats sent by worker processes so far."""
+        if self.queue is None:
+            return
+        while True:
+            try:
+                self.merge(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+    def summary(self):
+        """Collects and returns the stats as a list of dicts sorted by stage
+        name, with keys: stage, count, total_s, mean_ms, max_ms, mbytes."""
+        self.collect()
+        rows = []
+        for name in sorted(self.stats):
+            count, total, longest, nbytes = self.stats[name]
+            rows.append({
+                "stage": name,
+                "count": count,
+                "total_s": total,
+                "mean_ms": 1000. * total / count,
+                "max_ms": 1000. * longest,
+                "mbytes": nbytes / 2.**20,
+            })
+        return rows
+
+    def reset(self):
+        """Clears the stats."""
+        self.stats = {}
+
+
+############################################################
+#  Active timer
+############################################################
+
+_timer = NullTimer()
+
+
+def get_timer():
+    """Returns the active timer. A NullTimer if timing is off."""
+    return _timer
+
+
+def set_timer(timer):
+    """Sets the active timer. Pass None to turn timing off."""
+    global _timer
+    _timer = timer if timer is not None else NullTimer()
+    return _timer
@@ -12,9 +12,11 @@ import os
 import logging
 import math
 import random
+from collections import OrderedDict
 import numpy as np
 import tensorflow as tf
 import scipy
+import scipy.ndimage
 import skimage.color
 import skimage.io
 import skimage.transform
@@ -25,7 +27,6 @@ except ImportError:
 
 
 import shutil
-import warnings
 from distutils.version import LooseVersion
 
 
@@ -38,6 +39,8 @@ from astropy import wcs
 from astropy import units as u
 from astropy.visualization import ZScaleInterval
 
+from mrcnn import timing
+
 # URL from which to download the latest COCO trained weights
 COCO_MODEL_URL = "https://github.com/matterport/Mask_RCNN/releases/download/v2.0/mask_rcnn_coco.h5"
 
@@ -52,24 +55,20 @@ def extract_bboxes(mask):
 
     Returns: bbox array [num_instances, (y1, x1, y2, x2)].
     """
-    boxes = np.zeros([mask.shape[-1], 4], dtype=np.int32)
-    for i in range(mask.shape[-1]):
-        m = mask[:, :, i]
-        # Bounding box.
-        horizontal_indicies = np.where(np.any(m, axis=0))[0]
-        vertical_indicies = np.where(np.any(m, axis=1))[0]
-        if horizontal_indicies.shape[0]:
-            x1, x2 = horizontal_indicies[[0, -1]]
-            y1, y2 = vertical_indicies[[0, -1]]
-            # x2 and y2 should not be part of the box. Increment by 1.
-            x2 += 1
-            y2 += 1
-        else:
-            # No mask for this instance. Might happen due to
-            # resizing or cropping. Set bbox to zeros
-            x1, x2, y1, y2 = 0, 0, 0, 0
-        boxes[i] = np.array([y1, x1, y2, x2])
-    return boxes.astype(np.int32)
+    # Rows and columns that have mask pixels, for all instances at once
+    vertical = np.any(mask, axis=1)
+    horizontal = np.any(mask, axis=0)
+    y1 = np.argmax(vertical, axis=0)
+    x1 = np.argmax(horizontal, axis=0)
+    # x2 and y2 should not be part of the box. The index of the last pixel
+    # from the end gives the exclusive end directly.
+    y2 = vertical.shape[0] - np.argmax(vertical[::-1], axis=0)
+    x2 = horizontal.shape[0] - np.argmax(horizontal[::-1], axis=0)
+    boxes = np.stack([y1, x1, y2, x2], axis=1).astype(np.int32)
+    # No mask for this instance. Might happen due to
+    # resizing or cropping. Set bbox to zeros
+    boxes[~np.any(vertical, axis=0)] = 0
+    return boxes
 
 
 def compute_iou(box, boxes, box_area, boxes_area):
@@ -144,82 +143,226 @@ def get_iou(bb1, bb2):
     return iou
 
 
-def compute_overlaps(boxes1, boxes2):
+# Size of the temporary arrays of a row chunk of compute_overlaps(), in
+# bytes. Small enough for the chunk to stay in the CPU cache.
+OVERLAPS_CHUNK_BYTES = 2**20
+
+
+def compute_overlaps(boxes1, boxes2, chunk_bytes=None):
     """Computes IoU overlaps between two sets of boxes.
     boxes1, boxes2: [N, (y1, x1, y2, x2)].
+    chunk_bytes: Optional. Bound on the memory used in addition to the
+        result, in bytes. Defaults to OVERLAPS_CHUNK_BYTES.
 
-    For better performance, pass the largest set first and the smaller second.
+    Returns a float32 matrix [boxes1 count, boxes2 count]. It's computed by
+    chunks of rows of boxes1, so pass the largest set first and the
+    smaller second.
     """
+    boxes1 = np.asarray(boxes1, dtype=np.float32)
+    boxes2 = np.asarray(boxes2, dtype=np.float32)
     # Areas of anchors and GT boxes
     area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
     area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
 
     # Compute overlaps to generate matrix [boxes1 count, boxes2 count]
-    # Each cell contains the IoU value.
-    overlaps = np.zeros((boxes1.shape[0], boxes2.shape[0]))
-    for i in range(overlaps.shape[1]):
-        box2 = boxes2[i]
-        overlaps[:, i] = compute_iou(box2, boxes1, area2[i], area1)
+    # Each cell contains the IoU value. A chunk needs 3 temporary arrays
+    # of its size.
+    overlaps = np.empty((boxes1.shape[0], boxes2.shape[0]), dtype=np.float32)
+    chunk_bytes = chunk_bytes or OVERLAPS_CHUNK_BYTES
+    rows = max(1, chunk_bytes // (3 * 4 * max(boxes2.shape[0], 1)))
+    for start in range(0, boxes1.shape[0], rows):
+        b1 = boxes1[start:start + rows, np.newaxis]
+        # Intersection heights, widths and areas
+        h = np.minimum(b1[..., 2], boxes2[:, 2])
+        h -= np.maximum(b1[..., 0], boxes2[:, 0])
+        np.maximum(h, 0, out=h)
+        w = np.minimum(b1[..., 3], boxes2[:, 3])
+        w -= np.maximum(b1[..., 1], boxes2[:, 1])
+        np.maximum(w, 0, out=w)
+        h *= w
+        # IoU, with the union computed in the result
+        iou = overlaps[start:start + rows]
+        np.add(area1[start:start + rows, np.newaxis], area2, out=iou)
+        iou -= h
+        np.divide(h, iou, out=iou)
     return overlaps
 
 
-def compute_overlaps_masks(masks1, masks2):
+def pairwise_iou(boxes_a, boxes_b):
+    """Computes the IoU of every pair of boxes of two sets, in float64.
+    Vectorized get_iou() without its asserts: pairs that don't overlap,
+    and empty or inverted boxes, have an IoU of 0.
+
+    boxes_a: [A, (y1, x1, y2, x2)]
+    boxes_b: [B, (y1, x1, y2, x2)]
+
+    Returns: [A, B] IoU matrix.
+    """
+    a = np.asarray(boxes_a, dtype=np.float64).reshape([-1, 4])
+    b = np.asarray(boxes_b, dtype=np.float64).reshape([-1, 4])
+    return _box_iou(a[:, np.newaxis], b[np.newaxis])
+
+
+def _box_iou(a, b):
+    """IoU of the boxes a and b [..., (y1, x1, y2, x2)], broadcast
+    together. 0 for empty unions."""
+    area_a = np.maximum(a[..., 2] - a[..., 0], 0) * np.maximum(a[..., 3] - a[..., 1], 0)
+    area_b = np.maximum(b[..., 2] - b[..., 0], 0) * np.maximum(b[..., 3] - b[..., 1], 0)
+    h = np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0])
+    w = np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1])
+    intersection = np.maximum(h, 0) * np.maximum(w, 0)
+    union = area_a + area_b - intersection
+    iou = np.zeros_like(intersection)
+    np.divide(intersection, union, out=iou, where=union > 0)
+    return iou
+
+
+def match_best(ious, threshold):
+    """Matches each row of an IoU matrix to the column with the highest IoU
+    over the threshold. A column can be matched to several rows.
+
+    ious: [A, B] IoU matrix, see pairwise_iou().
+    threshold: Minimum IoU of a match, excluded.
+
+    Returns: [A] int column index of the match of each row, -1 if the row
+        has no IoU over the threshold. Ties go to the first column.
+    """
+    ious = np.asarray(ious)
+    if ious.shape[1] == 0:
+        return np.full([ious.shape[0]], -1, dtype=np.int64)
+    best = np.argmax(ious, axis=1)
+    return np.where(ious[np.arange(ious.shape[0]), best] > threshold, best, -1)
+
+
+def match_best_sparse(rows, cols, ious, num_rows, threshold):
+    """match_best() on the non-zero IoUs of a sparse IoU matrix, like the
+    ones returned by BoxGridIndex.overlaps().
+
+    rows, cols, ious: 1D arrays of the row, column and IoU of each pair.
+    num_rows: Number of rows of the matrix.
+
+    Returns: [num_rows] int column index of the match of each row, or -1.
+    """
+    keep = ious > threshold
+    rows, cols, ious = rows[keep], cols[keep], ious[keep]
+    # By row, then decreasing IoU, then column
+    order = np.lexsort((cols, -ious, rows))
+    rows, cols = rows[order], cols[order]
+    first = np.ones([rows.shape[0]], dtype=bool)
+    first[1:] = rows[1:] != rows[:-1]
+    best = np.full([num_rows], -1, dtype=np.int64)
+    best[rows[first]] = cols[first]
+    return best
+
+
+def match_one_to_one(ious, threshold):
+    """Greedy one-to-one matching: pairs are taken by decreasing IoU, skipping
+    the ones whose row or column is already matched.
+
+    ious: [A, B] IoU matrix, see pairwise_iou().
+    threshold: Minimum IoU of a match, excluded.
+
+    Returns (rows, cols), two int arrays of the matched pairs, by
+    decreasing IoU.
+    """
+    ious = np.asarray(ious)
+    rows, cols = np.nonzero(ious > threshold)
+    order = np.argsort(-ious[rows, cols], kind="mergesort")
+    rows, cols = rows[order], cols[order]
+    row_used = np.zeros([ious.shape[0]], dtype=bool)
+    col_used = np.zeros([ious.shape[1]], dtype=bool)
+    keep = np.zeros([rows.shape[0]], dtype=bool)
+    for k in range(rows.shape[0]):
+        if row_used[rows[k]] or col_used[cols[k]]:
+            continue
+        keep[k] = row_used[rows[k]] = col_used[cols[k]] = True
+    return rows[keep], cols[keep]
+
+
+# Number of set bits of each byte value
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.int64)
+
+
+def _pack_masks(masks, boxes):
+    """Bit-packs each mask inside its box. The box is widened to whole bytes
+    of the image width, so the packed masks of two instances are aligned and
+    can be ANDed byte for byte.
+
+    masks: [height, width, N] bool.
+    boxes: [N, (y1, x1, y2, x2)] from extract_bboxes().
+
+    Returns a list of [y2 - y1, bytes] uint8 arrays, and the [N, (c1, c2)]
+    range of bytes of each one.
+    """
+    byte_cols = np.stack([boxes[:, 1] // 8, (boxes[:, 3] + 7) // 8], axis=1)
+    packed = []
+    for i, (y1, x1, y2, x2) in enumerate(boxes):
+        c1, c2 = byte_cols[i]
+        packed.append(np.packbits(masks[y1:y2, c1 * 8:c2 * 8, i], axis=1))
+    return packed, byte_cols
+
+
+def compute_overlaps_masks(masks1, masks2, sparse=False):
     """Computes IoU overlaps between two sets of masks.
     masks1, masks2: [Height, Width, instances]
-    """
-    
-    # If either set of masks is empty return empty result
-    if masks1.shape[-1] == 0 or masks2.shape[-1] == 0:
-        return np.zeros((masks1.shape[-1], masks2.shape[-1]))
-    # flatten masks and compute their areas
-    masks1 = np.reshape(masks1 > .5, (-1, masks1.shape[-1])).astype(np.float32)
-    masks2 = np.reshape(masks2 > .5, (-1, masks2.shape[-1])).astype(np.float32)
-    area1 = np.sum(masks1, axis=0)
-    area2 = np.sum(masks2, axis=0)
-
-    # intersections and union
-    intersections = np.dot(masks1.T, masks2)
-    union = area1[:, None] + area2[None, :] - intersections
-    overlaps = intersections / union
+    sparse: If True, returns the overlapping pairs only.
 
+    Pairs are compared only if their bounding boxes intersect, and only in
+    the intersection, on masks bit-packed inside their boxes. Memory is
+    proportional to the size of the objects instead of the image.
+
+    Returns:
+    If sparse is False, the [instances1, instances2] float32 IoU matrix.
+    If sparse is True, (ids1, ids2, ious), three 1D arrays listing the pairs
+    with IoU > 0.
+    """
+    masks1 = masks1 > .5
+    masks2 = masks2 > .5
+    boxes1 = extract_bboxes(masks1)
+    boxes2 = extract_bboxes(masks2)
+
+    # Candidate pairs: intersecting boxes. Empty masks have empty boxes.
+    ids2, ids1 = BoxGridIndex(boxes2).query(boxes1)
+    packed1, bytes1 = _pack_masks(masks1, boxes1)
+    packed2, bytes2 = _pack_masks(masks2, boxes2)
+    area1 = np.array([_POPCOUNT[p].sum() for p in packed1], dtype=np.int64)
+    area2 = np.array([_POPCOUNT[p].sum() for p in packed2], dtype=np.int64)
+
+    # Intersections, in the intersection of the boxes. Bits outside of a box
+    # are 0 so the partial bytes at the edges need no masking.
+    intersections = np.zeros([ids1.shape[0]], dtype=np.int64)
+    for k, (i, j) in enumerate(zip(ids1, ids2)):
+        y1 = max(boxes1[i, 0], boxes2[j, 0])
+        y2 = min(boxes1[i, 2], boxes2[j, 2])
+        c1 = max(bytes1[i, 0], bytes2[j, 0])
+        c2 = min(bytes1[i, 1], bytes2[j, 1])
+        a = packed1[i][y1 - boxes1[i, 0]:y2 - boxes1[i, 0], c1 - bytes1[i, 0]:c2 - bytes1[i, 0]]
+        b = packed2[j][y1 - boxes2[j, 0]:y2 - boxes2[j, 0], c1 - bytes2[j, 0]:c2 - bytes2[j, 0]]
+        intersections[k] = _POPCOUNT[a & b].sum()
+
+    union = area1[ids1] + area2[ids2] - intersections
+    ious = (intersections / np.maximum(union, 1)).astype(np.float32)
+    keep = intersections > 0
+    if sparse:
+        return ids1[keep], ids2[keep], ious[keep]
+    overlaps = np.zeros((masks1.shape[-1], masks2.shape[-1]), dtype=np.float32)
+    overlaps[ids1[keep], ids2[keep]] = ious[keep]
     return overlaps
 
 
-def non_max_suppression(boxes, scores, threshold):
+def non_max_suppression(boxes, scores, threshold, max_output=None):
     """Performs non-maximum suppression and returns indices of kept boxes.
     boxes: [N, (y1, x1, y2, x2)]. Notice that (y2, x2) lays outside the box.
     scores: 1-D array of box scores.
     threshold: Float. IoU threshold to use for filtering.
+    max_output: Optional. Maximum number of boxes to keep.
+
+    See the nms module for batched per class NMS and soft-NMS.
     """
+    # Import here, nms.py imports this module
+    from mrcnn import nms
     assert boxes.shape[0] > 0
-    if boxes.dtype.kind != "f":
-        boxes = boxes.astype(np.float32)
-
-    # Compute box areas
-    y1 = boxes[:, 0]
-    x1 = boxes[:, 1]
-    y2 = boxes[:, 2]
-    x2 = boxes[:, 3]
-    area = (y2 - y1) * (x2 - x1)
-
-    # Get indicies of boxes sorted by scores (highest first)
-    ixs = scores.argsort()[::-1]
-
-    pick = []
-    while len(ixs) > 0:
-        # Pick top box and add its index to the list
-        i = ixs[0]
-        pick.append(i)
-        # Compute IoU of the picked box with the rest
-        iou = compute_iou(boxes[i], boxes[ixs[1:]], area[i], area[ixs[1:]])
-        # Identify boxes with IoU over the threshold. This
-        # returns indices into ixs[1:], so add 1 to get
-        # indices into ixs.
-        remove_ixs = np.where(iou > threshold)[0] + 1
-        # Remove indices of the picked and overlapped boxes.
-        ixs = np.delete(ixs, remove_ixs)
-        ixs = np.delete(ixs, 0)
-    return np.array(pick, dtype=np.int32)
+    return nms.non_max_suppression(boxes, scores, threshold, max_output)
 
 
 def apply_box_deltas(boxes, deltas):
@@ -559,6 +702,35 @@ def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square
     return image.astype(image_dtype), window, scale, padding, crop
 
 
+def pad_to_multiple(image, multiple=64):
+    """Pads an image with zeros at the bottom and on the right to make its
+    height and width multiples of the given value.
+
+    Returns:
+    image: the padded image
+    padding: Padding added to the image [(top, bottom), (left, right), (0, 0)]
+    """
+    h, w = image.shape[:2]
+    padding = [(0, -h % multiple), (0, -w % multiple), (0, 0)]
+    if padding[0][1] or padding[1][1]:
+        image = np.pad(image, padding, mode='constant', constant_values=0)
+    return image, padding
+
+
+def group_by_shape(images):
+    """Groups images by shape.
+
+    images: List or array of images.
+
+    Returns an OrderedDict of shape: [indices of the images of that shape],
+    in the order the shapes first appear.
+    """
+    groups = OrderedDict()
+    for i, image in enumerate(images):
+        groups.setdefault(tuple(image.shape), []).append(i)
+    return groups
+
+
 def resize_mask(mask, scale, padding, crop=None):
     """Resizes a mask using the given scale and padding.
     Typically, you get the scale and padding from resize_image() to
@@ -568,11 +740,10 @@ def resize_mask(mask, scale, padding, crop=None):
     padding: Padding to add to the mask in the form
             [(top, bottom), (left, right), (0, 0)]
     """
-    # Suppress warning from scipy 0.13.0, the output shape of zoom() is
-    # calculated with round() instead of int()
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        mask = scipy.ndimage.zoom(mask, zoom=[scale, scale, 1], order=0)
+    # Nearest neighbor, to the size of the image resized by resize_image()
+    h, w = mask.shape[:2]
+    mask = resize(mask, (round(h * scale), round(w * scale)), order=0,
+                  preserve_range=True)
     if crop is not None:
         y, x, h, w = crop
         mask = mask[y:y + h, x:x + w]
@@ -581,24 +752,233 @@ def resize_mask(mask, scale, padding, crop=None):
     return mask
 
 
+def _resize_weights(in_sizes, out_sizes):
+    """Computes the bilinear interpolation weights to resize 1D segments,
+    like resize() with order=1 and mode='constant'.
+
+    in_sizes: [N] Input size of each segment
+    out_sizes: [N] Output size of each segment
+
+    Returns flat arrays over the sum(out_sizes) output samples, in segment
+    order: the input samples (i0, i1), local to the segment, and their
+    weights (w0, w1). Samples outside of the input have a weight of 0.
+    """
+    in_sizes = np.asarray(in_sizes, dtype=np.int64)
+    out_sizes = np.asarray(out_sizes, dtype=np.int64)
+    segment = np.repeat(np.arange(out_sizes.shape[0]), out_sizes)
+    offset = np.cumsum(out_sizes) - out_sizes
+    o = np.arange(segment.shape[0]) - offset[segment]
+    n = in_sizes[segment]
+    # Center of the output sample in input coordinates
+    c = (o + 0.5) * (n / out_sizes[segment]) - 0.5
+    i0 = np.floor(c).astype(np.int64)
+    w1 = c - i0
+    w0 = 1 - w1
+    i1 = i0 + 1
+    w0[i0 < 0] = 0
+    w1[i1 > n - 1] = 0
+    return np.maximum(i0, 0), np.minimum(i1, n - 1), w0, w1
+
+
+def _bilinear(m, rows0, rows1, cols0, cols1, wy0, wy1, wx0, wx1):
+    """Bilinear interpolation of the flattened array m. The rows and columns
+    are offsets in m that add up to the index of each sample."""
+    return wy0 * (wx0 * m[rows0 + cols0] + wx1 * m[rows0 + cols1]) + \
+        wy1 * (wx0 * m[rows1 + cols0] + wx1 * m[rows1 + cols1])
+
+
+def _clip_resized(values, low, high):
+    """Clips interpolated values to the range of their input, like resize()
+    does. Zeros (the constant value outside of the input) are preserved."""
+    return np.where(values == 0, values, np.clip(values, low, high))
+
+
+def _box_pixels(h, w):
+    """Enumerates the pixels of boxes of size [N] (h, w).
+    Returns flat arrays of the instance, row and column of each pixel."""
+    area = h * w
+    ids = np.repeat(np.arange(h.shape[0]), area)
+    k = np.arange(ids.shape[0]) - np.repeat(np.cumsum(area) - area, area)
+    r = k // w[ids]
+    return ids, r, k - r * w[ids]
+
+
+def resize_to_boxes(masks, boxes):
+    """Resizes small masks to the size of their boxes with bilinear
+    interpolation, all instances at once. This is the inverse of the crop
+    and resize done by minimize_mask().
+
+    masks: [N, height, width] Small masks, float or bool.
+    boxes: [N, (y1, x1, y2, x2)] Boxes to fit the masks in.
+
+    Returns the resized masks as flat arrays of pixels, in image coordinates:
+    ids: Instance of each pixel
+    ys, xs: Pixel coordinates
+    values: Interpolated mask values
+    """
+    n, mh, mw = masks.shape[:3]
+    y1, x1, y2, x2 = np.asarray(boxes, dtype=np.int64)[:, :4].T
+    h = np.maximum(y2 - y1, 0)
+    w = np.maximum(x2 - x1, 0)
+    r0, r1, wy0, wy1 = _resize_weights(np.full([n], mh), h)
+    c0, c1, wx0, wx1 = _resize_weights(np.full([n], mw), w)
+    masks = masks.reshape([n * mh, mw])
+    # Interpolate the rows first: [sum(h), width]
+    base = np.repeat(np.arange(n) * mh, h)
+    rows = wy0[:, np.newaxis] * masks[base + r0] + wy1[:, np.newaxis] * masks[base + r1]
+    rows = rows.reshape([-1])
+    # Then the columns, for each pixel of all boxes
+    ids, r, c = _box_pixels(h, w)
+    ry = (np.repeat(np.cumsum(h) - h, h * w) + r) * mw
+    cx = np.repeat(np.cumsum(w) - w, h * w) + c
+    values = wx0[cx] * rows[ry + c0[cx]] + wx1[cx] * rows[ry + c1[cx]]
+    masks = masks.reshape([n, mh * mw])
+    values = _clip_resized(values, masks.min(axis=1)[ids], masks.max(axis=1)[ids])
+    return ids, y1[ids] + r, x1[ids] + c, values
+
+
+# Number of box pixels resized at a time by iter_resize_to_boxes(). Each
+# pixel takes about 100 bytes of index, weight and value arrays.
+RESIZE_CHUNK_PIXELS = 2**16
+
+
+def _box_chunks(areas, max_pixels):
+    """Splits boxes into slices of consecutive boxes of at most max_pixels
+    pixels in total, or of a single box if it's larger than that."""
+    ends = np.cumsum(areas)
+    start = 0
+    while start < ends.shape[0]:
+        limit = (ends[start - 1] if start else 0) + max_pixels
+        stop = max(int(np.searchsorted(ends, limit, side="right")), start + 1)
+        yield slice(start, stop)
+        start = stop
+
+
+def iter_resize_to_boxes(masks, boxes, max_pixels=None):
+    """resize_to_boxes() by chunks of boxes, to bound the memory of the
+    index and weight arrays of the pixels.
+
+    max_pixels: Optional. Number of box pixels in a chunk. Defaults to
+        RESIZE_CHUNK_PIXELS.
+
+    Yields the (ids, ys, xs, values) of resize_to_boxes() for each chunk,
+    in instance order. ids are indices in masks.
+    """
+    boxes = np.asarray(boxes, dtype=np.int64)
+    h = np.maximum(boxes[:, 2] - boxes[:, 0], 0)
+    w = np.maximum(boxes[:, 3] - boxes[:, 1], 0)
+    for chunk in _box_chunks(h * w, max_pixels or RESIZE_CHUNK_PIXELS):
+        ids, ys, xs, values = resize_to_boxes(masks[chunk], boxes[chunk])
+        yield ids + chunk.start, ys, xs, values
+
+
+def crop_and_resize_masks(masks, ids, boxes, output_shape, mask_boxes=None):
+    """Crops boxes out of binary masks and resizes the crops with bilinear
+    interpolation, all boxes at once. Gives the same values as
+    resize(mask[y1:y2, x1:x2], output_shape) for each box, without building
+    the crops or, for mini masks, the full size masks.
+
+    masks: [height, width, N] Binary masks. Full size masks, or mini masks
+        if mask_boxes is given.
+    ids: [M] Index of the mask to crop each box from.
+    boxes: [M, (y1, x1, y2, x2)] Boxes to crop, in image coordinates.
+    output_shape: (height, width) of the resized crops.
+    mask_boxes: Optional. [N, (y1, x1, y2, x2)] The boxes the mini masks
+        were made from. See minimize_mask(). Mini masks are expanded to
+        their boxes, like expand_mask() does, and are 0 outside of them.
+
+    Returns [M, height, width] float resized crops.
+    """
+    m = ids.shape[0]
+    oh, ow = output_shape
+    y1, x1, y2, x2 = np.asarray(boxes, dtype=np.int64)[:, :4].T
+    h = y2 - y1
+    w = x2 - x1
+
+    if mask_boxes is None:
+        width, n = masks.shape[1:]
+        flat = masks.reshape([-1])
+
+        def fetch(k, ys, xs):
+            return flat[(ys * width + xs) * n + ids[k]]
+    else:
+        # Expand the mini masks in use to their boxes, box local
+        used, inverse = np.unique(ids, return_inverse=True)
+        gy1, gx1, gy2, gx2 = np.asarray(mask_boxes, dtype=np.int64)[used, :4].T
+        gh = gy2 - gy1
+        gw = gx2 - gx1
+        values = np.concatenate(
+            [np.around(v).astype(bool) for _, _, _, v in
+             iter_resize_to_boxes(np.moveaxis(masks[:, :, used], -1, 0),
+                                  mask_boxes[used])] + [np.zeros([0], dtype=bool)])
+        offset = np.cumsum(gh * gw) - gh * gw
+
+        def fetch(k, ys, xs):
+            g = inverse[k]
+            ly = ys - gy1[g]
+            lx = xs - gx1[g]
+            inside = (ly >= 0) & (ly < gh[g]) & (lx >= 0) & (lx < gw[g])
+            pixel = offset[g] + np.clip(ly, 0, gh[g] - 1) * gw[g] + np.clip(lx, 0, gw[g] - 1)
+            return values[pixel] & inside
+
+    # Bilinear interpolation of the crops: [M, height, width]
+    r0, r1, wy0, wy1 = [a.reshape([m, oh, 1]) for a in
+                        _resize_weights(h, np.full([m], oh))]
+    c0, c1, wx0, wx1 = [a.reshape([m, 1, ow]) for a in
+                        _resize_weights(w, np.full([m], ow))]
+    k = np.arange(m).reshape([m, 1, 1])
+    top = y1.reshape([m, 1, 1])
+    left = x1.reshape([m, 1, 1])
+    v00 = fetch(k, top + r0, left + c0)
+    v01 = fetch(k, top + r0, left + c1)
+    v10 = fetch(k, top + r1, left + c0)
+    v11 = fetch(k, top + r1, left + c1)
+    crops = wy0 * (wx0 * v00 + wx1 * v01) + wy1 * (wx0 * v10 + wx1 * v11)
+    # Crops that are all ones stay all ones. Only the crops whose samples
+    # are all ones can be, check all the pixels of those.
+    full = np.zeros([m], dtype=bool)
+    candidates = np.where((v00 & v01 & v10 & v11).reshape([m, -1]).all(axis=1))[0]
+    if candidates.shape[0]:
+        pixel_ids, r, c = _box_pixels(h[candidates], w[candidates])
+        k = candidates[pixel_ids]
+        full[candidates] = np.bincount(pixel_ids, fetch(k, y1[k] + r, x1[k] + c),
+                                       minlength=candidates.shape[0]) == \
+            h[candidates] * w[candidates]
+    return _clip_resized(crops, full.reshape([m, 1, 1]), 1)
+
+
 def minimize_mask(bbox, mask, mini_shape):
     """Resize masks to a smaller version to reduce memory load.
     Mini-masks can be resized back to image scale using expand_masks()
 
     See inspect_data.ipynb notebook for more details.
     """
-    mini_mask = np.zeros(mini_shape + (mask.shape[-1],), dtype=bool)
-    for i in range(mask.shape[-1]):
-        # Pick slice and cast to bool in case load_mask() returned wrong dtype
-        m = mask[:, :, i].astype(bool)
-        y1, x1, y2, x2 = bbox[i][:4]
-        m = m[y1:y2, x1:x2]
-        if m.size == 0:
-            raise Exception("Invalid bounding box with area of zero")
-        # Resize with bilinear interpolation
-        m = resize(m, mini_shape)
-        mini_mask[:, :, i] = np.around(m).astype(np.bool)
-    return mini_mask
+    n = mask.shape[-1]
+    y1, x1, y2, x2 = np.asarray(bbox, dtype=np.int64)[:, :4].T
+    if np.any((y2 <= y1) | (x2 <= x1)):
+        raise Exception("Invalid bounding box with area of zero")
+    # Cast to bool in case load_mask() returned wrong dtype
+    mask = mask.astype(bool)
+    # Resize the box crops with bilinear interpolation, sampling all
+    # instances at once in the flattened [height, width, N] mask
+    mh, mw = mini_shape
+    r0, r1, wy0, wy1 = [a.reshape([n, mh, 1]) for a in
+                        _resize_weights(y2 - y1, np.full([n], mh))]
+    c0, c1, wx0, wx1 = [a.reshape([n, 1, mw]) for a in
+                        _resize_weights(x2 - x1, np.full([n], mw))]
+    width = mask.shape[1]
+    ids = np.arange(n).reshape([n, 1, 1])
+    top = y1.reshape([n, 1, 1])
+    left = x1.reshape([n, 1, 1])
+    m = _bilinear(mask.reshape([-1]),
+                  (top + r0) * width * n + ids, (top + r1) * width * n + ids,
+                  (left + c0) * n, (left + c1) * n, wy0, wy1, wx0, wx1)
+    # Crops that are all ones stay all ones
+    pixel_ids, r, c = _box_pixels(y2 - y1, x2 - x1)
+    full = np.bincount(pixel_ids, mask[y1[pixel_ids] + r, x1[pixel_ids] + c, pixel_ids],
+                       minlength=n) == (y2 - y1) * (x2 - x1)
+    m = _clip_resized(m, full.reshape([n, 1, 1]), 1)
+    return np.moveaxis(np.around(m).astype(bool), 0, -1)
 
 
 def expand_mask(bbox, mini_mask, image_shape):
@@ -607,15 +987,10 @@ def expand_mask(bbox, mini_mask, image_shape):
 
     See inspect_data.ipynb notebook for more details.
     """
-    mask = np.zeros(image_shape[:2] + (mini_mask.shape[-1],), dtype=bool)
-    for i in range(mask.shape[-1]):
-        m = mini_mask[:, :, i]
-        y1, x1, y2, x2 = bbox[i][:4]
-        h = y2 - y1
-        w = x2 - x1
-        # Resize with bilinear interpolation
-        m = resize(m, (h, w))
-        mask[y1:y2, x1:x2, i] = np.around(m).astype(np.bool)
+    mask = np.zeros(tuple(image_shape[:2]) + (mini_mask.shape[-1],), dtype=bool)
+    # Resize with bilinear interpolation
+    for ids, ys, xs, values in iter_resize_to_boxes(np.moveaxis(mini_mask, -1, 0), bbox):
+        mask[ys, xs, ids] = np.around(values).astype(bool)
     return mask
 
 
@@ -632,15 +1007,152 @@ def unmold_mask(mask, bbox, image_shape):
 
     Returns a binary mask with the same size as the original image.
     """
+    return unmold_masks(mask[np.newaxis], np.array([bbox]), image_shape)[:, :, 0]
+
+
+def unmold_masks(masks, boxes, image_shape, mask_format="full"):
+    """Batched version of unmold_mask().
+    masks: [N, height, width] of type float. Small, typically 28x28 masks.
+    boxes: [N, (y1, x1, y2, x2)]. The boxes to fit the masks in.
+    mask_format: One of MASK_FORMATS. The format of the returned masks.
+
+    Returns binary masks [height, width, N] with the size of the original
+    image, or a list of N box crops or RLEs. See MASK_FORMATS.
+    """
+    assert mask_format in MASK_FORMATS, "Unknown mask format {}".format(mask_format)
     threshold = 0.5
-    y1, x1, y2, x2 = bbox
-    mask = resize(mask, (y2 - y1, x2 - x1))
-    mask = np.where(mask >= threshold, 1, 0).astype(np.bool)
+    boxes = np.asarray(boxes, dtype=np.int64)
+    h = np.maximum(boxes[:, 2] - boxes[:, 0], 0)
+    w = np.maximum(boxes[:, 3] - boxes[:, 1], 0)
+    if mask_format == "full":
+        full_masks = np.zeros(tuple(image_shape[:2]) + (masks.shape[0],), dtype=bool)
+    else:
+        results = []
+    # Resize the masks to their boxes, a chunk of boxes at a time, see
+    # iter_resize_to_boxes()
+    for chunk in _box_chunks(h * w, RESIZE_CHUNK_PIXELS):
+        ids, ys, xs, values = resize_to_boxes(masks[chunk], boxes[chunk])
+        if mask_format == "full":
+            # Put them in the right location.
+            full_masks[ys, xs, ids + chunk.start] = values >= threshold
+            continue
+        # The pixels are in instance and row major order
+        crops = [c.reshape(shape) for c, shape in
+                 zip(np.split(values >= threshold, np.cumsum(h[chunk] * w[chunk])[:-1]),
+                     zip(h[chunk], w[chunk]))]
+        if mask_format == "rle":
+            crops = [crop_to_rle(c, b, image_shape) for c, b in zip(crops, boxes[chunk])]
+        results.extend(crops)
+    return full_masks if mask_format == "full" else results
 
-    # Put the mask in the right location.
-    full_mask = np.zeros(image_shape[:2], dtype=np.bool)
-    full_mask[y1:y2, x1:x2] = mask
-    return full_mask
+
+############################################################
+#  Compact Masks
+############################################################
+
+# Formats of instance masks, as returned by MaskRCNN.detect():
+# - "full": [height, width, N] bool array of the size of the image.
+# - "crop": List of N [h, w] bool crops of the masks in their boxes, where
+#   (h, w) is the size of the box (y1, x1, y2, x2).
+# - "rle": List of N run length encodings of the full size masks, as
+#   {"size": [height, width], "counts": [...]}, in the uncompressed COCO
+#   format: alternate runs of 0 and 1, in column major order, starting
+#   with 0.
+# Crops and RLEs take memory in proportion of the boxes and the mask
+# perimeters. Full size masks are only needed for display and to export.
+MASK_FORMATS = ["full", "crop", "rle"]
+
+
+def _rle_from_positions(positions, shape):
+    """RLE of a mask of the given shape from the sorted column major
+    positions of its pixels."""
+    size = int(shape[0]) * int(shape[1])
+    if positions.shape[0] == 0:
+        counts = np.array([size])
+    else:
+        breaks = np.flatnonzero(np.diff(positions) != 1) + 1
+        starts = positions[np.concatenate([[0], breaks])]
+        ends = positions[np.concatenate([breaks - 1, [positions.shape[0] - 1]])] + 1
+        bounds = np.stack([starts, ends], axis=1).reshape([-1])
+        counts = np.diff(np.concatenate([[0], bounds, [size]]))
+        if counts[-1] == 0:
+            counts = counts[:-1]
+    return {"size": [int(shape[0]), int(shape[1])], "counts": counts.tolist()}
+
+
+def rle_encode(mask):
+    """Returns the RLE of a [height, width] binary mask. See MASK_FORMATS."""
+    positions = np.flatnonzero(np.asarray(mask).ravel(order="F"))
+    return _rle_from_positions(positions, mask.shape[:2])
+
+
+def rle_decode(rle):
+    """Returns the [height, width] bool mask of an RLE."""
+    height, width = rle["size"]
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    values = np.arange(counts.shape[0]) % 2 == 1
+    flat = np.zeros([height * width], dtype=bool)
+    flat[:counts.sum()] = np.repeat(values, counts)
+    return flat.reshape([height, width], order="F")
+
+
+def rle_area(rle):
+    """Returns the number of pixels of an RLE mask."""
+    return int(np.sum(rle["counts"][1::2]))
+
+
+def crop_to_rle(crop, box, image_shape):
+    """Returns the RLE of the full size mask of a crop, without building
+    the full size mask.
+    crop: [h, w] binary mask of the box.
+    box: [y1, x1, y2, x2] of the crop in the image.
+    """
+    height = int(image_shape[0])
+    x, y = np.nonzero(np.asarray(crop).T)
+    positions = (x + int(box[1])) * height + (y + int(box[0]))
+    return _rle_from_positions(positions, image_shape[:2])
+
+
+def crop_to_mask(crop, box, image_shape):
+    """Pastes a crop in a [height, width] bool mask of the image size."""
+    y1, x1, y2, x2 = np.asarray(box, dtype=np.int64)[:4]
+    mask = np.zeros(tuple(image_shape[:2]), dtype=bool)
+    mask[y1:y2, x1:x2] = crop
+    return mask
+
+
+def mask_to_crop(mask, box):
+    """Returns the [h, w] crop of a full size mask in a box."""
+    y1, x1, y2, x2 = np.asarray(box, dtype=np.int64)[:4]
+    return np.asarray(mask[y1:y2, x1:x2], dtype=bool)
+
+
+def mask_count(masks):
+    """Returns the number of instances of masks in any of MASK_FORMATS."""
+    if isinstance(masks, np.ndarray):
+        return masks.shape[-1]
+    return len(masks)
+
+
+def instance_mask(masks, boxes, i, image_shape):
+    """Returns the [height, width] bool mask of instance i of masks in any
+    of MASK_FORMATS. boxes are the boxes of the crops, if masks are crops."""
+    if isinstance(masks, np.ndarray):
+        return masks[:, :, i].astype(bool)
+    if isinstance(masks[i], dict):
+        return rle_decode(masks[i])
+    return crop_to_mask(masks[i], boxes[i], image_shape)
+
+
+def to_full_masks(masks, boxes, image_shape):
+    """Converts masks in any of MASK_FORMATS to a [height, width, N] bool
+    array of the image size. Arrays are returned as they are."""
+    if isinstance(masks, np.ndarray):
+        return masks
+    full = np.zeros(tuple(image_shape[:2]) + (len(masks),), dtype=bool)
+    for i in range(len(masks)):
+        full[:, :, i] = instance_mask(masks, boxes, i, image_shape)
+    return full
 
 
 ############################################################
@@ -706,6 +1218,379 @@ def generate_pyramid_anchors(scales, ratios, feature_shapes, feature_strides,
     return np.concatenate(anchors, axis=0)
 
 
+# Dihedral transforms of the image plane. A transform is an int made of
+# these flags. The transpose is applied first, then the flips.
+DIHEDRAL_FLIP_LR = 1
+DIHEDRAL_FLIP_UD = 2
+DIHEDRAL_TRANSPOSE = 4
+DIHEDRAL_TRANSFORMS = list(range(8))
+
+
+def dihedral_boxes(boxes, transform, image_shape):
+    """Applies a dihedral transform (flips and 90 degree rotations) to boxes.
+
+    boxes: [N, (y1, x1, y2, x2)] in pixel coordinates. (y2, x2) is outside
+        the box.
+    transform: int made of DIHEDRAL_* flags.
+    image_shape: [height, width, ...] of the image before the transform.
+
+    Returns: [N, (y1, x1, y2, x2)] transformed boxes of the same dtype.
+    """
+    h, w = image_shape[:2]
+    boxes = np.array(boxes)
+    if transform & DIHEDRAL_TRANSPOSE:
+        boxes = boxes[:, [1, 0, 3, 2]]
+        h, w = w, h
+    if transform & DIHEDRAL_FLIP_UD:
+        boxes[:, [0, 2]] = h - boxes[:, [2, 0]]
+    if transform & DIHEDRAL_FLIP_LR:
+        boxes[:, [1, 3]] = w - boxes[:, [3, 1]]
+    return boxes
+
+
+def dihedral_image(image, transform):
+    """Applies a dihedral transform to an image or a stack of masks.
+
+    image: [height, width, ...]
+    transform: int made of DIHEDRAL_* flags.
+
+    Returns a view of the transformed image. No data is copied.
+    """
+    if transform & DIHEDRAL_TRANSPOSE:
+        image = np.swapaxes(image, 0, 1)
+    if transform & DIHEDRAL_FLIP_UD:
+        image = image[::-1]
+    if transform & DIHEDRAL_FLIP_LR:
+        image = image[:, ::-1]
+    return image
+
+
+def dihedral_shape(image_shape, transform):
+    """Returns the image shape after the given dihedral transform."""
+    if transform & DIHEDRAL_TRANSPOSE:
+        return (image_shape[1], image_shape[0]) + tuple(image_shape[2:])
+    return tuple(image_shape)
+
+
+class AnchorGridIndex(object):
+    """Spatial index over a fixed set of anchors to quickly find the anchors
+    that intersect a given box.
+
+    Anchors produced by generate_pyramid_anchors() come in groups of equal
+    size (one per scale and ratio) whose centers lie on a regular lattice.
+    Each group is stored as a [rows, cols] grid of anchor indices, so the
+    anchors overlapping a box are a rectangular block of that grid found with
+    two binary searches per axis. Groups that don't form a full lattice are
+    kept as plain index lists and always returned as candidates, so the
+    index is exact for any anchor array.
+
+    anchors: [N, (y1, x1, y2, x2)] anchors in pixel coordinates.
+    """
+
+    def __init__(self, anchors):
+        self.anchors = anchors
+        self.num_anchors = anchors.shape[0]
+        # Same area formula as compute_overlaps() to get identical IoUs
+        self.area = (anchors[:, 2] - anchors[:, 0]) * (anchors[:, 3] - anchors[:, 1])
+
+        heights = anchors[:, 2] - anchors[:, 0]
+        widths = anchors[:, 3] - anchors[:, 1]
+        center_y = np.round(anchors[:, 0] + 0.5 * heights, 6)
+        center_x = np.round(anchors[:, 1] + 0.5 * widths, 6)
+        sizes = np.round(np.stack([heights, widths], axis=1), 6)
+        _, group_ids = np.unique(sizes, axis=0, return_inverse=True)
+        group_ids = group_ids.reshape(-1)
+
+        # Lattice groups: (grid, row_y1, row_y2, col_x1, col_x2)
+        self.grids = []
+        # Center coordinates of the rows and columns of each lattice and
+        # lookup table from anchor (height, width) to lattice
+        self.grid_centers = []
+        self.grid_sizes = {}
+        # Anchor permutations of dihedral transforms. See dihedral_permutation()
+        self._permutations = {}
+        # Anchors that are not part of a lattice
+        dense_ids = []
+        for g in range(group_ids.max() + 1 if group_ids.size else 0):
+            ids = np.where(group_ids == g)[0]
+            ys = np.unique(center_y[ids])
+            xs = np.unique(center_x[ids])
+            if ys.shape[0] * xs.shape[0] != ids.shape[0]:
+                dense_ids.append(ids)
+                continue
+            # Sort by center (y, x) so the indices form a [rows, cols] grid
+            order = np.lexsort((center_x[ids], center_y[ids]))
+            grid = ids[order].reshape(ys.shape[0], xs.shape[0])
+            # Conservative extents of each row and column of the grid
+            row_y1 = anchors[grid, 0].min(axis=1)
+            row_y2 = anchors[grid, 2].max(axis=1)
+            col_x1 = anchors[grid, 1].min(axis=0)
+            col_x2 = anchors[grid, 3].max(axis=0)
+            self.grid_sizes[tuple(sizes[ids[0]])] = len(self.grids)
+            self.grids.append((grid, row_y1, row_y2, col_x1, col_x2))
+            self.grid_centers.append((ys, xs))
+        self.dense_ids = np.concatenate(dense_ids) if dense_ids \
+            else np.zeros([0], dtype=np.int64)
+
+    def query(self, boxes):
+        """Finds candidate anchors for each of the given boxes.
+
+        boxes: [M, (y1, x1, y2, x2)] in pixel coordinates.
+
+        Returns two 1D arrays of the same length, (anchor_ids, box_ids). Every
+        anchor that intersects a box is listed once with that box. A few
+        anchors that only touch the box edge might be included too.
+        """
+        anchor_ids = []
+        box_ids = []
+        for grid, row_y1, row_y2, col_x1, col_x2 in self.grids:
+            # Rows whose anchors satisfy y2 > box.y1 and y1 < box.y2
+            r0 = np.searchsorted(row_y2, boxes[:, 0], side="right")
+            r1 = np.searchsorted(row_y1, boxes[:, 2], side="left")
+            c0 = np.searchsorted(col_x2, boxes[:, 1], side="right")
+            c1 = np.searchsorted(col_x1, boxes[:, 3], side="left")
+            nrows = np.maximum(r1 - r0, 0)
+            ncols = np.maximum(c1 - c0, 0)
+            counts = nrows * ncols
+            total = counts.sum()
+            if total == 0:
+                continue
+            # Enumerate the cells of each box's block without a Python loop
+            b = np.repeat(np.arange(boxes.shape[0]), counts)
+            offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+            cols = ncols[b]
+            anchor_ids.append(grid[r0[b] + offsets // cols, c0[b] + offsets % cols])
+            box_ids.append(b)
+        if self.dense_ids.shape[0]:
+            a, b = np.meshgrid(self.dense_ids, np.arange(boxes.shape[0]))
+            anchor_ids.append(a.reshape(-1))
+            box_ids.append(b.reshape(-1))
+        if not anchor_ids:
+            return np.zeros([0], dtype=np.int64), np.zeros([0], dtype=np.int64)
+        return np.concatenate(anchor_ids), np.concatenate(box_ids)
+
+    def overlaps(self, boxes, anchor_mask=None):
+        """Computes the non-zero IoU overlaps between the anchors and the
+        given boxes. Sparse equivalent of compute_overlaps(anchors, boxes).
+
+        boxes: [M, (y1, x1, y2, x2)] in pixel coordinates.
+        anchor_mask: Optional. [N] bool array. If given, only the anchors
+            where it's True are considered.
+
+        Returns (anchor_ids, box_ids, ious), three 1D arrays listing the
+        anchor-box pairs with IoU > 0. Pairs not listed have zero overlap.
+        """
+        anchor_ids, box_ids = self.query(boxes)
+        if anchor_mask is not None:
+            keep = anchor_mask[anchor_ids]
+            anchor_ids = anchor_ids[keep]
+            box_ids = box_ids[keep]
+        box_area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        a = self.anchors[anchor_ids]
+        b = boxes[box_ids]
+        # Same operations as compute_iou() so the values match exactly
+        y1 = np.maximum(b[:, 0], a[:, 0])
+        y2 = np.minimum(b[:, 2], a[:, 2])
+        x1 = np.maximum(b[:, 1], a[:, 1])
+        x2 = np.minimum(b[:, 3], a[:, 3])
+        intersection = np.maximum(x2 - x1, 0) * np.maximum(y2 - y1, 0)
+        union = box_area[box_ids] + self.area[anchor_ids] - intersection
+        ious = intersection / union
+        keep = ious > 0
+        return anchor_ids[keep], box_ids[keep], ious[keep]
+
+    def lookup(self, boxes, tolerance=1e-3):
+        """Finds the anchors that are equal to the given boxes.
+
+        boxes: [M, (y1, x1, y2, x2)] in pixel coordinates.
+        tolerance: Maximum coordinate difference, in pixels.
+
+        Returns: [M] anchor indices, or -1 for boxes that are not an anchor.
+        Only anchors that belong to a lattice can be found.
+        """
+        ids = np.full([boxes.shape[0]], -1, dtype=np.int64)
+        heights = boxes[:, 2] - boxes[:, 0]
+        widths = boxes[:, 3] - boxes[:, 1]
+        center_y = boxes[:, 0] + 0.5 * heights
+        center_x = boxes[:, 1] + 0.5 * widths
+        sizes = np.round(np.stack([heights, widths], axis=1), 6)
+        for size, g in self.grid_sizes.items():
+            ix = np.where(np.all(np.abs(sizes - size) < tolerance, axis=1))[0]
+            if ix.shape[0] == 0:
+                continue
+            grid = self.grids[g][0]
+            ys, xs = self.grid_centers[g]
+            rows = np.clip(np.searchsorted(ys, center_y[ix] - tolerance), 0, ys.shape[0] - 1)
+            cols = np.clip(np.searchsorted(xs, center_x[ix] - tolerance), 0, xs.shape[0] - 1)
+            found = (np.abs(ys[rows] - center_y[ix]) < tolerance) & \
+                    (np.abs(xs[cols] - center_x[ix]) < tolerance)
+            ids[ix[found]] = grid[rows[found], cols[found]]
+        return ids
+
+    def dihedral_permutation(self, transform, image_shape):
+        """Maps the anchors to the anchors they become when the image is
+        transformed with the given dihedral transform (see dihedral_boxes()).
+
+        Returns: [N] array. Element i is the index of the transformed anchor i,
+            or -1 if it falls off the anchor lattice (this happens to the
+            first row or column of anchors, which are centered on the image
+            border).
+        """
+        key = (transform, tuple(image_shape[:2]))
+        if key not in self._permutations:
+            boxes = dihedral_boxes(self.anchors, transform, image_shape)
+            self._permutations[key] = self.lookup(boxes)
+        return self._permutations[key]
+
+
+############################################################
+#  Spatial Index
+############################################################
+
+class BoxGridIndex(object):
+    """Uniform grid index of boxes, to find the boxes in a rectangle, the
+    boxes containing a point or the nearest boxes of a point without
+    comparing every pair.
+
+    The extent of the boxes is divided in square cells and each box is
+    listed in the cells it covers. A query only looks at the boxes of the
+    cells it covers, then checks them exactly. Queries are batched: all the
+    rectangles or points are looked up at once, without a Python loop.
+
+    boxes: [N, (y1, x1, y2, x2)], in pixel or normalized coordinates. Points
+        can be indexed as boxes of zero size.
+    cell_size: Optional. Side of the cells. Defaults to the median box size,
+        enlarged if needed to keep about N cells or less.
+    """
+
+    def __init__(self, boxes, cell_size=None):
+        self.boxes = np.asarray(boxes, dtype=np.float64).reshape([-1, 4])
+        self.num_boxes = n = self.boxes.shape[0]
+        self._tree = None
+        if n == 0:
+            self.origin = np.zeros([2])
+            self.cell_size = 1.
+            self.grid_shape = np.ones([2], dtype=np.int64)
+        else:
+            self.origin = self.boxes[:, :2].min(axis=0)
+            extent = self.boxes[:, 2:].max(axis=0) - self.origin
+            if cell_size is None:
+                sizes = np.maximum(self.boxes[:, 2] - self.boxes[:, 0],
+                                   self.boxes[:, 3] - self.boxes[:, 1])
+                cell_size = max(np.median(sizes), np.sqrt(extent[0] * extent[1] / n))
+            # Cells of zero size if all the boxes are the same point
+            self.cell_size = float(cell_size) if cell_size > 0 else 1.
+            self.grid_shape = np.floor(extent / self.cell_size).astype(np.int64) + 1
+
+        # Cells covered by each box, as a sorted list of (cell, box) pairs
+        # and the start of each cell in it
+        box_ids, cells = self._cells(self.boxes)
+        order = np.argsort(cells, kind="mergesort")
+        self.cell_boxes = box_ids[order]
+        counts = np.bincount(cells, minlength=int(np.prod(self.grid_shape)))
+        self.cell_starts = np.concatenate([[0], np.cumsum(counts)])
+
+    def _cells(self, boxes):
+        """Enumerates the grid cells covered by each box, clipped to the grid.
+        Returns two 1D arrays of the same length, (box_ids, cells)."""
+        if boxes.shape[0] == 0:
+            return np.zeros([0], dtype=np.int64), np.zeros([0], dtype=np.int64)
+        low = np.floor((boxes[:, :2] - self.origin) / self.cell_size).astype(np.int64)
+        high = np.floor((boxes[:, 2:] - self.origin) / self.cell_size).astype(np.int64)
+        low = np.clip(low, 0, self.grid_shape - 1)
+        high = np.clip(high, low, self.grid_shape - 1)
+        nrows, ncols = (high - low + 1).T
+        counts = nrows * ncols
+        ids = np.repeat(np.arange(boxes.shape[0]), counts)
+        k = np.arange(ids.shape[0]) - np.repeat(np.cumsum(counts) - counts, counts)
+        rows = low[ids, 0] + k // ncols[ids]
+        cols = low[ids, 1] + k % ncols[ids]
+        return ids, rows * self.grid_shape[1] + cols
+
+    def _candidates(self, boxes):
+        """Lists the indexed boxes sharing a cell with each query box, once.
+        Returns two 1D arrays of the same length, (box_ids, query_ids)."""
+        query_ids, cells = self._cells(boxes)
+        counts = self.cell_starts[cells + 1] - self.cell_starts[cells]
+        query_ids = np.repeat(query_ids, counts)
+        k = np.arange(query_ids.shape[0]) - np.repeat(np.cumsum(counts) - counts, counts)
+        box_ids = self.cell_boxes[np.repeat(self.cell_starts[cells], counts) + k]
+        # Boxes that cover several cells of a query are listed several times
+        pairs = np.unique(query_ids * max(self.num_boxes, 1) + box_ids)
+        return pairs % max(self.num_boxes, 1), pairs // max(self.num_boxes, 1)
+
+    def query(self, rects):
+        """Finds the boxes that intersect each rectangle, with a positive area.
+        A box of zero size (a point) intersects the rectangles that strictly
+        contain it.
+
+        rects: [M, (y1, x1, y2, x2)] query rectangles.
+
+        Returns two 1D arrays of the same length, (box_ids, rect_ids), of the
+        intersecting pairs, sorted by rectangle then box.
+        """
+        rects = np.asarray(rects, dtype=np.float64).reshape([-1, 4])
+        box_ids, rect_ids = self._candidates(rects)
+        b = self.boxes[box_ids]
+        r = rects[rect_ids]
+        keep = (b[:, 0] < r[:, 2]) & (b[:, 2] > r[:, 0]) & \
+            (b[:, 1] < r[:, 3]) & (b[:, 3] > r[:, 1])
+        return box_ids[keep], rect_ids[keep]
+
+    def query_points(self, points):
+        """Finds the boxes that contain each point, with y1 <= y < y2 and
+        x1 <= x < x2.
+
+        points: [M, (y, x)] query points.
+
+        Returns two 1D arrays of the same length, (box_ids, point_ids),
+        sorted by point then box.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape([-1, 2])
+        box_ids, point_ids = self._candidates(np.concatenate([points, points], axis=1))
+        b = self.boxes[box_ids]
+        p = points[point_ids]
+        keep = np.all((b[:, :2] <= p) & (p < b[:, 2:]), axis=1)
+        return box_ids[keep], point_ids[keep]
+
+    def overlaps(self, rects):
+        """Computes the non-zero IoUs between the boxes and the rectangles.
+        Sparse equivalent of pairwise_iou(boxes, rects).
+
+        Returns (box_ids, rect_ids, ious), three 1D arrays listing the pairs
+        with IoU > 0.
+        """
+        rects = np.asarray(rects, dtype=np.float64).reshape([-1, 4])
+        box_ids, rect_ids = self.query(rects)
+        ious = _box_iou(self.boxes[box_ids], rects[rect_ids])
+        keep = ious > 0
+        return box_ids[keep], rect_ids[keep], ious[keep]
+
+    def nearest(self, points, k=1):
+        """Finds the k boxes with the nearest centers to each point. Uses a
+        KD-tree of the box centers, built on the first call.
+
+        points: [M, (y, x)] query points.
+
+        Returns:
+        ids: [M, k] indices of the nearest boxes, closest first. -1 if there
+            are less than k boxes.
+        distances: [M, k] distances to the box centers, inf for missing boxes.
+        """
+        import scipy.spatial
+        points = np.asarray(points, dtype=np.float64).reshape([-1, 2])
+        if self._tree is None:
+            self._tree = scipy.spatial.cKDTree((self.boxes[:, :2] + self.boxes[:, 2:]) / 2)
+        if self.num_boxes == 0:
+            return np.full([points.shape[0], k], -1, dtype=np.int64), \
+                np.full([points.shape[0], k], np.inf)
+        distances, ids = self._tree.query(points, k=k)
+        distances = distances.reshape([points.shape[0], k])
+        ids = ids.reshape([points.shape[0], k]).astype(np.int64)
+        ids[ids >= self.num_boxes] = -1
+        return ids, distances
+
+
 ############################################################
 #  Miscellaneous
 ############################################################
@@ -724,6 +1609,7 @@ def compute_matches(gt_boxes, gt_class_ids, gt_masks,
                     pred_boxes, pred_class_ids, pred_scores, pred_masks,
                     iou_threshold=0.5, score_threshold=0.0):
     """Finds matches between prediction and ground truth instances.
+    pred_masks can be in any of MASK_FORMATS.
 
     Returns:
         gt_match: 1-D array. For each GT box it has the index of the matched
@@ -732,6 +1618,7 @@ def compute_matches(gt_boxes, gt_class_ids, gt_masks,
                     the matched ground truth box.
         overlaps: [pred_boxes, gt_boxes] IoU overlaps.
     """
+    pred_masks = to_full_masks(pred_masks, pred_boxes, gt_masks.shape)
     # Trim zero padding
     # TODO: cleaner to do zero unpadding upstream
     gt_boxes = trim_zeros(gt_boxes)
@@ -960,20 +1847,209 @@ def resize(image, output_shape, order=1, mode='constant', cval=0, clip=True,
     receive the right parameters. The right parameters depend on the version
     of skimage. This solves the problem by using different parameters per
     version. And it provides a central place to control resizing defaults.
+
+    With the defaults (zero padding, clipping, no anti-aliasing) and the
+    range preserved, the image goes to the resize backends instead, see
+    resize_backends(). They give the same results as skimage.
     """
-    if LooseVersion(skimage.__version__) >= LooseVersion("0.14"):
-        # New in 0.14: anti_aliasing. Default it to False for backward
-        # compatibility with skimage 0.13.
-        return skimage.transform.resize(
-            image, output_shape,
-            order=order, mode=mode, cval=cval, clip=clip,
-            preserve_range=preserve_range, anti_aliasing=anti_aliasing,
-            anti_aliasing_sigma=anti_aliasing_sigma)
+    if mode == 'constant' and cval == 0 and clip and not anti_aliasing and \
+            (preserve_range or image.dtype.kind in "fb"):
+        for name in resize_backends(image.dtype, order):
+            resized = RESIZE_BACKENDS[name](image, output_shape, order)
+            if resized is not None:
+                return resized
+    return _skimage_resize(image, output_shape, order=order, mode=mode, cval=cval,
+                           clip=clip, preserve_range=preserve_range,
+                           anti_aliasing=anti_aliasing,
+                           anti_aliasing_sigma=anti_aliasing_sigma)
+
+
+# New in skimage 0.14: anti_aliasing
+_SKIMAGE_ANTI_ALIASING = LooseVersion(skimage.__version__) >= LooseVersion("0.14")
+# New in scipy 1.6: grid_mode, the pixel center convention of skimage
+_SCIPY_GRID_MODE = LooseVersion(scipy.__version__) >= LooseVersion("1.6")
+
+
+def _skimage_resize(image, output_shape, **kwargs):
+    """Calls skimage resize() with the arguments of the installed version."""
+    if _SKIMAGE_ANTI_ALIASING:
+        # Default anti_aliasing to False for backward compatibility
+        # with skimage 0.13.
+        kwargs.setdefault("anti_aliasing", False)
     else:
-        return skimage.transform.resize(
-            image, output_shape,
-            order=order, mode=mode, cval=cval, clip=clip,
-            preserve_range=preserve_range)
+        kwargs.pop("anti_aliasing", None)
+        kwargs.pop("anti_aliasing_sigma", None)
+    return skimage.transform.resize(image, output_shape, **kwargs)
+
+
+############################################################
+#  Resize Backends
+############################################################
+
+# A resize backend is a function (image, output_shape, order) that resizes
+# the height and width of an image like resize() with mode='constant',
+# cval=0, clip=True and preserve_range=True: same pixel center convention,
+# zeros outside of the image and interpolated values clipped to the range
+# of the input. With order 0 the output has the dtype of the image, with
+# order > 0 it's floating point. A backend returns None for the images it
+# doesn't handle, and the next one is tried.
+RESIZE_BACKENDS = OrderedDict()
+
+# Backends tried first, whatever the selected backend: they handle special
+# sizes only, exactly.
+RESIZE_FAST_PATHS = ["identity", "integer"]
+
+# Selected backend of each (dtype name, order), see set_resize_backend().
+# The default is "skimage".
+_resize_backend = {}
+
+
+def register_resize_backend(name, backend):
+    """Registers a resize backend function under the given name."""
+    RESIZE_BACKENDS[name] = backend
+
+
+def set_resize_backend(name, dtype=None, order=None):
+    """Selects the resize backend of images of a dtype resized with an
+    interpolation order. dtype and order default to all of them. A name of
+    None restores the default.
+    """
+    assert name is None or name in RESIZE_BACKENDS, \
+        "Unknown resize backend {}".format(name)
+    dtype = np.dtype(dtype).name if dtype is not None else None
+    for key in list(_resize_backend.keys()) + [(dtype, order)]:
+        if (dtype is None or key[0] == dtype) and (order is None or key[1] == order):
+            if name is None:
+                _resize_backend.pop(key, None)
+            else:
+                _resize_backend[key] = name
+
+
+def resize_backends(dtype, order):
+    """Returns the names of the backends resize() tries, in order, for an
+    image of the given dtype and interpolation order."""
+    dtype = np.dtype(dtype).name
+    name = _resize_backend.get((dtype, order)) or \
+        _resize_backend.get((dtype, None)) or \
+        _resize_backend.get((None, order)) or \
+        _resize_backend.get((None, None)) or "skimage"
+    return RESIZE_FAST_PATHS + [name]
+
+
+def _resize_float(image):
+    """Float type of the interpolated values of an image, as in skimage."""
+    return image.dtype if image.dtype in [np.float32, np.float64] else np.float64
+
+
+def _resize_sizes(image, output_shape):
+    """Returns the output (height, width), or None if output_shape changes
+    other dimensions than the height and width."""
+    output_shape = tuple(output_shape)
+    if output_shape[2:] and output_shape[2:] != image.shape[2:]:
+        return None
+    return output_shape[:2]
+
+
+def _clip_to_input(image, resized):
+    """Clips resized values to the range of the input image, in place, like
+    skimage does in mode 'constant' with cval=0."""
+    low, high = np.min(image), np.max(image)
+    if not low <= 0 <= high and np.min(resized) <= 0 <= np.max(resized):
+        low, high = min(low, 0), max(high, 0)
+    np.clip(resized, low, high, out=resized)
+    return resized
+
+
+def _resize_skimage(image, output_shape, order):
+    """Resize backend calling skimage resize(). The reference."""
+    return _skimage_resize(image, output_shape, order=order, mode='constant',
+                           cval=0, clip=True, preserve_range=True)
+
+
+def _resize_identity(image, output_shape, order):
+    """Resize backend of the images of the output size. Returns a copy."""
+    if _resize_sizes(image, output_shape) != image.shape[:2]:
+        return None
+    return image.astype(image.dtype if order == 0 else _resize_float(image))
+
+
+def _resize_scipy(image, output_shape, order):
+    """Resize backend interpolating in float32 with scipy.ndimage.zoom(),
+    one channel at a time. Values are not converted to float64 like skimage
+    does with integer images."""
+    size = _resize_sizes(image, output_shape)
+    if size is None or not _SCIPY_GRID_MODE:
+        return None
+    zoom = [o / i for o, i in zip(size, image.shape[:2])]
+    if order == 0:
+        # Nearest neighbor: all channels at once, in the image dtype
+        data = image.view(np.uint8) if image.dtype == bool else image
+        resized = scipy.ndimage.zoom(data, zoom + [1] * (image.ndim - 2), order=0,
+                                     mode='grid-constant', cval=0, grid_mode=True)
+        return resized.view(bool) if image.dtype == bool else resized
+    data = image.astype(np.float32)
+    channels = data.reshape(image.shape[:2] + (-1,))
+    resized = np.empty(tuple(size) + (channels.shape[-1],), dtype=np.float32)
+    for c in range(channels.shape[-1]):
+        scipy.ndimage.zoom(channels[:, :, c], zoom, output=resized[:, :, c], order=order,
+                           mode='grid-constant', cval=0, grid_mode=True)
+    return _clip_to_input(data, resized.reshape(tuple(size) + image.shape[2:]))
+
+
+def _scale_axis(a, factor, order):
+    """Resizes the first axis of an array by an integer factor with
+    nearest neighbor (order 0) or linear (order 1) interpolation.
+    factor: k > 0 to scale up k times, -k to scale down k times.
+    """
+    k = abs(factor)
+    if k == 1:
+        return a
+    if factor < 0:
+        # Scale down: output samples fall on input pixels (odd k) or halfway
+        # between two of them (even k), where nearest neighbor rounds up
+        if k % 2 or order == 0:
+            return a[k // 2::k]
+        return (a[k // 2 - 1::k] + a[k // 2::k]) / 2
+    if order == 0:
+        return np.repeat(a, k, axis=0)
+    # Scale up: the k outputs of an input pixel mix it with its previous or
+    # next pixel with the same weights everywhere
+    t = (np.arange(k) + 0.5) / k - 0.5
+    shape = (1, k) + (1,) * (a.ndim - 1)
+    padded = np.concatenate([np.zeros_like(a[:1]), a, np.zeros_like(a[:1])])
+    resized = a[:, np.newaxis] * (1 - np.abs(t)).astype(a.dtype).reshape(shape) + \
+        padded[:-2, np.newaxis] * np.maximum(-t, 0).astype(a.dtype).reshape(shape) + \
+        padded[2:, np.newaxis] * np.maximum(t, 0).astype(a.dtype).reshape(shape)
+    return resized.reshape((-1,) + a.shape[1:])
+
+
+def _resize_integer(image, output_shape, order):
+    """Resize backend of the images scaled up or down by integer factors,
+    with order 0 or 1. Repeats or strides the pixels instead of
+    interpolating."""
+    size = _resize_sizes(image, output_shape)
+    if size is None or order not in [0, 1]:
+        return None
+    factors = []
+    for i, o in zip(image.shape[:2], size):
+        if o % i == 0:
+            factors.append(o // i)
+        elif i % o == 0:
+            factors.append(-(i // o))
+        else:
+            return None
+    data = image if order == 0 else image.astype(_resize_float(image))
+    resized = _scale_axis(data, factors[0], order)
+    resized = np.swapaxes(_scale_axis(np.swapaxes(resized, 0, 1), factors[1], order), 0, 1)
+    if order == 0:
+        return np.array(resized)
+    return _clip_to_input(data, np.ascontiguousarray(resized))
+
+
+register_resize_backend("skimage", _resize_skimage)
+register_resize_backend("scipy", _resize_scipy)
+register_resize_backend("identity", _resize_identity)
+register_resize_backend("integer", _resize_integer)
 
 
 ############################################################
@@ -986,61 +2062,68 @@ def read_table(filename):
 
 def read_fits(filename, stretch=True, normalize=True, convertToRGB=True):
     """ Read FITS image """
+
+    # - Per-stage timing (a no-op unless timing is on)
+    timer = timing.get_timer()
 	
-    # - Open file
-    try:
-        hdu = fits.open(filename, memmap=False)
-    except Exception as ex:
-        errmsg = 'ERROR: Cannot read image file: ' + filename
-        print(errmsg)
-        return None
+    with timer.stage("fits_read") as stage:
+        # - Open file
+        try:
+            hdu = fits.open(filename, memmap=False)
+        except Exception as ex:
+            errmsg = 'ERROR: Cannot read image file: ' + filename
+            print(errmsg)
+            return None
+
+        # - Read data
+        data = hdu[0].data
+        data_size = np.shape(data)
+        nchan = len(data.shape)
+        if nchan == 4:
+          output_data = data[0, 0, :, :]
+        elif nchan == 2:
+          output_data = data
+        else:
+          errmsg = 'ERROR: Invalid/unsupported number of channels found in file ' + filename + ' (nchan=' + str(nchan) + ')!'
+          hdu.close()
+          print(errmsg)
+          return None
 
-    # - Read data
-    data = hdu[0].data
-    data_size = np.shape(data)
-    nchan = len(data.shape)
-    if nchan == 4:
-      output_data = data[0, 0, :, :]
-    elif nchan == 2:
-      output_data = data
-    else:
-      errmsg = 'ERROR: Invalid/unsupported number of channels found in file ' + filename + ' (nchan=' + str(nchan) + ')!'
-      hdu.close()
-      print(errmsg)
-      return None
+        # - Convert data to float 32
+        output_data = output_data.astype(np.float32)
 
-    # - Convert data to float 32
-    output_data = output_data.astype(np.float32)
+        # - Read metadata
+        header = hdu[0].header
 
-    # - Read metadata
-    header = hdu[0].header
+        # - Close file
+        hdu.close()
 
-    # - Close file
-    hdu.close()
-
-    # - Replace nan values with min pix value
-    img_min = np.nanmin(output_data)
-    output_data[np.isnan(output_data)] = img_min
+        # - Replace nan values with min pix value
+        img_min = np.nanmin(output_data)
+        output_data[np.isnan(output_data)] = img_min
+        stage.add(output_data)
 
     # - Stretch data using zscale transform
     if stretch:
-        data_stretched = stretch_img(output_data)
-        output_data = data_stretched
-        output_data = output_data.astype(np.float32)
-
-    # - Normalize data to [0,255]
-    if normalize:
-        data_norm = normalize_img(output_data)
-        output_data = data_norm
-        output_data = output_data.astype(np.float32)
-
-    # - Convert to RGB image
-    if convertToRGB:
-        if not normalize:
+        with timer.stage("fits_zscale"):
+            data_stretched = stretch_img(output_data)
+            output_data = data_stretched
+            output_data = output_data.astype(np.float32)
+
+    with timer.stage("fits_normalize"):
+        # - Normalize data to [0,255]
+        if normalize:
             data_norm = normalize_img(output_data)
             output_data = data_norm
-        data_rgb = gray2rgb(output_data)
-        output_data = data_rgb
+            output_data = output_data.astype(np.float32)
+
+        # - Convert to RGB image
+        if convertToRGB:
+            if not normalize:
+                data_norm = normalize_img(output_data)
+                output_data = data_norm
+            data_rgb = gray2rgb(output_data)
+            output_data = data_rgb
 
     return output_data, header
 	
@@ -87,7 +87,8 @@ def display_instances(image, boxes, masks, class_ids, class_names,
                       colors=None, captions=None):
     """
     boxes: [num_instance, (y1, x1, y2, x2, class_id)] in image coordinates.
-    masks: [height, width, num_instances]
+    masks: [height, width, num_instances], or a list of box crops or RLEs,
+        see utils.MASK_FORMATS
     class_ids: [num_instances]
     class_names: list of class names of the dataset
     scores: (optional) confidence scores for each box
@@ -102,7 +103,7 @@ def display_instances(image, boxes, masks, class_ids, class_names,
     if not N:
         print("\n*** No instances to display *** \n")
     else:
-        assert boxes.shape[0] == masks.shape[-1] == class_ids.shape[0]
+        assert boxes.shape[0] == utils.mask_count(masks) == class_ids.shape[0]
 
     # If no axis is passed, create one and automatically call show()
     auto_show = False
@@ -148,7 +149,7 @@ def display_instances(image, boxes, masks, class_ids, class_names,
                 color='w', size=11, backgroundcolor="none")
 
         # Mask
-        mask = masks[:, :, i]
+        mask = utils.instance_mask(masks, boxes, i, image.shape)
         if show_mask:
             masked_image = apply_mask(masked_image, mask, color)
 
@@ -15,6 +15,7 @@ from mrcnn import logger
 
 #from mrcnn import model as modellib, utils
 from mrcnn import model as modellib
+from mrcnn import export
 from mrcnn.config import Config
 from mrcnn.classifier import SClassifier
 
@@ -147,9 +148,11 @@ def main():
 	import argparse
 
 	parser = argparse.ArgumentParser(description='Use Mask R-CNN to classify radio sources')
-	parser.add_argument('--image', required=True,type=str,metavar="path to image",help='Image to apply the color splash effect on')
-	parser.add_argument('--scatalog', required=True,type=str,metavar="/path/to/scatalog.root",help='Path to Caesar source catalog file (.root)')
-	parser.add_argument('--weights', required=True,type=str,metavar="/path/to/weights.h5",help="Path to weights .h5 file")
+	parser.add_argument('--image', required=False,type=str,metavar="path to image",help='Image to apply the color splash effect on')
+	parser.add_argument('--scatalog', required=False,type=str,metavar="/path/to/scatalog.root",help='Path to Caesar source catalog file (.root)')
+	parser.add_argument('--weights', required=False,type=str,metavar="/path/to/weights.h5",help="Path to weights .h5 file")
+	parser.add_argument('--frozen', required=False,type=str,metavar="/path/to/model.pb",help="Path to frozen model .pb file, used instead of --weights")
+	parser.add_argument('--export', required=False,type=str,metavar="/path/to/model.pb",help="Export the model with --weights to a frozen model .pb file and exit")
 
 	parser.add_argument('--logs', required=False,default=DEFAULT_LOGS_DIR,metavar="/path/to/logs/",help='Logs and checkpoints directory (default=logs/)')
 	parser.add_argument('--nthreads', required=False,default=1,type=int,metavar="Number of worker threads",help="Number of worker threads")		
@@ -162,9 +165,11 @@ def main():
 
 	
 	# - Validate arguments
-	assert args.image, "Provide --image "
-	assert args.scatalog, "Provide --scatalog "
-	assert args.weights, "Provide --weights "
+	if not args.export:
+		assert args.image, "Provide --image "
+		assert args.scatalog, "Provide --scatalog "
+	assert args.weights or args.frozen, "Provide --weights or --frozen "
+	assert not (args.export and args.frozen), "Provide --weights, not --frozen, to export a model "
 
 	# - Get options
 	weights_path = args.weights
@@ -172,26 +177,41 @@ def main():
 	print("Image: ", args.image)
 	print("Source catalog: ", args.scatalog)
 	print("Weights: ", args.weights)
+	print("Frozen model: ", args.frozen)
 	print("Logs: ", args.logs)
 	print("scoreThr: ",args.scoreThr)
 	print("iouThr: ",args.iouThr)
 	print("nsources_max: ",args.nsources_max)
 	print("scutout_size: ",args.scutout_size)
 
-	# - Set configurations
-	config = SClassifierConfig()
-	config.display()
-
 	# =================================
 	# ==       BUILD MODEL
 	# =================================  
-	# - Create model for inference
-	logger.info("Creating model according to given config ...")
-	model = modellib.MaskRCNN(mode="inference", config=config,model_dir=args.logs)
-
-	# - Load weights
-	logger.info("Loading weights %s ..." % args.weights)
-	model.load_weights(args.weights,by_name=True)
+	if args.frozen:
+		# - Load frozen model, with its config
+		logger.info("Loading frozen model %s ..." % args.frozen)
+		model = export.FrozenMaskRCNN(args.frozen)
+		config = model.config
+		config.display()
+
+	else:
+		# - Set configurations
+		config = SClassifierConfig()
+		config.display()
+
+		# - Create model for inference
+		logger.info("Creating model according to given config ...")
+		model = modellib.MaskRCNN(mode="inference", config=config,model_dir=args.logs)
+
+		# - Load weights
+		logger.info("Loading weights %s ..." % args.weights)
+		model.load_weights(args.weights,by_name=True)
+
+	# - Export frozen model
+	if args.export:
+		logger.info("Exporting frozen model to %s ..." % args.export)
+		export.export_frozen(model,args.export)
+		return 0
 
 	# =================================
 	# ==       CLASSIFY SOURCES
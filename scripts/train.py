@@ -33,7 +33,6 @@ import json
 import datetime
 import numpy as np
 import skimage.draw
-from imgaug import augmenters as iaa
 import matplotlib.pyplot as plt
 from matplotlib import patches
 
@@ -46,6 +45,7 @@ sys.path.append(ROOT_DIR)  # To find local version of the library
 from mrcnn.config import Config
 from mrcnn import model as modellib, utils
 from mrcnn import visualize
+from mrcnn.augment import DihedralAugmentation
 
 # Path to trained weights file
 #COCO_WEIGHTS_PATH = os.path.join(ROOT_DIR, "mask_rcnn_coco.h5")
@@ -288,15 +288,8 @@ def train(model,nepochs=10,nthreads=1):
 	dataset_val.load_dataset(args.dataset)
 	dataset_val.prepare()
 
-	# Image augmentation
-	# http://imgaug.readthedocs.io/en/latest/source/augmenters.html
-	augmentation = iaa.SomeOf((0, 2), 
-		[
-			iaa.Fliplr(0.5),
-			iaa.Flipud(0.5),
-			iaa.OneOf([iaa.Affine(rotate=90),iaa.Affine(rotate=180),iaa.Affine(rotate=270)])
-		]
-	)
+	# Image augmentation: random flips and 90 degree rotations
+	augmentation = DihedralAugmentation()
 
 	# *** This training schedule is an example. Update to your needs ***
 	# Since we're using a very small dataset, and starting from
@@ -36,7 +36,6 @@ import numpy as np
 import skimage.draw
 import skimage.measure
 from skimage.measure import find_contours
-from imgaug import augmenters as iaa
 
 
 # Root directory of the project
@@ -48,6 +47,9 @@ sys.path.append(ROOT_DIR)  # To find local version of the library
 from mrcnn.config import Config
 from mrcnn import model as modellib, utils
 from mrcnn import visualize
+from mrcnn.augment import DihedralAugmentation
+from mrcnn.quarantine import Quarantine, validate_dataset
+from mrcnn.tfrecord import TFRecordInput, write_tfrecords
 from mrcnn.analyze import ModelTester
 from mrcnn.graph import Graph
 
@@ -318,25 +320,23 @@ class SourceDataset(utils.Dataset):
 def train(model,nepochs=10,nthreads=1):    
 	"""Train the model."""
     
-	# Training dataset.
-	dataset_train = SourceDataset()
-	dataset_train.load_dataset(args.dataset)
-	dataset_train.prepare()
-
-	# Validation dataset
-	dataset_val = SourceDataset()
-	dataset_val.load_dataset(args.dataset)
-	dataset_val.prepare()
-
-	# Image augmentation
-	# http://imgaug.readthedocs.io/en/latest/source/augmenters.html
-	augmentation = iaa.SomeOf((0, 2), 
-		[
-			iaa.Fliplr(0.5),
-			iaa.Flipud(0.5),
-			iaa.OneOf([iaa.Affine(rotate=90),iaa.Affine(rotate=180),iaa.Affine(rotate=270)])
-		]
-	)
+	if args.tfrecords:
+		# Training and validation datasets exported with the 'export' command
+		dataset_train = TFRecordInput(args.tfrecords + "-*.tfrecord", config)
+		dataset_val = TFRecordInput(args.tfrecords + "-*.tfrecord", config)
+	else:
+		# Training dataset.
+		dataset_train = SourceDataset()
+		dataset_train.load_dataset(args.dataset)
+		dataset_train.prepare()
+
+		# Validation dataset
+		dataset_val = SourceDataset()
+		dataset_val.load_dataset(args.dataset)
+		dataset_val.prepare()
+
+	# Image augmentation: random flips and 90 degree rotations
+	augmentation = DihedralAugmentation()
 
 	# *** This training schedule is an example. Update to your needs ***
 	# Since we're using a very small dataset, and starting from
@@ -353,6 +353,33 @@ def train(model,nepochs=10,nthreads=1):
 	)
 
 
+def export(config,nthreads=1):
+	""" Write the dataset to TFRecord files, to train with --tfrecords """
+	dataset = SourceDataset()
+	dataset.load_dataset(args.dataset)
+	dataset.prepare()
+
+	quarantine= Quarantine(os.path.join(args.logs, config.QUARANTINE_FILE)) if config.QUARANTINE_FILE else None
+
+	print("INFO: Exporting dataset to %s-*.tfrecord ..." % args.tfrecords)
+	write_tfrecords(dataset, config, args.tfrecords, workers=nthreads, quarantine=quarantine)
+
+
+def validate(config,nthreads=1):
+	""" Quarantine the samples of the dataset that fail to load """
+	dataset = SourceDataset()
+	dataset.load_dataset(args.dataset)
+	dataset.prepare()
+
+	# The training runs with the same logs directory skip the quarantined samples
+	quarantine_file= os.path.join(args.logs, config.QUARANTINE_FILE)
+	quarantine= Quarantine(quarantine_file)
+
+	print("INFO: Validating dataset ...")
+	failed= validate_dataset(dataset, config, quarantine, workers=nthreads)
+	print("INFO: %d samples failed, %d samples in quarantine file %s" % (len(failed),len(quarantine),quarantine_file))
+
+
 def test(model):
 	""" Test the model on input dataset """    
 	dataset = SourceDataset()
@@ -378,7 +405,7 @@ if __name__ == '__main__':
 	# Parse command line arguments
 	parser = argparse.ArgumentParser(description='Train Mask R-CNN to detect radio sources.')
 
-	parser.add_argument("command",metavar="<command>",help="'train' or 'splash'")
+	parser.add_argument("command",metavar="<command>",help="'train', 'test', 'validate' or 'export'")
 	parser.add_argument('--dataset', required=False,metavar="/path/to/balloon/dataset/",help='Directory of the source dataset')
 	parser.add_argument('--weights', required=True,metavar="/path/to/weights.h5",help="Path to weights .h5 file or 'coco'")
 	parser.add_argument('--logs', required=False,default=DEFAULT_LOGS_DIR,metavar="/path/to/logs/",help='Logs and checkpoints directory (default=logs/)')
@@ -388,6 +415,7 @@ if __name__ == '__main__':
 	parser.add_argument('--nvalidation_steps', required=False,default=50,type=int,metavar="Number of validation steps per epoch",help='Number of validation steps per epoch')
 	parser.add_argument('--weighttype', required=False,default='',metavar="Type of weights",help="Type of weights")
 	parser.add_argument('--nthreads', required=False,default=1,type=int,metavar="Number of worker threads",help="Number of worker threads")
+	parser.add_argument('--tfrecords', required=False,default='',metavar="/path/to/prefix",help="Prefix of the TFRecord files written by 'export'. If given, train from them")
 	parser.add_argument('--nimg_test', required=False,default=-1,type=int,metavar="Number of images in dataset to inspect during test",help="Number of images in dataset to inspect during test")	
 	parser.add_argument('--scoreThr_test', required=False,default=0.7,type=float,metavar="Object detection score threshold to be used during test",help="Object detection score threshold to be used during test")
 	parser.add_argument('--iouThr_test', required=False,default=0.6,type=float,metavar="IOU threshold used to match detected objects with true objects",help="IOU threshold used to match detected objects with true objects")
@@ -397,8 +425,8 @@ if __name__ == '__main__':
 
 	# Validate arguments
 	if args.command == "train":
-		assert args.dataset, "Argument --dataset is required for training"
-	elif args.command == "test":
+		assert args.dataset or args.tfrecords, "Argument --dataset or --tfrecords is required for training"
+	elif args.command in ("test","validate","export"):
 		assert args.dataset, "Argument --dataset is required for testing"
 	elif args.command == "splash":
 		assert args.image, "Provide --image to apply color splash"
@@ -432,6 +460,15 @@ if __name__ == '__main__':
 
 	config.display()
 
+	# Validate or export the dataset, no model needed
+	if args.command == "validate":
+		validate(config,args.nthreads)
+		sys.exit(0)
+	elif args.command == "export":
+		assert args.tfrecords, "Argument --tfrecords is required for export"
+		export(config,args.nthreads)
+		sys.exit(0)
+
 	# Create model
 	if args.command == "train":
 		model = modellib.MaskRCNN(mode="training", config=config,model_dir=args.logs)
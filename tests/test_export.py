@@ -0,0 +1,69 @@
+"""
+Round trip test of the frozen inference graphs of export.py.
+"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip("tensorflow")
+pytest.importorskip("keras")
+
+import keras.backend as K
+
+from mrcnn import model as modellib
+from mrcnn import export
+from mrcnn.config import Config
+
+
+class ExportConfig(Config):
+    """Small inference model, with random weights. Keep all detections so
+    that the outputs are compared on many of them."""
+    NAME = "export"
+    GPU_COUNT = 1
+    IMAGES_PER_GPU = 2
+    NUM_CLASSES = 3
+    BACKBONE = "resnet50"
+    IMAGE_MIN_DIM = 128
+    IMAGE_MAX_DIM = 128
+    RPN_ANCHOR_SCALES = (8, 16, 32, 64, 128)
+    POST_NMS_ROIS_INFERENCE = 100
+    DETECTION_MAX_INSTANCES = 20
+    DETECTION_MIN_CONFIDENCE = 0
+
+
+def sorted_detections(r):
+    """Detections of a result by decreasing score, so that the order of
+    equal scores doesn't matter."""
+    order = np.lexsort(tuple(r["rois"].T) + (-r["scores"],))
+    return r["rois"][order], r["class_ids"][order], r["scores"][order], \
+        r["masks"][..., order]
+
+
+@pytest.mark.parametrize("optimize", [False, True])
+def test_export_round_trip(tmp_path, optimize):
+    K.clear_session()
+    config = ExportConfig()
+    model = modellib.MaskRCNN(mode="inference", config=config, model_dir=str(tmp_path))
+    rng = np.random.RandomState(0)
+    images = [rng.randint(0, 255, (128, 128, 3)).astype(np.uint8)
+              for _ in range(config.BATCH_SIZE)]
+    expected = model.detect_many(images)
+
+    path = str(tmp_path / "mask_rcnn.pb")
+    export.export_frozen(model, path, optimize=optimize)
+    frozen = export.FrozenMaskRCNN(path)
+    try:
+        results = frozen.detect_many(images)
+    finally:
+        frozen.close()
+        K.clear_session()
+
+    assert len(results) == len(expected)
+    for e, r in zip(expected, results):
+        assert r["rois"].shape[0] == e["rois"].shape[0] > 0
+        e_rois, e_class_ids, e_scores, e_masks = sorted_detections(e)
+        r_rois, r_class_ids, r_scores, r_masks = sorted_detections(r)
+        np.testing.assert_allclose(r_scores, e_scores, atol=1e-4)
+        np.testing.assert_allclose(r_rois, e_rois, atol=1)
+        np.testing.assert_array_equal(r_class_ids, e_class_ids)
+        assert np.mean(r_masks != e_masks) < 1e-3